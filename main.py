@@ -5,7 +5,13 @@ import os
 import re
 import io
 import csv
+import gzip
+import zlib
+import hashlib
 import uuid
+import functools
+import itertools
+import bisect
 import time
 import json
 import traceback
@@ -16,25 +22,29 @@ from email.header import decode_header
 import email.utils
 from datetime import datetime, date, timedelta
 from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
-from typing import Dict, List, Optional, Tuple, Any
-from html import escape as h
+from typing import Dict, List, Optional, Tuple, Any, Iterable, Iterator, Union
+from collections.abc import Mapping
+from html import escape as _html_escape
 
 from wsgiref.simple_server import make_server, WSGIRequestHandler
 from urllib.parse import parse_qs, urlencode, quote as urlencode_component
 import cgi
 
 import psycopg2
-from psycopg2.extras import RealDictCursor
+from psycopg2.extras import RealDictCursor, execute_values
 from psycopg2 import pool
+from psycopg2 import sql as pgsql
 
 try:
     from openpyxl import Workbook, load_workbook
     from openpyxl.styles import Font, Alignment, PatternFill, Border, Side
     from openpyxl.utils import get_column_letter
+    from openpyxl.xml import LXML as OPENPYXL_LXML
 except ImportError:
     Workbook = None
     load_workbook = None
     Font = Alignment = PatternFill = Border = Side = get_column_letter = None
+    OPENPYXL_LXML = False
 
 try:
     from bs4 import BeautifulSoup
@@ -61,6 +71,31 @@ try:
 except ImportError:
     pdfplumber = None
 
+try:
+    import pypdfium2 as pdfium
+except ImportError:
+    pdfium = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    from markupsafe import escape as _markup_escape
+except ImportError:
+    _markup_escape = None
+
+if _markup_escape is not None:
+    def h(s: Any) -> str:
+        """HTML-экранирование на C (markupsafe). str() обязателен: Markup экранирует всё,
+        что к нему прибавляют, а страницы склеивают экранированные значения с разметкой.
+        None даёт пустую строку, а не "None"."""
+        return str(_markup_escape(s)) if s is not None else ""
+else:
+    def h(s: Any) -> str:
+        return _html_escape(s) if s is not None else ""
+
 APP_DIR = os.path.dirname(os.path.abspath(__file__))
 DOWNLOAD_DIR = os.path.join(APP_DIR, "_downloads_tmp")
 os.makedirs(DOWNLOAD_DIR, exist_ok=True)
@@ -94,343 +129,461 @@ NAV = [
 ]
 
 
+def _render_nav(path: str) -> str:
+    nav_html = []
+    for group, items in NAV:
+        nav_html.append(f'<div class="navgroup"><div class="navtitle">{h(group)}</div>')
+        for name, url in items:
+            active = "active" if url == path else ""
+            nav_html.append(f'<a class="navitem {active}" href="{h(url)}"><span>{h(name)}</span></a>')
+        nav_html.append("</div>")
+    return "\n".join(nav_html)
+
+
+# NAV не меняется во время работы — меню рендерится один раз для каждого активного пункта
+NAV_HTML = _render_nav("")
+_NAV_HTML_BY_PATH = {url: _render_nav(url) for _group, items in NAV for _name, url in items}
+
+
 DB_POOL = None
+PG_POOL_MIN = int(os.environ.get("PG_POOL_MIN", "10"))
+PG_POOL_MAX = int(os.environ.get("PG_POOL_MAX", "50"))
+PG_HEALTHCHECK_INTERVAL = 60
+# PREPARE для выборок по id на каждом соединении пула. По умолчанию выключено: за PgBouncer
+# в режиме pool_mode = transaction подготовленные операторы между транзакциями не сохраняются
+PG_PREPARE_LOOKUPS = os.environ.get("PG_PREPARE_LOOKUPS", "0") == "1"
+
+
+class PreparingConnection(psycopg2.extensions.connection):
+    """Соединение пула, которое помнит, какие операторы из LOOKUP_STATEMENTS на нём уже подготовлены.
+    Готовятся лениво, при первой выборке (см. _fetch_by_id): к этому моменту схема уже создана."""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared_lookups: set = set()
+
 
 def init_db_pool():
     global DB_POOL
     if DB_POOL is None:
         DB_POOL = pool.ThreadedConnectionPool(
-            minconn=2,
-            maxconn=10,
-            dsn=os.environ.get("DATABASE_URL")
+            minconn=PG_POOL_MIN,
+            maxconn=max(PG_POOL_MIN, PG_POOL_MAX),
+            dsn=os.environ.get("DATABASE_URL"),
+            connection_factory=PreparingConnection if PG_PREPARE_LOOKUPS else None,
+            keepalives=1,
+            keepalives_idle=30,
+            keepalives_interval=10,
+            keepalives_count=3,
         )
 
+# Когда соединение в последний раз вернули в пул (id соединения -> time.monotonic())
+_CONN_RETURNED_AT: Dict[int, float] = {}
+
+
+def _connection_alive(conn) -> bool:
+    """Соединение, пролежавшее в пуле дольше PG_HEALTHCHECK_INTERVAL, проверяется SELECT 1 перед выдачей"""
+    if conn.closed:
+        return False
+    returned = _CONN_RETURNED_AT.get(id(conn))
+    if returned is None or time.monotonic() - returned < PG_HEALTHCHECK_INTERVAL:
+        return True
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT 1")
+        conn.rollback()
+        return True
+    except Exception:
+        return False
+
+
 def get_db_connection():
     global DB_POOL
     if DB_POOL is None:
         init_db_pool()
+    # Проверка при выдаче, по одному соединению: мёртвое закрывается и заменяется новым из пула
+    for _ in range(PG_POOL_MAX + 1):
+        conn = DB_POOL.getconn()
+        if _connection_alive(conn):
+            return conn
+        _CONN_RETURNED_AT.pop(id(conn), None)
+        try:
+            DB_POOL.putconn(conn, close=True)
+        except Exception:
+            pass
     return DB_POOL.getconn()
 
 def return_db_connection(conn):
     global DB_POOL
     if DB_POOL is not None:
         try:
-            DB_POOL.putconn(conn)
+            if conn.closed:
+                _CONN_RETURNED_AT.pop(id(conn), None)
+                DB_POOL.putconn(conn, close=True)
+            else:
+                _CONN_RETURNED_AT[id(conn)] = time.monotonic()
+                DB_POOL.putconn(conn)
+                if conn.closed:  # лишние сверх minconn пул закрывает сам
+                    _CONN_RETURNED_AT.pop(id(conn), None)
         except:
             pass
 
+
 from contextlib import contextmanager
 
 @contextmanager
 def db_connection():
-    """Context manager for safe database connection handling"""
+    """Context manager for safe database connection handling: commit on success, rollback on error"""
     conn = get_db_connection()
     try:
         yield conn
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
     finally:
         return_db_connection(conn)
 
 
+@contextmanager
+def db_cursor(dict_cursor: bool = False, name: Optional[str] = None):
+    """Cursor on a pooled connection; commit/rollback and return to the pool are handled by db_connection()"""
+    with db_connection() as conn:
+        with conn.cursor(name=name, cursor_factory=RealDictCursor if dict_cursor else None) as cur:
+            yield cur
+
+
+SCHEMA_VERSION = 12
+
+_SCHEMA_DDL = """
+    CREATE TABLE IF NOT EXISTS settings (
+        id SERIAL PRIMARY KEY,
+        key VARCHAR(255) UNIQUE NOT NULL,
+        value TEXT
+    );
+    CREATE TABLE IF NOT EXISTS cp_category_map (
+        id SERIAL PRIMARY KEY,
+        counterparty_key VARCHAR(500) UNIQUE NOT NULL,
+        category VARCHAR(500)
+    );
+    CREATE TABLE IF NOT EXISTS user_category_map (
+        id SERIAL PRIMARY KEY,
+        counterparty_key VARCHAR(500) NOT NULL,
+        category VARCHAR(500)
+    );
+    CREATE INDEX IF NOT EXISTS idx_user_category_map_key ON user_category_map (counterparty_key);
+    CREATE TABLE IF NOT EXISTS bank_rows (
+        id VARCHAR(64) PRIMARY KEY,
+        date_str VARCHAR(20),
+        month VARCHAR(10),
+        incoming DECIMAL(18,2) DEFAULT 0,
+        outgoing DECIMAL(18,2) DEFAULT 0,
+        purpose TEXT,
+        counterparty TEXT,
+        doctype VARCHAR(100),
+        skip_outgoing BOOLEAN DEFAULT FALSE,
+        category VARCHAR(255),
+        cp_inn VARCHAR(20),
+        cp_kpp VARCHAR(20),
+        cp_account VARCHAR(50),
+        cp_bank TEXT,
+        cp_bik VARCHAR(20),
+        cp_corr VARCHAR(50),
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    CREATE TABLE IF NOT EXISTS counterparties (
+        id VARCHAR(64) PRIMARY KEY,
+        kind VARCHAR(100),
+        name TEXT NOT NULL,
+        inn VARCHAR(20),
+        kpp VARCHAR(20),
+        bank TEXT,
+        bik VARCHAR(20),
+        corr VARCHAR(50),
+        account VARCHAR(50),
+        legal_address TEXT,
+        phone VARCHAR(50),
+        is_our_company BOOLEAN DEFAULT FALSE,
+        full_name TEXT,
+        inspection_code VARCHAR(50),
+        oktmo VARCHAR(20),
+        okato VARCHAR(20),
+        signatory TEXT,
+        sfr_reg_number VARCHAR(50),
+        pfr_reg_self VARCHAR(50),
+        pfr_reg_employees VARCHAR(50),
+        pfr_terr_code VARCHAR(20),
+        pfr_terr_organ TEXT,
+        payment_details TEXT,
+        okpo VARCHAR(20),
+        okopf VARCHAR(20),
+        okfs VARCHAR(20),
+        okved1 VARCHAR(50),
+        okved2 VARCHAR(50),
+        okpo_rosstat VARCHAR(20),
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    ALTER TABLE counterparties ADD COLUMN IF NOT EXISTS is_our_company BOOLEAN DEFAULT FALSE;
+    ALTER TABLE counterparties ADD COLUMN IF NOT EXISTS full_name TEXT;
+    ALTER TABLE counterparties ADD COLUMN IF NOT EXISTS inspection_code VARCHAR(50);
+    ALTER TABLE counterparties ADD COLUMN IF NOT EXISTS oktmo VARCHAR(20);
+    ALTER TABLE counterparties ADD COLUMN IF NOT EXISTS okato VARCHAR(20);
+    ALTER TABLE counterparties ADD COLUMN IF NOT EXISTS signatory TEXT;
+    ALTER TABLE counterparties ADD COLUMN IF NOT EXISTS sfr_reg_number VARCHAR(50);
+    ALTER TABLE counterparties ADD COLUMN IF NOT EXISTS pfr_reg_self VARCHAR(50);
+    ALTER TABLE counterparties ADD COLUMN IF NOT EXISTS pfr_reg_employees VARCHAR(50);
+    ALTER TABLE counterparties ADD COLUMN IF NOT EXISTS pfr_terr_code VARCHAR(20);
+    ALTER TABLE counterparties ADD COLUMN IF NOT EXISTS pfr_terr_organ TEXT;
+    ALTER TABLE counterparties ADD COLUMN IF NOT EXISTS payment_details TEXT;
+    ALTER TABLE counterparties ADD COLUMN IF NOT EXISTS okpo VARCHAR(20);
+    ALTER TABLE counterparties ADD COLUMN IF NOT EXISTS okopf VARCHAR(20);
+    ALTER TABLE counterparties ADD COLUMN IF NOT EXISTS okfs VARCHAR(20);
+    ALTER TABLE counterparties ADD COLUMN IF NOT EXISTS okved1 VARCHAR(50);
+    ALTER TABLE counterparties ADD COLUMN IF NOT EXISTS okved2 VARCHAR(50);
+    ALTER TABLE counterparties ADD COLUMN IF NOT EXISTS okpo_rosstat VARCHAR(20);
+    CREATE TABLE IF NOT EXISTS acts (
+        id VARCHAR(64) PRIMARY KEY,
+        doc_no VARCHAR(50),
+        doc_date VARCHAR(20),
+        executor_id VARCHAR(64),
+        customer_id VARCHAR(64),
+        direction VARCHAR(50) DEFAULT 'provide',
+        executor_json TEXT,
+        customer_json TEXT,
+        basis TEXT,
+        vat_mode VARCHAR(100),
+        lines_json TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    ALTER TABLE acts ADD COLUMN IF NOT EXISTS direction VARCHAR(50) DEFAULT 'provide';
+    ALTER TABLE acts ADD COLUMN IF NOT EXISTS executor_json TEXT;
+    ALTER TABLE acts ADD COLUMN IF NOT EXISTS customer_json TEXT;
+    CREATE TABLE IF NOT EXISTS payment_orders (
+        id VARCHAR(64) PRIMARY KEY,
+        number VARCHAR(50),
+        date_str VARCHAR(20),
+        amount DECIMAL(18,2),
+        amount_words TEXT,
+        payer_json TEXT,
+        receiver_json TEXT,
+        purpose TEXT,
+        pay_type VARCHAR(50),
+        vid_op VARCHAR(10),
+        ocher VARCHAR(10),
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    CREATE TABLE IF NOT EXISTS payment_templates (
+        id SERIAL PRIMARY KEY,
+        name VARCHAR(255) UNIQUE NOT NULL,
+        template_json TEXT
+    );
+    CREATE TABLE IF NOT EXISTS employees (
+        id VARCHAR(64) PRIMARY KEY,
+        name TEXT NOT NULL,
+        inn VARCHAR(20),
+        passport VARCHAR(100),
+        passport_issued TEXT,
+        bank TEXT,
+        bik VARCHAR(20),
+        corr VARCHAR(50),
+        account VARCHAR(50),
+        salary DECIMAL(18,2),
+        advance DECIMAL(18,2),
+        main_part DECIMAL(18,2),
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    ALTER TABLE employees ADD COLUMN IF NOT EXISTS inn VARCHAR(20);
+    ALTER TABLE employees ADD COLUMN IF NOT EXISTS passport VARCHAR(100);
+    ALTER TABLE employees ADD COLUMN IF NOT EXISTS passport_issued TEXT;
+    ALTER TABLE employees ADD COLUMN IF NOT EXISTS bank TEXT;
+    ALTER TABLE employees ADD COLUMN IF NOT EXISTS bik VARCHAR(20);
+    ALTER TABLE employees ADD COLUMN IF NOT EXISTS corr VARCHAR(50);
+    ALTER TABLE employees ADD COLUMN IF NOT EXISTS account VARCHAR(50);
+    ALTER TABLE employees ADD COLUMN IF NOT EXISTS advance DECIMAL(18,2);
+    ALTER TABLE employees ADD COLUMN IF NOT EXISTS main_part DECIMAL(18,2);
+    CREATE TABLE IF NOT EXISTS salary_payments (
+        id VARCHAR(64) PRIMARY KEY,
+        employee_id VARCHAR(64),
+        month VARCHAR(10),
+        pay_type VARCHAR(20),
+        amount DECIMAL(18,2),
+        payment_order_id VARCHAR(64),
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    ALTER TABLE salary_payments ADD COLUMN IF NOT EXISTS pay_type VARCHAR(20);
+    ALTER TABLE salary_payments ADD COLUMN IF NOT EXISTS payment_order_id VARCHAR(64);
+    ALTER TABLE payment_orders ADD COLUMN IF NOT EXISTS source VARCHAR(50);
+    CREATE TABLE IF NOT EXISTS upd_rows (
+        id VARCHAR(64) PRIMARY KEY,
+        doc_no VARCHAR(50),
+        doc_date VARCHAR(20),
+        counterparty TEXT,
+        inn VARCHAR(20),
+        amount DECIMAL(18,2),
+        vat DECIMAL(18,2),
+        description TEXT,
+        source_file TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    CREATE TABLE IF NOT EXISTS real_rows (
+        id VARCHAR(64) PRIMARY KEY,
+        doc_no VARCHAR(50),
+        doc_date VARCHAR(20),
+        counterparty TEXT,
+        amount DECIMAL(18,2),
+        description TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    CREATE TABLE IF NOT EXISTS basis_history (
+        id SERIAL PRIMARY KEY,
+        basis TEXT UNIQUE NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS cash_payments (
+        id VARCHAR(64) PRIMARY KEY,
+        date_str VARCHAR(20),
+        nomenclature TEXT,
+        amount DECIMAL(18,2) DEFAULT 0,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    CREATE TABLE IF NOT EXISTS marketplace_rows (
+        id VARCHAR(64) PRIMARY KEY,
+        platform VARCHAR(50) NOT NULL,
+        period_type VARCHAR(20),
+        period_label VARCHAR(100),
+        year INTEGER,
+        quarter INTEGER,
+        month INTEGER,
+        date_start VARCHAR(20),
+        date_end VARCHAR(20),
+        amount DECIMAL(18,2) DEFAULT 0,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    CREATE INDEX IF NOT EXISTS idx_marketplace_rows_platform ON marketplace_rows(platform);
+    CREATE INDEX IF NOT EXISTS idx_bank_rows_date ON bank_rows(date_str);
+    CREATE INDEX IF NOT EXISTS idx_bank_rows_created ON bank_rows(created_at DESC);
+    ALTER TABLE bank_rows ADD COLUMN IF NOT EXISTS op_date DATE;
+    CREATE INDEX IF NOT EXISTS idx_bank_rows_op_date ON bank_rows(op_date);
+    ALTER TABLE bank_rows ADD COLUMN IF NOT EXISTS search_text TEXT;
+    CREATE INDEX IF NOT EXISTS idx_cash_payments_date ON cash_payments(date_str);
+    CREATE INDEX IF NOT EXISTS idx_counterparties_name ON counterparties(name);
+    CREATE INDEX IF NOT EXISTS idx_counterparties_inn ON counterparties(inn);
+    DROP INDEX IF EXISTS idx_counterparties_name_upper;
+    CREATE INDEX IF NOT EXISTS idx_acts_date ON acts(doc_date);
+    CREATE INDEX IF NOT EXISTS idx_payment_orders_date ON payment_orders(date_str);
+    DELETE FROM user_category_map a USING user_category_map b
+        WHERE a.id > b.id AND a.counterparty_key = b.counterparty_key AND a.category = b.category;
+    CREATE UNIQUE INDEX IF NOT EXISTS uq_user_category_map ON user_category_map(counterparty_key, category);
+"""
+
+
+def _backfill_bank_op_dates(cur):
+    """op_date для строк, загруженных до появления колонки: дата разбирается тем же parse_date_ddmmyyyy,
+    что и при загрузке (to_date в SQL падает на датах вроде 31.02)."""
+    cur.execute("SELECT id, date_str FROM bank_rows WHERE op_date IS NULL AND date_str <> ''")
+    fixes = [(rid, d) for rid, ds in cur.fetchall() if (d := parse_date_ddmmyyyy(ds))]
+    if fixes:
+        execute_values(cur, """
+            UPDATE bank_rows AS b SET op_date = v.op_date
+            FROM (VALUES %s) AS v(id, op_date) WHERE b.id = v.id
+        """, fixes, template="(%s, %s::date)", page_size=1000)
+
+
+def bank_search_text(counterparty: Optional[str], purpose: Optional[str], category: Optional[str],
+                     incoming: Any, outgoing: Any) -> str:
+    """Строка поиска страницы банка (bank_rows.search_text): контрагент, назначение, статья и ненулевые суммы
+    через norm_text. Считается в Python, а не upper() в SQL: с локалью базы C/POSIX upper() не трогает кириллицу.
+    Нулевые суммы не пишутся, как и в прежнем поиске по странице (str(Decimal 0 or "") == ""): иначе запрос
+    «0.00» находил бы почти каждую строку, ведь у операции заполнено только поступление или только списание."""
+    amounts = [f"{decimal_from_str(v):.2f}" for v in (incoming, outgoing) if v and decimal_from_str(v)]
+    return norm_text(" ".join([counterparty or "", purpose or "", category or ""] + amounts))
+
+
+def _refresh_bank_search_text(cur, ids: Optional[List[Any]] = None):
+    """Пересчитать search_text для строк ids (None — для строк, где он ещё не заполнен)."""
+    sql = "SELECT id, counterparty, purpose, category, incoming, outgoing FROM bank_rows"
+    if ids is None:
+        cur.execute(sql + " WHERE search_text IS NULL")
+    elif not ids:
+        return
+    else:
+        cur.execute(sql + " WHERE id = ANY(%s)", (list(ids),))
+    _bulk_update_column(cur, "bank_rows", "search_text",
+                        [(rid, bank_search_text(*fields)) for rid, *fields in cur.fetchall()])
+
+
 def init_database():
     conn = get_db_connection()
-    cur = conn.cursor()
-    
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS settings (
-            id SERIAL PRIMARY KEY,
-            key VARCHAR(255) UNIQUE NOT NULL,
-            value TEXT
-        )
-    """)
-    
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS cp_category_map (
-            id SERIAL PRIMARY KEY,
-            counterparty_key VARCHAR(500) UNIQUE NOT NULL,
-            category VARCHAR(500)
-        )
-    """)
-    
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS user_category_map (
-            id SERIAL PRIMARY KEY,
-            counterparty_key VARCHAR(500) NOT NULL,
-            category VARCHAR(500)
-        )
-    """)
-    cur.execute("""
-        CREATE INDEX IF NOT EXISTS idx_user_category_map_key ON user_category_map (counterparty_key)
-    """)
-    
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS bank_rows (
-            id VARCHAR(64) PRIMARY KEY,
-            date_str VARCHAR(20),
-            month VARCHAR(10),
-            incoming DECIMAL(18,2) DEFAULT 0,
-            outgoing DECIMAL(18,2) DEFAULT 0,
-            purpose TEXT,
-            counterparty TEXT,
-            doctype VARCHAR(100),
-            skip_outgoing BOOLEAN DEFAULT FALSE,
-            category VARCHAR(255),
-            cp_inn VARCHAR(20),
-            cp_kpp VARCHAR(20),
-            cp_account VARCHAR(50),
-            cp_bank TEXT,
-            cp_bik VARCHAR(20),
-            cp_corr VARCHAR(50),
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    """)
-    
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS counterparties (
-            id VARCHAR(64) PRIMARY KEY,
-            kind VARCHAR(100),
-            name TEXT NOT NULL,
-            inn VARCHAR(20),
-            kpp VARCHAR(20),
-            bank TEXT,
-            bik VARCHAR(20),
-            corr VARCHAR(50),
-            account VARCHAR(50),
-            legal_address TEXT,
-            phone VARCHAR(50),
-            is_our_company BOOLEAN DEFAULT FALSE,
-            full_name TEXT,
-            inspection_code VARCHAR(50),
-            oktmo VARCHAR(20),
-            okato VARCHAR(20),
-            signatory TEXT,
-            sfr_reg_number VARCHAR(50),
-            pfr_reg_self VARCHAR(50),
-            pfr_reg_employees VARCHAR(50),
-            pfr_terr_code VARCHAR(20),
-            pfr_terr_organ TEXT,
-            payment_details TEXT,
-            okpo VARCHAR(20),
-            okopf VARCHAR(20),
-            okfs VARCHAR(20),
-            okved1 VARCHAR(50),
-            okved2 VARCHAR(50),
-            okpo_rosstat VARCHAR(20),
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    """)
-    cur.execute("ALTER TABLE counterparties ADD COLUMN IF NOT EXISTS is_our_company BOOLEAN DEFAULT FALSE")
-    cur.execute("ALTER TABLE counterparties ADD COLUMN IF NOT EXISTS full_name TEXT")
-    cur.execute("ALTER TABLE counterparties ADD COLUMN IF NOT EXISTS inspection_code VARCHAR(50)")
-    cur.execute("ALTER TABLE counterparties ADD COLUMN IF NOT EXISTS oktmo VARCHAR(20)")
-    cur.execute("ALTER TABLE counterparties ADD COLUMN IF NOT EXISTS okato VARCHAR(20)")
-    cur.execute("ALTER TABLE counterparties ADD COLUMN IF NOT EXISTS signatory TEXT")
-    cur.execute("ALTER TABLE counterparties ADD COLUMN IF NOT EXISTS sfr_reg_number VARCHAR(50)")
-    cur.execute("ALTER TABLE counterparties ADD COLUMN IF NOT EXISTS pfr_reg_self VARCHAR(50)")
-    cur.execute("ALTER TABLE counterparties ADD COLUMN IF NOT EXISTS pfr_reg_employees VARCHAR(50)")
-    cur.execute("ALTER TABLE counterparties ADD COLUMN IF NOT EXISTS pfr_terr_code VARCHAR(20)")
-    cur.execute("ALTER TABLE counterparties ADD COLUMN IF NOT EXISTS pfr_terr_organ TEXT")
-    cur.execute("ALTER TABLE counterparties ADD COLUMN IF NOT EXISTS payment_details TEXT")
-    cur.execute("ALTER TABLE counterparties ADD COLUMN IF NOT EXISTS okpo VARCHAR(20)")
-    cur.execute("ALTER TABLE counterparties ADD COLUMN IF NOT EXISTS okopf VARCHAR(20)")
-    cur.execute("ALTER TABLE counterparties ADD COLUMN IF NOT EXISTS okfs VARCHAR(20)")
-    cur.execute("ALTER TABLE counterparties ADD COLUMN IF NOT EXISTS okved1 VARCHAR(50)")
-    cur.execute("ALTER TABLE counterparties ADD COLUMN IF NOT EXISTS okved2 VARCHAR(50)")
-    cur.execute("ALTER TABLE counterparties ADD COLUMN IF NOT EXISTS okpo_rosstat VARCHAR(20)")
-    
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS acts (
-            id VARCHAR(64) PRIMARY KEY,
-            doc_no VARCHAR(50),
-            doc_date VARCHAR(20),
-            executor_id VARCHAR(64),
-            customer_id VARCHAR(64),
-            direction VARCHAR(50) DEFAULT 'provide',
-            executor_json TEXT,
-            customer_json TEXT,
-            basis TEXT,
-            vat_mode VARCHAR(100),
-            lines_json TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    """)
-    
-    cur.execute("ALTER TABLE acts ADD COLUMN IF NOT EXISTS direction VARCHAR(50) DEFAULT 'provide'")
-    cur.execute("ALTER TABLE acts ADD COLUMN IF NOT EXISTS executor_json TEXT")
-    cur.execute("ALTER TABLE acts ADD COLUMN IF NOT EXISTS customer_json TEXT")
-    
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS payment_orders (
-            id VARCHAR(64) PRIMARY KEY,
-            number VARCHAR(50),
-            date_str VARCHAR(20),
-            amount DECIMAL(18,2),
-            amount_words TEXT,
-            payer_json TEXT,
-            receiver_json TEXT,
-            purpose TEXT,
-            pay_type VARCHAR(50),
-            vid_op VARCHAR(10),
-            ocher VARCHAR(10),
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    """)
-    
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS payment_templates (
-            id SERIAL PRIMARY KEY,
-            name VARCHAR(255) UNIQUE NOT NULL,
-            template_json TEXT
-        )
-    """)
-    
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS employees (
-            id VARCHAR(64) PRIMARY KEY,
-            name TEXT NOT NULL,
-            inn VARCHAR(20),
-            passport VARCHAR(100),
-            passport_issued TEXT,
-            bank TEXT,
-            bik VARCHAR(20),
-            corr VARCHAR(50),
-            account VARCHAR(50),
-            salary DECIMAL(18,2),
-            advance DECIMAL(18,2),
-            main_part DECIMAL(18,2),
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    """)
-    cur.execute("ALTER TABLE employees ADD COLUMN IF NOT EXISTS inn VARCHAR(20)")
-    cur.execute("ALTER TABLE employees ADD COLUMN IF NOT EXISTS passport VARCHAR(100)")
-    cur.execute("ALTER TABLE employees ADD COLUMN IF NOT EXISTS passport_issued TEXT")
-    cur.execute("ALTER TABLE employees ADD COLUMN IF NOT EXISTS bank TEXT")
-    cur.execute("ALTER TABLE employees ADD COLUMN IF NOT EXISTS bik VARCHAR(20)")
-    cur.execute("ALTER TABLE employees ADD COLUMN IF NOT EXISTS corr VARCHAR(50)")
-    cur.execute("ALTER TABLE employees ADD COLUMN IF NOT EXISTS account VARCHAR(50)")
-    cur.execute("ALTER TABLE employees ADD COLUMN IF NOT EXISTS advance DECIMAL(18,2)")
-    cur.execute("ALTER TABLE employees ADD COLUMN IF NOT EXISTS main_part DECIMAL(18,2)")
-    
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS salary_payments (
-            id VARCHAR(64) PRIMARY KEY,
-            employee_id VARCHAR(64),
-            month VARCHAR(10),
-            pay_type VARCHAR(20),
-            amount DECIMAL(18,2),
-            payment_order_id VARCHAR(64),
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    """)
-    cur.execute("ALTER TABLE salary_payments ADD COLUMN IF NOT EXISTS pay_type VARCHAR(20)")
-    cur.execute("ALTER TABLE salary_payments ADD COLUMN IF NOT EXISTS payment_order_id VARCHAR(64)")
-    cur.execute("ALTER TABLE payment_orders ADD COLUMN IF NOT EXISTS source VARCHAR(50)")
-    
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS upd_rows (
-            id VARCHAR(64) PRIMARY KEY,
-            doc_no VARCHAR(50),
-            doc_date VARCHAR(20),
-            counterparty TEXT,
-            inn VARCHAR(20),
-            amount DECIMAL(18,2),
-            vat DECIMAL(18,2),
-            description TEXT,
-            source_file TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    """)
-    
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS real_rows (
-            id VARCHAR(64) PRIMARY KEY,
-            doc_no VARCHAR(50),
-            doc_date VARCHAR(20),
-            counterparty TEXT,
-            amount DECIMAL(18,2),
-            description TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    """)
-    
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS basis_history (
-            id SERIAL PRIMARY KEY,
-            basis TEXT UNIQUE NOT NULL
-        )
-    """)
-    
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS cash_payments (
-            id VARCHAR(64) PRIMARY KEY,
-            date_str VARCHAR(20),
-            nomenclature TEXT,
-            amount DECIMAL(18,2) DEFAULT 0,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    """)
-    
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS marketplace_rows (
-            id VARCHAR(64) PRIMARY KEY,
-            platform VARCHAR(50) NOT NULL,
-            period_type VARCHAR(20),
-            period_label VARCHAR(100),
-            year INTEGER,
-            quarter INTEGER,
-            month INTEGER,
-            date_start VARCHAR(20),
-            date_end VARCHAR(20),
-            amount DECIMAL(18,2) DEFAULT 0,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    """)
-    
-    cur.execute("CREATE INDEX IF NOT EXISTS idx_marketplace_rows_platform ON marketplace_rows(platform)")
-    cur.execute("CREATE INDEX IF NOT EXISTS idx_bank_rows_date ON bank_rows(date_str)")
-    cur.execute("CREATE INDEX IF NOT EXISTS idx_bank_rows_created ON bank_rows(created_at DESC)")
-    cur.execute("CREATE INDEX IF NOT EXISTS idx_cash_payments_date ON cash_payments(date_str)")
-    cur.execute("CREATE INDEX IF NOT EXISTS idx_counterparties_name ON counterparties(name)")
-    cur.execute("CREATE INDEX IF NOT EXISTS idx_counterparties_inn ON counterparties(inn)")
-    cur.execute("CREATE INDEX IF NOT EXISTS idx_acts_date ON acts(doc_date)")
-    cur.execute("CREATE INDEX IF NOT EXISTS idx_payment_orders_date ON payment_orders(date_str)")
-    
-    conn.commit()
-    cur.close()
-    return_db_connection(conn)
+    try:
+        cur = conn.cursor()
+        try:
+            cur.execute("SELECT value FROM settings WHERE key = 'schema_version'")
+            row = cur.fetchone()
+            current = int(row[0]) if row and str(row[0]).isdigit() else 0
+        except psycopg2.Error:
+            conn.rollback()
+            current = 0
+        if current >= SCHEMA_VERSION:
+            conn.rollback()
+            cur.close()
+            return
+
+        cur.execute(_SCHEMA_DDL)
+        _backfill_bank_op_dates(cur)
+        _refresh_bank_search_text(cur)
+        cur.execute("""
+            INSERT INTO settings (key, value) VALUES ('schema_version', %s)
+            ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value
+        """, (str(SCHEMA_VERSION),))
+        conn.commit()
+        cur.close()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        return_db_connection(conn)
 
 
 def new_id() -> str:
     return uuid.uuid4().hex
 
 
+_WS_RE = re.compile(r"\s+")
+_SAFE_FN_RE = re.compile(r"[^0-9A-Za-zА-Яа-я_\-\. ]+")
+
+
+@functools.lru_cache(maxsize=16384)
 def norm_text(s: str) -> str:
-    s = (s or "").upper().strip()
-    s = re.sub(r"\s+", " ", s)
-    return s
+    # split()/join — один проход на C: обрезает края и схлопывает те же пробельные символы, что и \s+
+    return " ".join((s or "").upper().split())
 
 
+@functools.lru_cache(maxsize=16384)
 def norm_spaces(s: str) -> str:
-    s = (s or "").strip()
-    s = re.sub(r"\s+", " ", s)
-    return s
+    return " ".join((s or "").split())
 
 
+@functools.lru_cache(maxsize=16384)
 def norm_category(s: str) -> str:
     """Normalize category name: trim, collapse spaces, title case"""
-    s = (s or "").strip()
-    s = re.sub(r"\s+", " ", s)
+    s = " ".join((s or "").split())
     if not s:
         return "Прочее"
     return s.title()
 
 
+# Даты в выписке сильно повторяются (много операций за один день), а страницы разбирают их
+# в нескольких проходах (фильтр, сортировка, отчёты) — результат кэшируется по строке
+@functools.lru_cache(maxsize=4096)
 def parse_date_ddmmyyyy(s: str) -> Optional[date]:
     if not s:
         return None
-    m = re.search(r"^(\d{1,2})\.(\d{1,2})\.(\d{4})$", s.strip())
-    if not m:
+    parts = s.strip().split(".")
+    if len(parts) != 3:
+        return None
+    dd, mm_, yyyy = parts
+    if not (0 < len(dd) <= 2 and 0 < len(mm_) <= 2 and len(yyyy) == 4):
+        return None
+    if not (dd.isdecimal() and mm_.isdecimal() and yyyy.isdecimal()):
         return None
-    dd, mm_, yyyy = m.groups()
     try:
         return date(int(yyyy), int(mm_), int(dd))
     except ValueError:
@@ -448,16 +601,33 @@ def month_from_date_str(date_str: str) -> str:
     return f"{d.month:02d}.{d.year}"
 
 
+_ZERO = Decimal("0")
+_Q01 = Decimal("0.01")
+
+
+def _as_decimal(x) -> Decimal:
+    """Decimal(str(x or 0)) без лишних преобразований: значения из базы уже Decimal."""
+    if isinstance(x, Decimal):
+        return x
+    if not x:
+        return _ZERO
+    return Decimal(str(x))
+
+
 def decimal_from_str(s) -> Decimal:
     if s is None:
-        return Decimal("0")
+        return _ZERO
+    if isinstance(s, Decimal):
+        return s
+    if type(s) is int:
+        return Decimal(s)
     s = str(s).replace("\xa0", "").replace(" ", "").replace(",", ".")
     if not s:
-        return Decimal("0")
+        return _ZERO
     try:
         return Decimal(s)
     except InvalidOperation:
-        return Decimal("0")
+        return _ZERO
 
 
 def money2(d: Decimal) -> Decimal:
@@ -467,18 +637,21 @@ def money2(d: Decimal) -> Decimal:
 def _group_thousands(num: str) -> str:
     if not num:
         return "0"
-    out = []
-    i = len(num)
-    while i > 0:
-        j = max(0, i - 3)
-        out.append(num[j:i])
-        i = j
-    return ".".join(reversed(out))
+    return format(int(num), ",").replace(",", ".")
+
+
+_FMT_QUANTS = {n: Decimal(1).scaleb(-n) for n in range(0, 7)}
 
 
 def fmt_num(value: Any, decimals: int = 2, strip_trailing_zeros: bool = False) -> str:
     if value is None:
         return ""
+    if type(value) is int:
+        sign = "-" if value < 0 else ""
+        int_part = format(abs(value), ",").replace(",", ".")
+        if decimals <= 0 or strip_trailing_zeros:
+            return sign + int_part
+        return sign + int_part + "," + "0" * decimals
     try:
         if isinstance(value, Decimal):
             d = value
@@ -492,7 +665,7 @@ def fmt_num(value: Any, decimals: int = 2, strip_trailing_zeros: bool = False) -
     sign = "-" if d < 0 else ""
     d = abs(d)
 
-    q = Decimal("1") if decimals <= 0 else Decimal("1." + ("0" * decimals))
+    q = _FMT_QUANTS.get(max(decimals, 0)) or Decimal("1." + ("0" * decimals))
     d = d.quantize(q, rounding=ROUND_HALF_UP)
 
     s = format(d, "f")
@@ -515,6 +688,8 @@ def fmt_num(value: Any, decimals: int = 2, strip_trailing_zeros: bool = False) -
 
 
 def fmt_money(value: Any) -> str:
+    """Сумма с копейками. В результате только цифры, точки, запятая и минус — в HTML его можно
+    вставлять без h(); в построчных циклах страниц так и делается."""
     return fmt_num(value, decimals=2, strip_trailing_zeros=False)
 
 
@@ -522,9 +697,16 @@ def fmt_int(value: Any) -> str:
     return fmt_num(value, decimals=0, strip_trailing_zeros=True)
 
 
+_lxml_warned = False
+
+
 def require_openpyxl():
+    global _lxml_warned
     if Workbook is None:
         raise RuntimeError("Нужен openpyxl: pip install openpyxl")
+    if not OPENPYXL_LXML and not _lxml_warned:
+        _lxml_warned = True
+        print("[openpyxl] lxml не установлен — используется ElementTree, XLSX обрабатываются заметно медленнее (pip install lxml)")
 
 
 def excel_autosize(ws, max_width: int = 60):
@@ -572,7 +754,7 @@ def register_ru_font() -> str:
 
 
 def safe_filename(name: str) -> str:
-    name = re.sub(r"[^0-9A-Za-zА-Яа-я_\-\. ]+", "_", name or "")
+    name = _SAFE_FN_RE.sub("_", name or "")
     name = name.strip().replace(" ", "_")
     return name or "file"
 
@@ -582,17 +764,46 @@ def redirect(location: str, start_response):
     return [b""]
 
 
-def read_body(environ) -> bytes:
+MAX_FORM_BODY = int(os.environ.get("MAX_FORM_BODY", str(10 * 1024 * 1024)))
+# Лимит на multipart-запрос с файлом (выписки, справочники, отчёты площадок)
+MAX_UPLOAD_BODY = int(os.environ.get("MAX_UPLOAD_BODY", str(100 * 1024 * 1024)))
+
+
+class RequestTooLarge(Exception):
+    """Тело запроса больше лимита; application отвечает на него 413, а не 500."""
+
+
+def _content_length(environ) -> int:
     try:
-        length = int(environ.get("CONTENT_LENGTH") or "0")
+        return int(environ.get("CONTENT_LENGTH") or "0")
     except Exception:
-        length = 0
-    return environ["wsgi.input"].read(length) if length > 0 else b""
+        return 0
+
+
+def read_body(environ) -> bytes:
+    length = _content_length(environ)
+    if length <= 0:
+        return b""
+    if length > MAX_FORM_BODY:
+        raise RequestTooLarge(f"Слишком большой запрос: {length} байт (лимит {MAX_FORM_BODY})")
+    stream = environ["wsgi.input"]
+    chunks = []
+    remaining = length
+    while remaining:
+        buf = stream.read(min(DOWNLOAD_CHUNK_SIZE, remaining))
+        if not buf:
+            break
+        chunks.append(buf)
+        remaining -= len(buf)
+    return b"".join(chunks)
 
 
 def parse_post_form(environ) -> Dict[str, Any]:
     ctype = (environ.get("CONTENT_TYPE") or "").lower()
     if "multipart/form-data" in ctype:
+        length = _content_length(environ)
+        if length > MAX_UPLOAD_BODY:
+            raise RequestTooLarge(f"Слишком большой файл: {length} байт (лимит {MAX_UPLOAD_BODY})")
         fs = cgi.FieldStorage(fp=environ["wsgi.input"], environ=environ, keep_blank_values=True)
         out: Dict[str, Any] = {}
         for k in fs.keys():
@@ -619,6 +830,26 @@ def get_upload(form: Dict[str, Any], key: str = "file") -> Any:
     return v
 
 
+def save_upload(item: Any, dest_path: str) -> int:
+    """Копирует загруженный файл на диск кусками, не читая его целиком в память. Возвращает размер.
+    Файл больше MAX_UPLOAD_BODY удаляется, а запрос завершается RequestTooLarge."""
+    src = getattr(item, "file", None)
+    if src is None:
+        return 0
+    size = 0
+    with open(dest_path, "wb") as f:
+        while buf := src.read(DOWNLOAD_CHUNK_SIZE):
+            size += len(buf)
+            if size > MAX_UPLOAD_BODY:
+                break
+            f.write(buf)
+    if not size or size > MAX_UPLOAD_BODY:
+        os.remove(dest_path)
+    if size > MAX_UPLOAD_BODY:
+        raise RequestTooLarge(f"Слишком большой файл (лимит {MAX_UPLOAD_BODY} байт)")
+    return size
+
+
 def qs(environ) -> Dict[str, str]:
     q = parse_qs(environ.get("QUERY_STRING", ""), keep_blank_values=True)
     return {k: (v[0] if v else "") for k, v in q.items()}
@@ -629,35 +860,105 @@ def not_found(start_response):
     return [b"<h1>404</h1>"]
 
 
-def serve_text(start_response, html: str, status: str = "200 OK"):
+GZIP_MIN_SIZE = 1024
+
+
+def serve_text(environ, start_response, html: str, status: str = "200 OK"):
     data = html.encode("utf-8")
-    start_response(status, [
+    headers = [
         ("Content-Type", "text/html; charset=utf-8"),
-        ("Content-Length", str(len(data))),
         ("Cache-Control", "no-cache, no-store, must-revalidate"),
-    ])
+        ("Vary", "Accept-Encoding"),
+    ]
+    if len(data) >= GZIP_MIN_SIZE and "gzip" in (environ.get("HTTP_ACCEPT_ENCODING") or "").lower():
+        data = gzip.compress(data, compresslevel=6)
+        headers.append(("Content-Encoding", "gzip"))
+    headers.append(("Content-Length", str(len(data))))
+    start_response(status, headers)
     return [data]
 
 
-def serve_file_download(start_response, file_path: str, content_type: str):
-    if not os.path.exists(file_path):
+def serve_stream(environ, start_response, chunks: Iterable[str], status: str = "200 OK"):
+    """Как serve_text, но страница уходит кусками по мере готовности (WSGI-итератор), без сборки целиком.
+    Первый кусок берётся до start_response: ошибка в запросах страницы ещё становится ответом 500."""
+    chunks = iter(chunks)
+    first = next(chunks, "")
+    gz = "gzip" in (environ.get("HTTP_ACCEPT_ENCODING") or "").lower()
+    headers = [
+        ("Content-Type", "text/html; charset=utf-8"),
+        ("Cache-Control", "no-cache, no-store, must-revalidate"),
+        ("Vary", "Accept-Encoding"),
+    ]
+    if gz:
+        headers.append(("Content-Encoding", "gzip"))
+    start_response(status, headers)
+    return _encode_chunks(itertools.chain((first,), chunks), gz)
+
+
+def _encode_chunks(chunks: Iterable[str], gz: bool) -> Iterator[bytes]:
+    # Z_SYNC_FLUSH после каждого куска: браузер получает его сразу, а не когда наберётся буфер сжатия
+    comp = zlib.compressobj(6, zlib.DEFLATED, 31) if gz else None
+    for chunk in chunks:
+        data = chunk.encode("utf-8")
+        if comp is not None:
+            data = comp.compress(data) + comp.flush(zlib.Z_SYNC_FLUSH)
+        if data:
+            yield data
+    if comp is not None:
+        yield comp.flush()
+
+
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+
+class _FileIter:
+    """Отдаёт файл кусками по DOWNLOAD_CHUNK_SIZE и закрывает его в close()."""
+
+    def __init__(self, filelike, block_size: int = DOWNLOAD_CHUNK_SIZE):
+        self.filelike = filelike
+        self.block_size = block_size
+
+    def __iter__(self):
+        return iter(lambda: self.filelike.read(self.block_size), b"")
+
+    def close(self):
+        self.filelike.close()
+
+
+def serve_file_download(environ, start_response, file_path: str, content_type: str):
+    if not os.path.isfile(file_path):
         return not_found(start_response)
-    with open(file_path, "rb") as f:
-        data = f.read()
+    size = os.path.getsize(file_path)
+    filelike = open(file_path, "rb")
     filename = os.path.basename(file_path)
-    headers = [("Content-Type", content_type), ("Content-Length", str(len(data)))]
+    headers = [("Content-Type", content_type), ("Content-Length", str(size))]
     headers.append(("Content-Disposition", f'attachment; filename="{filename}"'))
     start_response("200 OK", headers)
-    return [data]
+    file_wrapper = environ.get("wsgi.file_wrapper")
+    if file_wrapper:
+        return file_wrapper(filelike, DOWNLOAD_CHUNK_SIZE)
+    return _FileIter(filelike)
 
 
 _INN_RE = re.compile(r"(?:\bИНН\b[:\s]*)(\d{10}|\d{12})", re.IGNORECASE)
+# ИНН в начале строки: либо через разделитель ("7701234567, ООО ..."), либо слитно ("7701234567ООО ...")
+_INN_PREFIX_RE = re.compile(r"^\s*(\d{10}|\d{12})(?:\s*(?:[,;:\-–—]|\s)+\s*(.+)|([A-Za-zА-Яа-я\"«].+))$")
+_HAS_LETTER_RE = re.compile(r"[A-Za-zА-Яа-я]")
+_INN_BARE_RE = re.compile(r"\b(\d{10}|\d{12})\b")
+_INN_LABEL_RE = re.compile(r"\bИНН\b[:\s]*", re.IGNORECASE)
 
 def split_inn_from_name(name: str) -> Tuple[str, str]:
     s = (name or "").strip()
     if not s:
         return ("", "")
 
+    if not any(c.isdigit() for c in s):
+        # Без цифр ИНН быть не может — остаётся только чистка метки и пробелов
+        if "ИНН" in s.upper():
+            s = _INN_LABEL_RE.sub(" ", s)
+        s = _WS_RE.sub(" ", s).strip()
+        return (s.strip(" ,;:-–—"), "")
+
     inn = ""
 
     m = _INN_RE.search(s)
@@ -666,25 +967,19 @@ def split_inn_from_name(name: str) -> Tuple[str, str]:
         s = _INN_RE.sub(" ", s).strip()
 
     if not inn:
-        m2 = re.match(r"^\s*(\d{10}|\d{12})\s*([,;:\-–—]|\s)+\s*(.+)$", s)
+        m2 = _INN_PREFIX_RE.match(s)
         if m2:
             inn = m2.group(1)
-            s = (m2.group(3) or "").strip()
-
-    if not inn:
-        m3 = re.match(r"^\s*(\d{10}|\d{12})([A-Za-zА-Яа-я\"«].+)$", s)
-        if m3:
-            inn = m3.group(1)
-            s = (m3.group(2) or "").strip()
+            s = (m2.group(2) or m2.group(3) or "").strip()
 
-    if not inn and re.search(r"[A-Za-zА-Яа-я]", s):
-        m4 = re.search(r"\b(\d{10}|\d{12})\b", s)
+    if not inn and _HAS_LETTER_RE.search(s):
+        m4 = _INN_BARE_RE.search(s)
         if m4:
             inn = m4.group(1)
             s = re.sub(r"\b" + re.escape(inn) + r"\b", " ", s).strip()
 
-    s = re.sub(r"\bИНН\b[:\s]*", " ", s, flags=re.IGNORECASE)
-    s = re.sub(r"\s+", " ", s).strip()
+    s = _INN_LABEL_RE.sub(" ", s)
+    s = _WS_RE.sub(" ", s).strip()
     s = s.strip(" ,;:-–—")
 
     return (s, inn)
@@ -703,12 +998,15 @@ def load_counterparty_category_map(path: str) -> Dict[str, str]:
 
     if ext == ".xlsx":
         require_openpyxl()
-        wb = load_workbook(path, data_only=True)
-        ws = wb.active
-        for row in ws.iter_rows(min_row=2, values_only=True):
-            cat = row[0] if len(row) > 0 else ""
-            cp = row[1] if len(row) > 1 else ""
-            add_pair(str(cat or ""), str(cp or ""))
+        wb = load_workbook(path, read_only=True, data_only=True)
+        try:
+            ws = wb.active
+            for row in ws.iter_rows(min_row=2, values_only=True):
+                cat = row[0] if len(row) > 0 else ""
+                cp = row[1] if len(row) > 1 else ""
+                add_pair(str(cat or ""), str(cp or ""))
+        finally:
+            wb.close()
         return mapping
 
     if ext == ".csv":
@@ -730,88 +1028,352 @@ def load_counterparty_category_map(path: str) -> Dict[str, str]:
     raise ValueError("Поддерживаются только .xlsx или .csv")
 
 
+def json_dumps_text(obj: Any) -> str:
+    """JSON для хранения в TEXT-колонках (orjson, если установлен; UTF-8 без экранирования)."""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode("utf-8")
+    return json.dumps(obj, ensure_ascii=False)
+
+
+def load_json_field(raw: Any, default: Any) -> Any:
+    """Разбирает JSON-колонку; пустое или битое значение -> default."""
+    if not raw:
+        return default
+    try:
+        return orjson.loads(raw) if orjson is not None else json.loads(raw)
+    except Exception:
+        return default
+
+
+def _bulk_update_column(cur, table: str, column: str, pairs: List[Tuple[Any, Any]]):
+    """Один UPDATE ... FROM (VALUES ...) вместо отдельного UPDATE на каждую строку. pairs: [(id, value), ...]"""
+    if not pairs:
+        return
+    execute_values(cur, f"""
+        UPDATE {table} AS t SET {column} = v.value
+        FROM (VALUES %s) AS v(id, value)
+        WHERE t.id = v.id
+    """, pairs, template="(%s, %s)", page_size=2000)
+
+
+def _bulk_update_columns(cur, table: str, columns: Tuple[str, ...], rows: List[Tuple[Any, ...]]):
+    """Несколько колонок одним UPDATE ... FROM (VALUES ...): каждая строка переписывается один раз.
+    rows: [(id, value1, value2, ...)]; None оставляет колонку как есть."""
+    if not rows:
+        return
+    sets = ", ".join(f"{c} = COALESCE(v.{c}, t.{c})" for c in columns)
+    execute_values(cur, f"""
+        UPDATE {table} AS t SET {sets}
+        FROM (VALUES %s) AS v(id, {", ".join(columns)})
+        WHERE t.id = v.id
+    """, rows, template="(" + ", ".join(["%s"] * (len(columns) + 1)) + ")", page_size=2000)
+
+
+class RowView(Mapping):
+    """Строка выборки только для чтения: кортеж из курсора и общий на всю выборку индекс колонок.
+    Используется для больших кэшируемых списков (bank_rows, counterparties) вместо dict на строку."""
+    __slots__ = ("_t", "_idx")
+    
+    def __init__(self, t: Tuple, idx: Dict[str, int]):
+        self._t = t
+        self._idx = idx
+    
+    def __getitem__(self, key):
+        return self._t[self._idx[key]]
+    
+    def get(self, key, default=None):
+        i = self._idx.get(key)
+        return default if i is None else self._t[i]
+    
+    def __contains__(self, key):
+        return key in self._idx
+    
+    def __iter__(self):
+        return iter(self._idx)
+    
+    def __len__(self):
+        return len(self._idx)
+    
+    def __repr__(self):
+        return repr(dict(self))
+
+
+def _column_index(cur) -> Dict[str, int]:
+    return {d.name: i for i, d in enumerate(cur.description)}
+
+
+def _fetch_views(cur) -> List[RowView]:
+    rows = cur.fetchall()
+    if not rows:
+        return []
+    idx = _column_index(cur)
+    return [RowView(t, idx) for t in rows]
+
+
+def _fetch_dicts(cur) -> List[Dict[str, Any]]:
+    """Как RealDictCursor + dict(row), но без промежуточного RealDictRow на каждую строку."""
+    rows = cur.fetchall()
+    if not rows:
+        return []
+    cols = [d.name for d in cur.description]
+    return [dict(zip(cols, t)) for t in rows]
+
+
+BANK_ROW_INSERT_COLUMNS = ("id, date_str, month, incoming, outgoing, purpose, counterparty, "
+                           "doctype, skip_outgoing, category, cp_inn, cp_kpp, cp_account, cp_bank, cp_bik, cp_corr, op_date, search_text")
+# С этого размера пачки выписка грузится через COPY, а не execute_values
+BANK_COPY_THRESHOLD = 500
+
+BANK_ROW_COLUMNS = """id, date_str as date, month, incoming, outgoing, purpose, counterparty,
+    doctype, skip_outgoing, category, cp_inn, cp_kpp, cp_account, cp_bank, cp_bik, cp_corr"""
+
+# Поля, из которых собирается bank_rows.search_text: при их изменении строка поиска пересчитывается
+BANK_SEARCH_FIELDS = frozenset(("counterparty", "purpose", "category", "incoming", "outgoing"))
+
+# Сортировка страницы банка -> ORDER BY. Строки без даты идут как 01.01.1900; при равном ключе — новые загрузки сверху
+BANK_PAGE_ORDER = {
+    "date_asc": "COALESCE(op_date, DATE '1900-01-01') ASC, created_at DESC, id",
+    "date_desc": "COALESCE(op_date, DATE '1900-01-01') DESC, created_at DESC, id",
+    "amount_desc": "COALESCE(incoming, 0) + COALESCE(outgoing, 0) DESC, created_at DESC, id",
+    "amount_asc": "COALESCE(incoming, 0) + COALESCE(outgoing, 0) ASC, created_at DESC, id",
+}
+BANK_PAGE_DEFAULT_ORDER = "created_at DESC, id"
+
+# Текстовые колонки выписки с большим числом повторов: в кэше bank_rows каждое значение хранится один раз
+BANK_ROW_SHARED_COLUMNS = (
+    "date", "month", "counterparty", "doctype", "category",
+    "cp_inn", "cp_kpp", "cp_account", "cp_bank", "cp_bik", "cp_corr",
+)
+
+
+# Поля, которые можно менять через update_bank_row / update_cash_row: ключ словаря -> колонка таблицы
+BANK_ROW_UPDATABLE = {
+    "date": "date_str", "month": "month", "incoming": "incoming", "outgoing": "outgoing",
+    "purpose": "purpose", "counterparty": "counterparty", "doctype": "doctype",
+    "skip_outgoing": "skip_outgoing", "category": "category", "cp_inn": "cp_inn", "cp_kpp": "cp_kpp",
+    "cp_account": "cp_account", "cp_bank": "cp_bank", "cp_bik": "cp_bik", "cp_corr": "cp_corr",
+    "op_date": "op_date",
+}
+CASH_ROW_UPDATABLE = {"date": "date_str", "nomenclature": "nomenclature", "amount": "amount"}
+
+COUNTERPARTY_UPDATABLE = {c: c for c in (
+    "kind", "name", "inn", "kpp", "bank", "bik", "corr", "account", "legal_address", "phone",
+    "is_our_company", "full_name", "inspection_code", "oktmo", "okato", "signatory", "sfr_reg_number",
+    "pfr_reg_self", "pfr_reg_employees", "pfr_terr_code", "pfr_terr_organ", "payment_details",
+    "okpo", "okopf", "okfs", "okved1", "okved2", "okpo_rosstat",
+)}
+
+_UPDATE_STMT_CACHE: Dict[Tuple[str, Tuple[str, ...], str, bool], str] = {}
+
+
+def _update_statement(cur, table: str, columns: Tuple[str, ...], returning: str = "", only_changed: bool = False) -> str:
+    """UPDATE table SET col = %s, ... WHERE id = %s, собранный через psycopg2.sql один раз на набор колонок.
+    only_changed добавляет условие (col, ...) IS DISTINCT FROM (%s, ...): значения передаются второй раз после id."""
+    key = (table, columns, returning, only_changed)
+    stmt = _UPDATE_STMT_CACHE.get(key)
+    if stmt is None:
+        idents = [pgsql.Identifier(c) for c in columns]
+        query = pgsql.SQL("UPDATE {} SET {} WHERE id = %s").format(
+            pgsql.Identifier(table),
+            pgsql.SQL(", ").join(pgsql.SQL("{} = %s").format(i) for i in idents),
+        )
+        if only_changed:
+            query += pgsql.SQL(" AND ({}) IS DISTINCT FROM ({})").format(
+                pgsql.SQL(", ").join(idents),
+                pgsql.SQL(", ").join(pgsql.Placeholder() for _ in idents),
+            )
+        stmt = query.as_string(cur)
+        if returning:
+            stmt += f" RETURNING {returning}"
+        _UPDATE_STMT_CACHE[key] = stmt
+    return stmt
+
+
+def _same_bank_value(key: str, current: Any, new: Any) -> bool:
+    """Совпадает ли новое значение поля строки выписки с уже сохранённым (как его вернула бы база).
+    Значения из формы приходят строками или числами, поэтому суммы сравниваются как Decimal, остальное — как текст."""
+    if key in ("incoming", "outgoing"):
+        return current is not None and decimal_from_str(new) == decimal_from_str(current)
+    if key == "skip_outgoing":
+        return bool(current) == bool(new)
+    if current is None or new is None:
+        return current is new
+    return str(current) == str(new)
+
+
+def _update_columns(updates: Dict[str, Any], allowed: Dict[str, str]) -> Tuple[str, ...]:
+    unknown = [k for k in updates if k not in allowed]
+    if unknown:
+        raise ValueError(f"Недопустимые поля для обновления: {', '.join(map(str, unknown))}")
+    return tuple(allowed[k] for k in updates)
+
+
+# Поля акта, которые хранятся как JSON: ключ словаря, колонка, значение по умолчанию
+_ACT_JSON_FIELDS = (("lines", "lines_json", []), ("executor", "executor_json", {}), ("customer", "customer_json", {}))
+
+# Ключ pg_advisory_xact_lock, под которым импорты выписок создают карточки контрагентов
+CP_IMPORT_LOCK_KEY = 0x42414E4B
+
+# Колонки для выборок по id перечислены явно: у SELECT * подготовленный план ломается после ADD COLUMN
+COUNTERPARTY_COLUMNS = "id, " + ", ".join(COUNTERPARTY_UPDATABLE) + ", created_at"
+ACT_COLUMNS = ("id, doc_no, doc_date, executor_id, customer_id, direction, executor_json, customer_json, "
+               "basis, vat_mode, lines_json, created_at")
+PAYMENT_ORDER_COLUMNS = ("id, number, date_str, amount, amount_words, payer_json, receiver_json, purpose, "
+                         "pay_type, vid_op, ocher, source, created_at")
+EMPLOYEE_COLUMNS = ("id, name, inn, passport, passport_issued, bank, bik, corr, account, "
+                    "salary, advance, main_part, created_at")
+
+# Выборки одной строки по id: имя подготовленного оператора -> запрос с параметром $1
+LOOKUP_STATEMENTS = {
+    "get_bank_row": f"SELECT {BANK_ROW_COLUMNS} FROM bank_rows WHERE id = $1",
+    "get_cash_row": "SELECT id, date_str as date, nomenclature, amount FROM cash_payments WHERE id = $1",
+    "get_counterparty": f"SELECT {COUNTERPARTY_COLUMNS} FROM counterparties WHERE id = $1",
+    "get_act": f"SELECT {ACT_COLUMNS} FROM acts WHERE id = $1",
+    "get_payment_order": f"SELECT {PAYMENT_ORDER_COLUMNS} FROM payment_orders WHERE id = $1",
+    "get_employee": f"SELECT {EMPLOYEE_COLUMNS} FROM employees WHERE id = $1",
+}
+_LOOKUP_QUERIES = {name: query.replace("$1", "%s") for name, query in LOOKUP_STATEMENTS.items()}
+
+
+def _fetch_by_id(cur, name: str, row_id: Any):
+    """Одна строка по id: EXECUTE подготовленного оператора, если PG_PREPARE_LOOKUPS, иначе обычный SELECT.
+    Оператор готовится на соединении при первом вызове. Если PREPARE/EXECUTE не прошли (устаревший план после
+    миграции и т.п.), транзакция откатывается к точке сохранения, операторы соединения сбрасываются
+    (при следующем вызове готовятся заново), а строка берётся обычным SELECT."""
+    prepared = getattr(cur.connection, "prepared_lookups", None) if PG_PREPARE_LOOKUPS else None
+    if prepared is not None:
+        sql = f"SAVEPOINT lookup; EXECUTE {name}(%s)"
+        if name not in prepared:
+            sql = f"SAVEPOINT lookup; PREPARE {name} (text) AS {LOOKUP_STATEMENTS[name]}; EXECUTE {name}(%s)"
+        try:
+            cur.execute(sql, (row_id,))
+            prepared.add(name)
+            row = cur.fetchone()
+            cur.execute("RELEASE SAVEPOINT lookup")
+            return row
+        except psycopg2.Error:
+            cur.execute("ROLLBACK TO SAVEPOINT lookup; DEALLOCATE ALL")
+            prepared.clear()
+    cur.execute(_LOOKUP_QUERIES[name], (row_id,))
+    return cur.fetchone()
+
+
+def _copy_csv_field(v: Any) -> str:
+    """Поле для COPY ... WITH (FORMAT csv): None -> NULL (пустое без кавычек), строки всегда в кавычках."""
+    if v is None:
+        return ""
+    return '"' + str(v).replace('"', '""') + '"'
+
+
 class AccountingStateDB:
     def __init__(self):
         self._last_saved_at = ""
-        self._cache = {}
+        self._cache: Dict[str, Tuple[float, Any]] = {}
         self._cache_ttl = 30
-        self._cache_time = {}
+        self._cache_lock = threading.RLock()
+        self._versions: Dict[str, int] = {}
     
     def _get_cache(self, key):
-        if key in self._cache and key in self._cache_time:
-            if time.time() - self._cache_time[key] < self._cache_ttl:
-                return self._cache[key]
-        return None
+        with self._cache_lock:
+            entry = self._cache.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if time.monotonic() >= expires_at:
+                del self._cache[key]
+                return None
+            return value
     
-    def _set_cache(self, key, value):
-        self._cache[key] = value
-        self._cache_time[key] = time.time()
+    def _set_cache(self, key, value, ttl: Optional[float] = None):
+        with self._cache_lock:
+            self._cache[key] = (time.monotonic() + (self._cache_ttl if ttl is None else ttl), value)
     
     def _clear_cache(self, key=None):
-        if key:
-            self._cache.pop(key, None)
-            self._cache_time.pop(key, None)
-        else:
-            self._cache.clear()
-            self._cache_time.clear()
+        with self._cache_lock:
+            if key:
+                self._cache.pop(key, None)
+            else:
+                self._cache.clear()
+    
+    def _cache_version(self, key: str) -> int:
+        with self._cache_lock:
+            return self._versions.get(key, 0)
+    
+    def _get_versioned(self, key: str):
+        """Кэш вида (версия, данные): данные отдаются, только если версия таблицы не сдвинулась."""
+        with self._cache_lock:
+            entry = self._get_cache(key)
+            if entry is not None and entry[0] == self._versions.get(key, 0):
+                return entry[1]
+            return None
+    
+    def _set_versioned(self, key: str, version: int, value, ttl: Optional[float] = None):
+        """Сохраняет выборку, если за время запроса таблицу никто не поменял."""
+        with self._cache_lock:
+            if version == self._versions.get(key, 0):
+                self._set_cache(key, (version, value), ttl=ttl)
+    
+    def _bump_version(self, key: str, patch=None):
+        """Сдвигает версию таблицы после записи. patch(rows) -> новый список дописывает изменения
+        в актуальный кэш без повторной выборки; без patch (или если patch вернул None) кэш сбрасывается."""
+        with self._cache_lock:
+            old = self._versions.get(key, 0)
+            self._versions[key] = old + 1
+            entry = self._get_cache(key)
+            patched = patch(entry[1]) if patch is not None and entry is not None and entry[0] == old else None
+            if patched is not None:
+                self._set_cache(key, (old + 1, patched))
+            else:
+                self._cache.pop(key, None)
     
     @property
     def last_saved_at(self):
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute("SELECT value FROM settings WHERE key = 'last_saved_at'")
-        row = cur.fetchone()
-        cur.close()
-        return_db_connection(conn)
-        return row[0] if row else "—"
+        return self._load_settings().get("last_saved_at", "—")
     
     def save(self):
         now = datetime.now().strftime("%d.%m.%Y %H:%M:%S")
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute("""
-            INSERT INTO settings (key, value) VALUES ('last_saved_at', %s)
-            ON CONFLICT (key) DO UPDATE SET value = %s
-        """, (now, now))
-        conn.commit()
-        cur.close()
-        return_db_connection(conn)
+        with db_cursor() as cur:
+            cur.execute("""
+                INSERT INTO settings (key, value) VALUES ('last_saved_at', %s)
+                ON CONFLICT (key) DO UPDATE SET value = %s
+            """, (now, now))
+        self._bump_version("settings")
     
     @property
     def settings(self) -> Dict[str, Any]:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute("SELECT key, value FROM settings")
-        rows = cur.fetchall()
-        cur.close()
-        return_db_connection(conn)
         result = {"our_company_id": None}
-        for key, value in rows:
-            result[key] = value
+        result.update(self._load_settings())
+        return result
+    
+    def _load_settings(self) -> Dict[str, Any]:
+        """Настройки хранятся до записи (версия сдвигается после коммита), но не дольше 60 с."""
+        cached = self._get_versioned("settings")
+        if cached is not None:
+            return cached
+        version = self._cache_version("settings")
+        with db_cursor() as cur:
+            cur.execute("SELECT key, value FROM settings")
+            rows = cur.fetchall()
+        result = {key: value for key, value in rows}
+        self._set_versioned("settings", version, result, ttl=60)
         return result
     
     def set_setting(self, key: str, value: str):
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute("""
-            INSERT INTO settings (key, value) VALUES (%s, %s)
-            ON CONFLICT (key) DO UPDATE SET value = %s
-        """, (key, value, value))
-        conn.commit()
-        cur.close()
-        return_db_connection(conn)
+        with db_cursor() as cur:
+            cur.execute("""
+                INSERT INTO settings (key, value) VALUES (%s, %s)
+                ON CONFLICT (key) DO UPDATE SET value = %s
+            """, (key, value, value))
+        self._bump_version("settings")
     
     @property
     def cp_category_map(self) -> Dict[str, str]:
         cached = self._get_cache("cp_category_map")
         if cached is not None:
             return cached
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute("SELECT counterparty_key, category FROM cp_category_map")
-        rows = cur.fetchall()
-        cur.close()
-        return_db_connection(conn)
+        with db_cursor() as cur:
+            cur.execute("SELECT counterparty_key, category FROM cp_category_map")
+            rows = cur.fetchall()
         result = {row[0]: row[1] for row in rows}
         self._set_cache("cp_category_map", result)
         return result
@@ -819,26 +1381,19 @@ class AccountingStateDB:
     @cp_category_map.setter
     def cp_category_map(self, value: Dict[str, str]):
         self._clear_cache("cp_category_map")
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute("DELETE FROM cp_category_map")
-        for k, v in value.items():
-            cur.execute("""
-                INSERT INTO cp_category_map (counterparty_key, category) VALUES (%s, %s)
-            """, (k, v))
-        conn.commit()
-        cur.close()
-        return_db_connection(conn)
+        clear_category_rules()
+        with db_cursor() as cur:
+            cur.execute("DELETE FROM cp_category_map")
+            # Таблица только что очищена, ключи словаря уникальны — грузим через COPY без ON CONFLICT
+            buf = io.StringIO()
+            for key, category in value.items():
+                buf.write(_copy_csv_field(key) + "," + _copy_csv_field(category) + "\n")
+            buf.seek(0)
+            cur.copy_expert("COPY cp_category_map (counterparty_key, category) FROM STDIN WITH (FORMAT csv)", buf)
     
     @property
     def cp_map_source(self) -> str:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute("SELECT value FROM settings WHERE key = 'cp_map_source'")
-        row = cur.fetchone()
-        cur.close()
-        return_db_connection(conn)
-        return row[0] if row else ""
+        return self._load_settings().get("cp_map_source", "")
     
     @cp_map_source.setter
     def cp_map_source(self, value: str):
@@ -850,12 +1405,9 @@ class AccountingStateDB:
         cached = self._get_cache("user_category_map")
         if cached is not None:
             return cached
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute("SELECT counterparty_key, category FROM user_category_map ORDER BY id")
-        rows = cur.fetchall()
-        cur.close()
-        return_db_connection(conn)
+        with db_cursor() as cur:
+            cur.execute("SELECT counterparty_key, category FROM user_category_map ORDER BY id")
+            rows = cur.fetchall()
         result: Dict[str, List[str]] = {}
         for row in rows:
             key, cat = row[0], row[1]
@@ -869,35 +1421,28 @@ class AccountingStateDB:
     @user_category_map.setter
     def user_category_map(self, value: Dict[str, Any]):
         self._clear_cache("user_category_map")
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute("DELETE FROM user_category_map")
-        for k, v in value.items():
-            cats = v if isinstance(v, list) else [v]
-            for cat in cats:
-                cur.execute("""
-                    INSERT INTO user_category_map (counterparty_key, category) VALUES (%s, %s)
-                """, (k, cat))
-        conn.commit()
-        cur.close()
-        return_db_connection(conn)
+        clear_category_rules()
+        with db_cursor() as cur:
+            cur.execute("DELETE FROM user_category_map")
+            pairs = []
+            for k, v in value.items():
+                cats = v if isinstance(v, list) else [v]
+                for cat in cats:
+                    pairs.append((k, cat))
+            execute_values(cur, """
+                INSERT INTO user_category_map (counterparty_key, category) VALUES %s
+                ON CONFLICT DO NOTHING
+            """, pairs, page_size=1000)
     
     def add_user_category(self, cp_key: str, category: str):
         """Add a category for counterparty (allows multiple categories per counterparty)"""
         self._clear_cache("user_category_map")
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute("SELECT id FROM user_category_map WHERE counterparty_key = %s AND category = %s", (cp_key, category))
-        if cur.fetchone():
-            cur.close()
-            return_db_connection(conn)
-            return
-        cur.execute("""
-            INSERT INTO user_category_map (counterparty_key, category) VALUES (%s, %s)
-        """, (cp_key, category))
-        conn.commit()
-        cur.close()
-        return_db_connection(conn)
+        clear_category_rules()
+        with db_cursor() as cur:
+            cur.execute("""
+                INSERT INTO user_category_map (counterparty_key, category) VALUES (%s, %s)
+                ON CONFLICT DO NOTHING
+            """, (cp_key, category))
     
     def get_user_categories(self, cp_key: str) -> List[str]:
         """Get all categories for a counterparty"""
@@ -905,253 +1450,449 @@ class AccountingStateDB:
     
     def remove_user_category(self, cp_key: str, category: str):
         """Remove a category from counterparty"""
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute("DELETE FROM user_category_map WHERE counterparty_key = %s AND category = %s", (cp_key, category))
-        conn.commit()
-        cur.close()
-        return_db_connection(conn)
-        if cp_key in self.user_category_map:
-            self.user_category_map[cp_key] = [c for c in self.user_category_map[cp_key] if c != category]
-            if not self.user_category_map[cp_key]:
-                del self.user_category_map[cp_key]
+        self._clear_cache("user_category_map")
+        clear_category_rules()
+        with db_cursor() as cur:
+            cur.execute("DELETE FROM user_category_map WHERE counterparty_key = %s AND category = %s", (cp_key, category))
     
     @property
     def bank_rows(self) -> List[Dict[str, Any]]:
-        cached = self._get_cache("bank_rows")
+        cached = self._get_versioned("bank_rows")
         if cached is not None:
             return cached
-        conn = get_db_connection()
-        cur = conn.cursor(cursor_factory=RealDictCursor)
-        cur.execute("""
-            SELECT id, date_str as date, month, incoming, outgoing, purpose, counterparty,
-                   doctype, skip_outgoing, category, cp_inn, cp_kpp, cp_account, cp_bank, cp_bik, cp_corr
-            FROM bank_rows ORDER BY created_at DESC
-        """)
-        rows = cur.fetchall()
-        cur.close()
-        return_db_connection(conn)
-        result = [dict(row) for row in rows]
-        self._set_cache("bank_rows", result)
+        version = self._cache_version("bank_rows")
+        result = list(self.iter_bank_rows())
+        self._set_versioned("bank_rows", version, result)
         return result
     
-    def add_bank_row(self, r: Dict[str, Any]):
-        self._clear_cache("bank_rows")
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute("""
-            INSERT INTO bank_rows (id, date_str, month, incoming, outgoing, purpose, counterparty,
-                                   doctype, skip_outgoing, category, cp_inn, cp_kpp, cp_account, cp_bank, cp_bik, cp_corr)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-            ON CONFLICT (id) DO NOTHING
-        """, (
+    @staticmethod
+    def _iter_query(sql: str, params: Tuple = (), batch: int = 500, view: bool = False,
+                    shared: Tuple[str, ...] = ()):
+        """Строки запроса через серверный курсор: пачками по batch, без fetchall() всей таблицы.
+        view=True отдаёт RowView вместо dict. Одинаковые значения колонок из shared
+        хранятся одним объектом на всю выборку (месяц, тип документа, реквизиты контрагента)."""
+        with db_cursor(name=f"stream_{uuid.uuid4().hex[:8]}") as cur:
+            cur.itersize = batch
+            cur.execute(sql, params)
+            idx = cols = None
+            dedup: List[Tuple[int, Dict[Any, Any]]] = []
+            for t in cur:
+                if idx is None:
+                    # у серверного курсора description появляется после первой пачки
+                    idx = _column_index(cur)
+                    cols = list(idx)
+                    dedup = [(idx[c], {}) for c in shared if c in idx]
+                if dedup:
+                    t = list(t)
+                    for i, seen in dedup:
+                        v = t[i]
+                        t[i] = seen.setdefault(v, v)
+                    t = tuple(t)
+                yield RowView(t, idx) if view else dict(zip(cols, t))
+    
+    def iter_bank_rows(self, batch: int = 1000):
+        return self._iter_query(f"SELECT {BANK_ROW_COLUMNS} FROM bank_rows ORDER BY created_at DESC",
+                                batch=batch, view=True, shared=BANK_ROW_SHARED_COLUMNS)
+    
+    @staticmethod
+    def _bank_row_params(r: Dict[str, Any]) -> Tuple:
+        return (
             r.get("id"), r.get("date"), r.get("month"),
-            str(decimal_from_str(r.get("incoming") or 0)), str(decimal_from_str(r.get("outgoing") or 0)),
+            decimal_from_str(r.get("incoming") or _ZERO), decimal_from_str(r.get("outgoing") or _ZERO),
             r.get("purpose"), r.get("counterparty"), r.get("doctype"),
             bool(r.get("skip_outgoing")), r.get("category"),
             r.get("cp_inn"), r.get("cp_kpp"), r.get("cp_account"),
-            r.get("cp_bank"), r.get("cp_bik"), r.get("cp_corr")
-        ))
-        conn.commit()
-        cur.close()
-        return_db_connection(conn)
+            r.get("cp_bank"), r.get("cp_bik"), r.get("cp_corr"),
+            parse_date_ddmmyyyy(r.get("date") or ""),
+            bank_search_text(r.get("counterparty"), r.get("purpose"), r.get("category"),
+                             r.get("incoming"), r.get("outgoing")),
+        )
+
+    def add_bank_row(self, r: Dict[str, Any]):
+        self.add_bank_rows([r])
+
+    def add_bank_rows(self, rows: List[Dict[str, Any]]):
+        """Bulk insert of imported bank rows: execute_values for small batches, COPY for large statements"""
+        if not rows:
+            return
+        with db_cursor() as cur:
+            if len(rows) >= BANK_COPY_THRESHOLD:
+                inserted = self._copy_bank_rows(cur, rows)
+            else:
+                inserted = execute_values(cur, f"""
+                    INSERT INTO bank_rows ({BANK_ROW_INSERT_COLUMNS})
+                    VALUES %s
+                    ON CONFLICT (id) DO NOTHING
+                    RETURNING {BANK_ROW_COLUMNS}
+                """, [self._bank_row_params(r) for r in rows], page_size=1000, fetch=True)
+            idx = _column_index(cur) if inserted else {}
+        new_rows = [RowView(t, idx) for t in inserted]
+        
+        def prepend(cached):
+            # Все строки одной вставки имеют одинаковый created_at, поэтому встают в начало списка
+            known = {r.get("id") for r in cached}
+            return [r for r in new_rows if r.get("id") not in known] + cached
+        
+        self._bump_version("bank_rows", prepend if new_rows else None)
+    
+    @classmethod
+    def _copy_bank_rows(cls, cur, rows: List[Dict[str, Any]]) -> List[Tuple]:
+        """COPY во временную таблицу и перенос в bank_rows с ON CONFLICT (id) DO NOTHING —
+        та же семантика, что у execute_values, но основной объём идёт одним потоком COPY."""
+        cur.execute(f"CREATE TEMP TABLE bank_rows_tmp ON COMMIT DROP AS SELECT {BANK_ROW_INSERT_COLUMNS} FROM bank_rows WITH NO DATA")
+        buf = io.StringIO()
+        for r in rows:
+            buf.write(",".join(_copy_csv_field(v) for v in cls._bank_row_params(r)) + "\n")
+        buf.seek(0)
+        cur.copy_expert(f"COPY bank_rows_tmp ({BANK_ROW_INSERT_COLUMNS}) FROM STDIN WITH (FORMAT csv)", buf)
+        cur.execute(f"""
+            INSERT INTO bank_rows ({BANK_ROW_INSERT_COLUMNS})
+            SELECT {BANK_ROW_INSERT_COLUMNS} FROM bank_rows_tmp
+            ON CONFLICT (id) DO NOTHING
+            RETURNING {BANK_ROW_COLUMNS}
+        """)
+        return cur.fetchall()
     
     def update_bank_row(self, rid: str, updates: Dict[str, Any]):
         if not updates:
             return
-        self._clear_cache("bank_rows")
-        conn = get_db_connection()
-        cur = conn.cursor()
-        
-        set_parts = []
-        values = []
-        for k, v in updates.items():
-            if k == "date":
-                set_parts.append("date_str = %s")
-            elif k == "skip_outgoing":
-                set_parts.append("skip_outgoing = %s")
-                v = bool(v)
-            else:
-                set_parts.append(f"{k} = %s")
-            values.append(v)
-        
-        values.append(rid)
-        cur.execute(f"UPDATE bank_rows SET {', '.join(set_parts)} WHERE id = %s", values)
-        conn.commit()
-        cur.close()
-        return_db_connection(conn)
+        current = self._cached_bank_row(rid)
+        if current is not None and all(k in current and _same_bank_value(k, current[k], v) for k, v in updates.items()):
+            return
+        if "date" in updates:
+            # op_date — разобранная дата для фильтра и сортировки страницы банка в базе
+            updates = dict(updates, op_date=parse_date_ddmmyyyy(updates["date"] or ""))
+        columns = _update_columns(updates, BANK_ROW_UPDATABLE)
+        values = [bool(v) if k == "skip_outgoing" else v for k, v in updates.items()]
+        with db_cursor() as cur:
+            cur.execute(_update_statement(cur, "bank_rows", columns, BANK_ROW_COLUMNS, only_changed=True), values + [rid] + values)
+            returned = _fetch_views(cur)
+            if returned and BANK_SEARCH_FIELDS.intersection(updates):
+                row = returned[0]
+                cur.execute("UPDATE bank_rows SET search_text = %s WHERE id = %s", (bank_search_text(
+                    row.get("counterparty"), row.get("purpose"), row.get("category"),
+                    row.get("incoming"), row.get("outgoing")), rid))
+        if not returned:
+            return
+        updated = returned[0]
+        self._bump_version("bank_rows", lambda cached: [updated if r.get("id") == rid else r for r in cached])
+    
+    def _cached_bank_row(self, rid: str) -> Optional[Dict[str, Any]]:
+        """Строка из актуального кэша bank_rows (без запроса к базе); None, если кэша нет или строки в нём нет."""
+        by_id = self._id_index("bank_rows")
+        return by_id.get(rid) if by_id is not None else None
     
     def get_bank_row(self, rid: str) -> Optional[Dict[str, Any]]:
-        conn = get_db_connection()
-        cur = conn.cursor(cursor_factory=RealDictCursor)
-        cur.execute("""
-            SELECT id, date_str as date, month, incoming, outgoing, purpose, counterparty,
-                   doctype, skip_outgoing, category, cp_inn, cp_kpp, cp_account, cp_bank, cp_bik, cp_corr
-            FROM bank_rows WHERE id = %s
-        """, (rid,))
-        row = cur.fetchone()
-        cur.close()
-        return_db_connection(conn)
+        cached = self._cached_bank_row(rid)
+        if cached is not None:
+            return dict(cached)
+        with db_cursor(dict_cursor=True) as cur:
+            row = _fetch_by_id(cur, "get_bank_row", rid)
         return dict(row) if row else None
     
     @property
     def cash_rows(self) -> List[Dict[str, Any]]:
-        conn = get_db_connection()
-        cur = conn.cursor(cursor_factory=RealDictCursor)
-        cur.execute("""
-            SELECT id, date_str as date, nomenclature, amount
-            FROM cash_payments ORDER BY date_str DESC, created_at DESC
-        """)
-        rows = cur.fetchall()
-        cur.close()
-        return_db_connection(conn)
-        return [dict(row) for row in rows]
+        with db_cursor() as cur:
+            cur.execute("""
+                SELECT id, date_str as date, nomenclature, amount
+                FROM cash_payments ORDER BY date_str DESC, created_at DESC
+            """)
+            return _fetch_dicts(cur)
     
     def add_cash_row(self, r: Dict[str, Any]):
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute("""
-            INSERT INTO cash_payments (id, date_str, nomenclature, amount)
-            VALUES (%s, %s, %s, %s)
-            ON CONFLICT (id) DO NOTHING
-        """, (
-            r.get("id"), r.get("date"), r.get("nomenclature"),
-            str(decimal_from_str(r.get("amount") or 0))
-        ))
-        conn.commit()
-        cur.close()
-        return_db_connection(conn)
+        self.add_cash_rows([r])
+    
+    def add_cash_rows(self, rows: List[Dict[str, Any]]):
+        if not rows:
+            return
+        with db_cursor() as cur:
+            execute_values(cur, """
+                INSERT INTO cash_payments (id, date_str, nomenclature, amount)
+                VALUES %s
+                ON CONFLICT (id) DO NOTHING
+            """, [(
+                r.get("id"), r.get("date"), r.get("nomenclature"),
+                decimal_from_str(r.get("amount") or _ZERO)
+            ) for r in rows], page_size=1000)
     
     def update_cash_row(self, rid: str, updates: Dict[str, Any]):
         if not updates:
             return
-        conn = get_db_connection()
-        cur = conn.cursor()
-        set_parts = []
-        values = []
-        for k, v in updates.items():
-            if k == "date":
-                set_parts.append("date_str = %s")
-            else:
-                set_parts.append(f"{k} = %s")
-            values.append(v)
-        values.append(rid)
-        cur.execute(f"UPDATE cash_payments SET {', '.join(set_parts)} WHERE id = %s", values)
-        conn.commit()
-        cur.close()
-        return_db_connection(conn)
+        columns = _update_columns(updates, CASH_ROW_UPDATABLE)
+        values = list(updates.values())
+        with db_cursor() as cur:
+            cur.execute(_update_statement(cur, "cash_payments", columns, only_changed=True), values + [rid] + values)
     
     def delete_cash_row(self, rid: str):
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute("DELETE FROM cash_payments WHERE id = %s", (rid,))
-        conn.commit()
-        cur.close()
-        return_db_connection(conn)
+        with db_cursor() as cur:
+            cur.execute("DELETE FROM cash_payments WHERE id = %s", (rid,))
     
     def get_cash_row(self, rid: str) -> Optional[Dict[str, Any]]:
-        conn = get_db_connection()
-        cur = conn.cursor(cursor_factory=RealDictCursor)
-        cur.execute("""
-            SELECT id, date_str as date, nomenclature, amount
-            FROM cash_payments WHERE id = %s
-        """, (rid,))
-        row = cur.fetchone()
-        cur.close()
-        return_db_connection(conn)
+        with db_cursor(dict_cursor=True) as cur:
+            row = _fetch_by_id(cur, "get_cash_row", rid)
         return dict(row) if row else None
     
+    @property
+    def marketplace_rows(self) -> List[Dict[str, Any]]:
+        cached = self._get_versioned("marketplace_rows")
+        if cached is not None:
+            return cached
+        version = self._cache_version("marketplace_rows")
+        with db_cursor() as cur:
+            # Только то, что выводится в таблице; строки — кортежи с общим индексом колонок (RowView)
+            cur.execute("""
+                SELECT id, platform, period_label, date_start, date_end, amount
+                FROM marketplace_rows ORDER BY year DESC, quarter DESC, month DESC, created_at DESC
+            """)
+            result = _fetch_views(cur)
+        self._set_versioned("marketplace_rows", version, result)
+        return result
+    
+    def add_marketplace_row(self, r: Dict[str, Any]):
+        with db_cursor() as cur:
+            cur.execute("""
+                INSERT INTO marketplace_rows (id, platform, period_type, period_label, year, quarter, month, date_start, date_end, amount)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+            """, (r.get("id"), r.get("platform"), r.get("period_type"), r.get("period_label"), r.get("year"),
+                  r.get("quarter"), r.get("month"), r.get("date_start"), r.get("date_end"), r.get("amount")))
+        # Порядок зависит от периода и created_at, проставленного базой, — список проще перечитать
+        self._bump_version("marketplace_rows")
+    
+    def delete_marketplace_row(self, rid: str):
+        with db_cursor() as cur:
+            cur.execute("DELETE FROM marketplace_rows WHERE id = %s", (rid,))
+        self._bump_version("marketplace_rows", lambda cached: [r for r in cached if r.get("id") != rid])
+    
     @property
     def counterparties(self) -> List[Dict[str, Any]]:
-        cached = self._get_cache("counterparties")
+        cached = self._get_versioned("counterparties")
         if cached is not None:
             return cached
-        conn = get_db_connection()
-        cur = conn.cursor(cursor_factory=RealDictCursor)
-        cur.execute("SELECT * FROM counterparties ORDER BY name")
-        rows = cur.fetchall()
-        cur.close()
-        return_db_connection(conn)
-        result = [dict(row) for row in rows]
-        self._set_cache("counterparties", result)
+        version = self._cache_version("counterparties")
+        with db_cursor() as cur:
+            cur.execute("SELECT * FROM counterparties ORDER BY name")
+            result = _fetch_views(cur)
+        self._set_versioned("counterparties", version, result)
         return result
     
     def add_counterparty(self, c: Dict[str, Any]):
-        self._clear_cache("counterparties")
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute("""
-            INSERT INTO counterparties (id, kind, name, inn, kpp, bank, bik, corr, account, legal_address, phone,
-                is_our_company, full_name, inspection_code, oktmo, okato, signatory, sfr_reg_number,
-                pfr_reg_self, pfr_reg_employees, pfr_terr_code, pfr_terr_organ, payment_details,
-                okpo, okopf, okfs, okved1, okved2, okpo_rosstat)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-            ON CONFLICT (id) DO NOTHING
-        """, (
-            c.get("id"), c.get("kind"), c.get("name"), c.get("inn"), c.get("kpp"),
-            c.get("bank"), c.get("bik"), c.get("corr"), c.get("account"),
-            c.get("legal_address"), c.get("phone"),
-            c.get("is_our_company", False), c.get("full_name"), c.get("inspection_code"),
-            c.get("oktmo"), c.get("okato"), c.get("signatory"), c.get("sfr_reg_number"),
-            c.get("pfr_reg_self"), c.get("pfr_reg_employees"), c.get("pfr_terr_code"),
-            c.get("pfr_terr_organ"), c.get("payment_details"), c.get("okpo"), c.get("okopf"),
-            c.get("okfs"), c.get("okved1"), c.get("okved2"), c.get("okpo_rosstat")
-        ))
-        conn.commit()
-        cur.close()
-        return_db_connection(conn)
+        self.add_counterparties([c])
     
-    def update_counterparty(self, cid: str, c: Dict[str, Any]):
-        self._clear_cache("counterparties")
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute("""
-            UPDATE counterparties SET kind=%s, name=%s, inn=%s, kpp=%s, bank=%s, bik=%s,
-                   corr=%s, account=%s, legal_address=%s, phone=%s,
-                   is_our_company=%s, full_name=%s, inspection_code=%s, oktmo=%s, okato=%s,
-                   signatory=%s, sfr_reg_number=%s, pfr_reg_self=%s, pfr_reg_employees=%s,
-                   pfr_terr_code=%s, pfr_terr_organ=%s, payment_details=%s,
-                   okpo=%s, okopf=%s, okfs=%s, okved1=%s, okved2=%s, okpo_rosstat=%s
-            WHERE id = %s
-        """, (
-            c.get("kind"), c.get("name"), c.get("inn"), c.get("kpp"),
-            c.get("bank"), c.get("bik"), c.get("corr"), c.get("account"),
-            c.get("legal_address"), c.get("phone"),
-            c.get("is_our_company", False), c.get("full_name"), c.get("inspection_code"),
-            c.get("oktmo"), c.get("okato"), c.get("signatory"), c.get("sfr_reg_number"),
-            c.get("pfr_reg_self"), c.get("pfr_reg_employees"), c.get("pfr_terr_code"),
-            c.get("pfr_terr_organ"), c.get("payment_details"), c.get("okpo"), c.get("okopf"),
-            c.get("okfs"), c.get("okved1"), c.get("okved2"), c.get("okpo_rosstat"), cid
-        ))
-        conn.commit()
-        cur.close()
-        return_db_connection(conn)
+    def add_counterparties(self, items: List[Dict[str, Any]]):
+        if not items:
+            return
+        with db_cursor() as cur:
+            execute_values(cur, """
+                INSERT INTO counterparties (id, kind, name, inn, kpp, bank, bik, corr, account, legal_address, phone,
+                    is_our_company, full_name, inspection_code, oktmo, okato, signatory, sfr_reg_number,
+                    pfr_reg_self, pfr_reg_employees, pfr_terr_code, pfr_terr_organ, payment_details,
+                    okpo, okopf, okfs, okved1, okved2, okpo_rosstat)
+                VALUES %s
+                ON CONFLICT (id) DO NOTHING
+            """, [(
+                c.get("id"), c.get("kind"), c.get("name"), c.get("inn"), c.get("kpp"),
+                c.get("bank"), c.get("bik"), c.get("corr"), c.get("account"),
+                c.get("legal_address"), c.get("phone"),
+                c.get("is_our_company", False), c.get("full_name"), c.get("inspection_code"),
+                c.get("oktmo"), c.get("okato"), c.get("signatory"), c.get("sfr_reg_number"),
+                c.get("pfr_reg_self"), c.get("pfr_reg_employees"), c.get("pfr_terr_code"),
+                c.get("pfr_terr_organ"), c.get("payment_details"), c.get("okpo"), c.get("okopf"),
+                c.get("okfs"), c.get("okved1"), c.get("okved2"), c.get("okpo_rosstat")
+            ) for c in items], page_size=1000)
+        # Порядок ORDER BY name задаёт collation базы, поэтому новые записи не вклеиваем, а перечитываем список
+        self._bump_version("counterparties")
+    
+    def add_counterparties_if_absent(self, items: List[Dict[str, Any]]) -> int:
+        """Пакетно создаёт карточки из выписки одним INSERT. Карточка пропускается, если контрагент с тем же
+        norm_text(имени) уже есть в базе или встретился раньше в этой же пачке. Сверка и вставка идут под
+        pg_advisory_xact_lock, поэтому два параллельных импорта не создадут двух карточек с одним именем."""
+        if not items:
+            return 0
+        with db_cursor() as cur:
+            cur.execute("SELECT pg_advisory_xact_lock(%s)", (CP_IMPORT_LOCK_KEY,))
+            cur.execute("SELECT name FROM counterparties")
+            seen = {norm_text(row[0]) for row in cur.fetchall()}
+            fresh = []
+            for c in items:
+                key = norm_text(c.get("name") or "")
+                if key not in seen:
+                    seen.add(key)
+                    fresh.append(c)
+            inserted = execute_values(cur, """
+                INSERT INTO counterparties (id, kind, name, inn, kpp, bank, bik, corr, account, legal_address, phone)
+                VALUES %s
+                ON CONFLICT (id) DO NOTHING
+                RETURNING id
+            """, [(
+                c.get("id"), c.get("kind"), c.get("name"), c.get("inn"), c.get("kpp"),
+                c.get("bank"), c.get("bik"), c.get("corr"), c.get("account"),
+                c.get("legal_address"), c.get("phone")
+            ) for c in fresh], page_size=1000, fetch=True) if fresh else []
+        if inserted:
+            self._bump_version("counterparties")
+        return len(inserted)
+    
+    def update_counterparty(self, cid: str, updates: Dict[str, Any]):
+        """Обновляет только переданные поля карточки. Если значения не изменились, строка не переписывается."""
+        if not updates:
+            return
+        columns = _update_columns(updates, COUNTERPARTY_UPDATABLE)
+        values = [bool(v) if k == "is_our_company" else v for k, v in updates.items()]
+        with db_cursor() as cur:
+            cur.execute(_update_statement(cur, "counterparties", columns, "*", only_changed=True), values + [cid] + values)
+            returned = _fetch_views(cur)
+        if not returned:
+            return
+        updated = returned[0]
+        
+        def replace(cached):
+            old = next((x for x in cached if x.get("id") == cid), None)
+            if old is None or old.get("name") != updated.get("name"):
+                return None  # имя поменялось: позиция в сортировке по name могла сдвинуться
+            return [updated if x.get("id") == cid else x for x in cached]
+        
+        self._bump_version("counterparties", replace)
     
     def delete_counterparty(self, cid: str):
-        self._clear_cache("counterparties")
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute("DELETE FROM counterparties WHERE id = %s", (cid,))
-        conn.commit()
-        cur.close()
-        return_db_connection(conn)
+        with db_cursor() as cur:
+            cur.execute("DELETE FROM counterparties WHERE id = %s", (cid,))
+        self._bump_version("counterparties", lambda cached: [x for x in cached if x.get("id") != cid])
     
     def get_counterparty_by_id(self, cid: str) -> Optional[Dict[str, Any]]:
-        conn = get_db_connection()
-        cur = conn.cursor(cursor_factory=RealDictCursor)
-        cur.execute("SELECT * FROM counterparties WHERE id = %s", (cid,))
-        row = cur.fetchone()
-        cur.close()
-        return_db_connection(conn)
+        by_id = self._id_index("counterparties")
+        cached = by_id.get(cid) if by_id is not None else None
+        if cached is not None:
+            return dict(cached)
+        with db_cursor(dict_cursor=True) as cur:
+            row = _fetch_by_id(cur, "get_counterparty", cid)
         return dict(row) if row else None
     
-    def find_counterparty_by_name(self, name: str) -> Optional[Dict[str, Any]]:
+    def _id_index(self, key: str) -> Optional[Dict[str, Any]]:
+        """id -> строка для актуального кэша key (bank_rows, counterparties). Пересобирается, когда список
+        в кэше сменился; None, если кэш не прогрет — тогда одиночные выборки идут в базу, а не грузят всю таблицу."""
+        rows = self._get_versioned(key)
+        if rows is None:
+            return None
+        cached = self._get_cache(key + "_by_id")
+        if cached is not None and cached[0] is rows:
+            return cached[1]
+        by_id = {r.get("id"): r for r in rows}
+        self._set_cache(key + "_by_id", (rows, by_id))
+        return by_id
+    
+    def bank_page(self, date_from: Optional[date], date_to: Optional[date], search: str, sort_mode: str,
+                  page: int, per_page: int) -> Tuple[List[RowView], int, int, List[RowView]]:
+        """Страница выписки: фильтр по датам и поиску, сортировка и LIMIT/OFFSET выполняются в базе.
+        Строки без разборчивой даты проходят фильтр по датам, как и раньше.
+        Возвращает (строки страницы, номер страницы, всего обычных строк, все спорные строки)."""
+        where = []
+        params: List[Any] = []
+        if date_from:
+            where.append("(op_date IS NULL OR op_date >= %s)")
+            params.append(date_from)
+        if date_to:
+            where.append("(op_date IS NULL OR op_date <= %s)")
+            params.append(date_to)
+        if search:
+            where.append("strpos(search_text, %s) > 0")
+            params.append(norm_text(search))
+        cond = " AND ".join(where) or "TRUE"
+        order = BANK_PAGE_ORDER.get(sort_mode, BANK_PAGE_DEFAULT_ORDER)
+        with db_cursor() as cur:
+            cur.execute(f"""
+                SELECT {BANK_ROW_COLUMNS} FROM bank_rows
+                WHERE {cond} AND category = 'СПОРНАЯ' ORDER BY {order}
+            """, params)
+            disputed = _fetch_views(cur)
+            # Обычные строки: страница и их общее число за один проход (total_rows — последняя колонка)
+            page_sql = f"""
+                SELECT {BANK_ROW_COLUMNS}, count(*) OVER () AS total_rows FROM bank_rows
+                WHERE {cond} AND category IS DISTINCT FROM 'СПОРНАЯ' ORDER BY {order}
+                LIMIT %s OFFSET %s
+            """
+            cur.execute(page_sql, params + [per_page, (page - 1) * per_page])
+            fetched = cur.fetchall()
+            if fetched:
+                total = fetched[0][-1]
+            else:
+                # Пусто: либо строк нет совсем, либо номер страницы больше последней
+                cur.execute(f"SELECT count(*) FROM bank_rows WHERE {cond} AND category IS DISTINCT FROM 'СПОРНАЯ'", params)
+                total = cur.fetchone()[0]
+                last_page = max(1, (total + per_page - 1) // per_page)
+                if page > last_page:
+                    page = last_page
+                if total:
+                    cur.execute(page_sql, params + [per_page, (page - 1) * per_page])
+                    fetched = cur.fetchall()
+            idx = _column_index(cur)
+            idx.pop("total_rows", None)
+        return [RowView(t[:-1], idx) for t in fetched], page, total, disputed
+    
+    def render_memo(self, key: str, source: Any, build):
+        """Результат build(), посчитанный по кэшированному списку source. Кэшированные списки не меняются
+        на месте (запись даёт новый список), поэтому build() повторяется, только когда сменился сам список."""
+        cached = self._get_cache(key)
+        if cached is not None and cached[0] is source:
+            return cached[1]
+        value = build()
+        self._set_cache(key, (source, value))
+        return value
+    
+    def bank_categories(self) -> Tuple[str, ...]:
+        """Статьи, встречающиеся в выписке. Хранится до следующего изменения bank_rows (по версии таблицы)."""
+        version = self._cache_version("bank_rows")
+        cached = self._get_cache("bank_categories")
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        with db_cursor() as cur:
+            cur.execute("SELECT DISTINCT category FROM bank_rows WHERE category IS NOT NULL ORDER BY category")
+            cats = tuple(c for (c,) in cur.fetchall())
+        self._set_cache("bank_categories", (version, cats))
+        return cats
+    
+    def category_datalist(self, include_user: bool = False) -> str:
+        """Готовые <option> подсказок статей. Пересобираются, только когда сдвинулась версия bank_rows
+        или перечитан user_category_map (include_user=True добавляет статьи, заведённые для контрагентов)."""
+        key = "category_datalist_user" if include_user else "category_datalist"
+        version = self._cache_version("bank_rows")
+        user_map = self.user_category_map if include_user else None
+        cached = self._get_cache(key)
+        if cached is not None and cached[0] == version and cached[1] is user_map:
+            return cached[2]
+        user_cats = tuple(itertools.chain.from_iterable(user_map.values())) if user_map else ()
+        html = category_datalist_html(self.bank_categories(), user_cats)
+        self._set_cache(key, (version, user_map, html))
+        return html
+    
+    def _cp_name_index(self) -> Tuple[Dict[str, Dict[str, Any]], List[Tuple[str, Dict[str, Any]]]]:
+        """Индекс нормализованных имён контрагентов. Пересобирается, когда кэш counterparties обновился."""
+        cps = self.counterparties
+        cached = self._get_cache("cp_name_index")
+        if cached is not None and cached[0] is cps:
+            return cached[1], cached[2]
+        by_name: Dict[str, Dict[str, Any]] = {}
+        pairs: List[Tuple[str, Dict[str, Any]]] = []
+        for c in cps:
+            cn = norm_text(c.get("name", ""))
+            by_name.setdefault(cn, c)
+            pairs.append((cn, c))
+        self._set_cache("cp_name_index", (cps, by_name, pairs))
+        return by_name, pairs
+    
+    def find_counterparty_by_name(self, name: str, extra: Optional[List[Dict[str, Any]]] = None) -> Optional[Dict[str, Any]]:
         n = norm_text(name)
-        for c in self.counterparties:
-            if norm_text(c.get("name", "")) == n:
+        by_name, pairs = self._cp_name_index()
+        c = by_name.get(n)
+        if c is not None:
+            return c
+        extra_pairs = [(norm_text(c.get("name", "")), c) for c in extra] if extra else []
+        for cn, c in extra_pairs:
+            if cn == n:
                 return c
-        for c in self.counterparties:
-            cn = norm_text(c.get("name", ""))
+        for cn, c in pairs:
+            if cn and (cn in n or n in cn):
+                return c
+        for cn, c in extra_pairs:
             if cn and (cn in n or n in cn):
                 return c
         return None
@@ -1170,7 +1911,9 @@ class AccountingStateDB:
                 return c
         return None
     
-    def auto_upsert_counterparty_from_bank_row(self, r: Dict[str, Any]):
+    def auto_upsert_counterparty_from_bank_row(self, r: Dict[str, Any], pending: Optional[List[Dict[str, Any]]] = None):
+        """Создаёт карточку контрагента по строке выписки. Если передан pending, новая карточка
+        только добавляется в этот список (для пакетной вставки через add_counterparties_if_absent)."""
         name = (r.get("counterparty") or "").strip()
         if not name:
             return
@@ -1182,7 +1925,7 @@ class AccountingStateDB:
         if inn2 and not (r.get("cp_inn") or "").strip():
             r["cp_inn"] = inn2
 
-        c = self.find_counterparty_by_name(name)
+        c = self.find_counterparty_by_name(name, pending)
         if not c:
             c = {
                 "id": new_id(),
@@ -1197,427 +1940,352 @@ class AccountingStateDB:
                 "legal_address": "",
                 "phone": "",
             }
-            self.add_counterparty(c)
+            if pending is not None:
+                pending.append(c)
+            else:
+                self.add_counterparties_if_absent([c])
     
     @property
     def acts(self) -> List[Dict[str, Any]]:
-        conn = get_db_connection()
-        cur = conn.cursor(cursor_factory=RealDictCursor)
-        cur.execute("SELECT * FROM acts ORDER BY created_at DESC")
-        rows = cur.fetchall()
-        cur.close()
-        return_db_connection(conn)
-        result = []
-        for row in rows:
-            d = dict(row)
-            if d.get("lines_json"):
-                try:
-                    d["lines"] = json.loads(d["lines_json"])
-                except:
-                    d["lines"] = []
-            else:
-                d["lines"] = []
-            if d.get("executor_json"):
-                try:
-                    d["executor"] = json.loads(d["executor_json"])
-                except:
-                    d["executor"] = {}
-            else:
-                d["executor"] = {}
-            if d.get("customer_json"):
-                try:
-                    d["customer"] = json.loads(d["customer_json"])
-                except:
-                    d["customer"] = {}
-            else:
-                d["customer"] = {}
-            result.append(d)
-        return result
+        return list(self.iter_acts())
+    
+    def iter_acts(self, batch: int = 500):
+        for d in self._iter_query("SELECT * FROM acts ORDER BY created_at DESC", batch=batch):
+            yield self._inflate_act(d)
+    
+    def iter_act_batches(self, batch: int = 500) -> Iterator[List[Dict[str, Any]]]:
+        """Акты пачками по batch в порядке iter_acts (keyset по created_at, id). Каждая пачка читается
+        отдельным коротким запросом, и соединение возвращается в пул до того, как пачка отдана вызывающему:
+        медленный клиент при потоковой отдаче страницы не держит соединение."""
+        # ORDER BY created_at DESC ставит строки без created_at первыми — продолжение после них отдельно
+        order = "ORDER BY created_at DESC, id DESC LIMIT %s"
+        last = None
+        while True:
+            with db_cursor() as cur:
+                if last is None:
+                    cur.execute(f"SELECT * FROM acts {order}", (batch,))
+                elif last[0] is None:
+                    cur.execute(f"SELECT * FROM acts WHERE created_at IS NOT NULL OR id < %s {order}",
+                                (last[1], batch))
+                else:
+                    cur.execute(f"SELECT * FROM acts WHERE created_at < %s OR (created_at = %s AND id < %s) {order}",
+                                (last[0], last[0], last[1], batch))
+                rows = _fetch_dicts(cur)
+            if not rows:
+                return
+            last = (rows[-1]["created_at"], rows[-1]["id"])
+            yield [self._inflate_act(d) for d in rows]
+            if len(rows) < batch:
+                return
+    
+    @staticmethod
+    def _inflate_act(d: Dict[str, Any]) -> Dict[str, Any]:
+        d["lines"] = load_json_field(d.get("lines_json"), [])
+        d["executor"] = load_json_field(d.get("executor_json"), {})
+        d["customer"] = load_json_field(d.get("customer_json"), {})
+        return d
     
     def add_act(self, act: Dict[str, Any]):
-        conn = get_db_connection()
-        cur = conn.cursor()
-        lines_json = json.dumps(act.get("lines", []), ensure_ascii=False)
-        executor_json = json.dumps(act.get("executor", {}), ensure_ascii=False)
-        customer_json = json.dumps(act.get("customer", {}), ensure_ascii=False)
-        cur.execute("""
-            INSERT INTO acts (id, doc_no, doc_date, direction, executor_json, customer_json, basis, vat_mode, lines_json)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
-        """, (
-            act.get("id"), act.get("doc_no"), act.get("doc_date"),
-            act.get("direction", "provide"), executor_json, customer_json,
-            act.get("basis"), act.get("vat_mode"), lines_json
-        ))
-        conn.commit()
-        cur.close()
-        return_db_connection(conn)
+        with db_cursor() as cur:
+            lines_json = json_dumps_text(act.get("lines", []))
+            executor_json = json_dumps_text(act.get("executor", {}))
+            customer_json = json_dumps_text(act.get("customer", {}))
+            cur.execute("""
+                INSERT INTO acts (id, doc_no, doc_date, direction, executor_json, customer_json, basis, vat_mode, lines_json)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+            """, (
+                act.get("id"), act.get("doc_no"), act.get("doc_date"),
+                act.get("direction", "provide"), executor_json, customer_json,
+                act.get("basis"), act.get("vat_mode"), lines_json
+            ))
     
-    def update_act(self, aid: str, act: Dict[str, Any]):
-        conn = get_db_connection()
-        cur = conn.cursor()
-        lines_json = json.dumps(act.get("lines", []), ensure_ascii=False)
-        executor_json = json.dumps(act.get("executor", {}), ensure_ascii=False)
-        customer_json = json.dumps(act.get("customer", {}), ensure_ascii=False)
-        cur.execute("""
-            UPDATE acts SET doc_no=%s, doc_date=%s, direction=%s, executor_json=%s, customer_json=%s,
-                   basis=%s, vat_mode=%s, lines_json=%s
-            WHERE id = %s
-        """, (
-            act.get("doc_no"), act.get("doc_date"),
-            act.get("direction", "provide"), executor_json, customer_json,
-            act.get("basis"), act.get("vat_mode"), lines_json, aid
-        ))
-        conn.commit()
-        cur.close()
-        return_db_connection(conn)
+    def update_act(self, aid: str, act: Dict[str, Any], existing: Optional[Dict[str, Any]] = None):
+        """existing — текущая версия акта (get_act_by_id). Неизменившиеся строки и стороны акта
+        не сериализуются заново и не переписываются (большой lines_json остаётся в TOAST как есть)."""
+        updates = {
+            "doc_no": act.get("doc_no"), "doc_date": act.get("doc_date"),
+            "direction": act.get("direction", "provide"), "basis": act.get("basis"), "vat_mode": act.get("vat_mode"),
+        }
+        for key, column, default in _ACT_JSON_FIELDS:
+            value = act.get(key, default)
+            if existing is None or existing.get(key, default) != value:
+                updates[column] = json_dumps_text(value)
+        values = list(updates.values())
+        with db_cursor() as cur:
+            cur.execute(_update_statement(cur, "acts", tuple(updates), only_changed=True), values + [aid] + values)
     
     def delete_act(self, aid: str):
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute("DELETE FROM acts WHERE id = %s", (aid,))
-        conn.commit()
-        cur.close()
-        return_db_connection(conn)
+        with db_cursor() as cur:
+            cur.execute("DELETE FROM acts WHERE id = %s", (aid,))
     
     def get_act_by_id(self, aid: str) -> Optional[Dict[str, Any]]:
-        conn = get_db_connection()
-        cur = conn.cursor(cursor_factory=RealDictCursor)
-        cur.execute("SELECT * FROM acts WHERE id = %s", (aid,))
-        row = cur.fetchone()
-        cur.close()
-        return_db_connection(conn)
+        with db_cursor(dict_cursor=True) as cur:
+            row = _fetch_by_id(cur, "get_act", aid)
         if not row:
             return None
-        d = dict(row)
-        if d.get("lines_json"):
-            try:
-                d["lines"] = json.loads(d["lines_json"])
-            except:
-                d["lines"] = []
-        else:
-            d["lines"] = []
-        if d.get("executor_json"):
-            try:
-                d["executor"] = json.loads(d["executor_json"])
-            except:
-                d["executor"] = {}
-        else:
-            d["executor"] = {}
-        if d.get("customer_json"):
-            try:
-                d["customer"] = json.loads(d["customer_json"])
-            except:
-                d["customer"] = {}
-        else:
-            d["customer"] = {}
-        return d
+        return self._inflate_act(dict(row))
     
     @property
     def payment_orders(self) -> List[Dict[str, Any]]:
-        conn = get_db_connection()
-        cur = conn.cursor(cursor_factory=RealDictCursor)
-        cur.execute("SELECT * FROM payment_orders ORDER BY created_at DESC")
-        rows = cur.fetchall()
-        cur.close()
-        return_db_connection(conn)
-        result = []
-        for row in rows:
-            d = dict(row)
-            d["date"] = d.pop("date_str", "")
-            if d.get("payer_json"):
-                try:
-                    d["payer"] = json.loads(d["payer_json"])
-                except:
-                    d["payer"] = {}
-            if d.get("receiver_json"):
-                try:
-                    d["receiver"] = json.loads(d["receiver_json"])
-                except:
-                    d["receiver"] = {}
-            result.append(d)
-        return result
+        return list(self.iter_payment_orders())
+    
+    def iter_payment_orders(self, batch: int = 500):
+        for d in self._iter_query("SELECT * FROM payment_orders ORDER BY created_at DESC", batch=batch):
+            yield self._inflate_payment_order(d)
+    
+    @staticmethod
+    def _inflate_payment_order(d: Dict[str, Any]) -> Dict[str, Any]:
+        d["date"] = d.pop("date_str", "")
+        if d.get("payer_json"):
+            d["payer"] = load_json_field(d["payer_json"], {})
+        if d.get("receiver_json"):
+            d["receiver"] = load_json_field(d["receiver_json"], {})
+        return d
+    
+    def get_payment_order_by_id(self, poid: str) -> Optional[Dict[str, Any]]:
+        with db_cursor(dict_cursor=True) as cur:
+            row = _fetch_by_id(cur, "get_payment_order", poid)
+        return self._inflate_payment_order(dict(row)) if row else None
     
     def add_payment_order(self, po: Dict[str, Any]):
-        conn = get_db_connection()
-        cur = conn.cursor()
-        payer_json = json.dumps(po.get("payer", {}), ensure_ascii=False)
-        receiver_json = json.dumps(po.get("receiver", {}), ensure_ascii=False)
-        cur.execute("""
-            INSERT INTO payment_orders (id, number, date_str, amount, amount_words, payer_json, receiver_json, purpose, pay_type, vid_op, ocher)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-        """, (
-            po.get("id"), po.get("number"), po.get("date"),
-            str(decimal_from_str(po.get("amount") or 0)), po.get("amount_words"),
-            payer_json, receiver_json, po.get("purpose"),
-            po.get("pay_type"), po.get("vid_op"), po.get("ocher")
-        ))
-        conn.commit()
-        cur.close()
-        return_db_connection(conn)
+        with db_cursor() as cur:
+            payer_json = json_dumps_text(po.get("payer", {}))
+            receiver_json = json_dumps_text(po.get("receiver", {}))
+            cur.execute("""
+                INSERT INTO payment_orders (id, number, date_str, amount, amount_words, payer_json, receiver_json, purpose, pay_type, vid_op, ocher)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+            """, (
+                po.get("id"), po.get("number"), po.get("date"),
+                decimal_from_str(po.get("amount") or _ZERO), po.get("amount_words"),
+                payer_json, receiver_json, po.get("purpose"),
+                po.get("pay_type"), po.get("vid_op"), po.get("ocher")
+            ))
     
     def delete_payment_order(self, poid: str):
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute("DELETE FROM payment_orders WHERE id = %s", (poid,))
-        conn.commit()
-        cur.close()
-        return_db_connection(conn)
+        with db_cursor() as cur:
+            cur.execute("DELETE FROM payment_orders WHERE id = %s", (poid,))
     
     @property
     def employees(self) -> List[Dict[str, Any]]:
-        conn = get_db_connection()
-        cur = conn.cursor(cursor_factory=RealDictCursor)
-        cur.execute("SELECT * FROM employees ORDER BY name")
-        rows = cur.fetchall()
-        cur.close()
-        return_db_connection(conn)
-        return [dict(row) for row in rows]
+        with db_cursor() as cur:
+            cur.execute("SELECT * FROM employees ORDER BY name")
+            return _fetch_dicts(cur)
     
     def add_employee(self, emp: Dict[str, Any]):
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute("""
-            INSERT INTO employees (id, name, inn, passport, passport_issued, bank, bik, corr, account, salary, advance, main_part)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-        """, (
-            emp.get("id"), emp.get("name"), emp.get("inn"), emp.get("passport"), emp.get("passport_issued"),
-            emp.get("bank"), emp.get("bik"), emp.get("corr"), emp.get("account"),
-            str(decimal_from_str(emp.get("salary") or 0)),
-            str(decimal_from_str(emp.get("advance") or 0)),
-            str(decimal_from_str(emp.get("main") or 0))
-        ))
-        conn.commit()
-        cur.close()
-        return_db_connection(conn)
+        with db_cursor() as cur:
+            cur.execute("""
+                INSERT INTO employees (id, name, inn, passport, passport_issued, bank, bik, corr, account, salary, advance, main_part)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+            """, (
+                emp.get("id"), emp.get("name"), emp.get("inn"), emp.get("passport"), emp.get("passport_issued"),
+                emp.get("bank"), emp.get("bik"), emp.get("corr"), emp.get("account"),
+                decimal_from_str(emp.get("salary") or _ZERO),
+                decimal_from_str(emp.get("advance") or _ZERO),
+                decimal_from_str(emp.get("main") or _ZERO)
+            ))
     
     def update_employee(self, eid: str, emp: Dict[str, Any]):
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute("""
-            UPDATE employees SET name=%s, inn=%s, passport=%s, passport_issued=%s, bank=%s, bik=%s, corr=%s, account=%s, salary=%s, advance=%s, main_part=%s WHERE id = %s
-        """, (
-            emp.get("name"), emp.get("inn"), emp.get("passport"), emp.get("passport_issued"),
-            emp.get("bank"), emp.get("bik"), emp.get("corr"), emp.get("account"),
-            str(decimal_from_str(emp.get("salary") or 0)),
-            str(decimal_from_str(emp.get("advance") or 0)),
-            str(decimal_from_str(emp.get("main") or 0)), eid
-        ))
-        conn.commit()
-        cur.close()
-        return_db_connection(conn)
+        with db_cursor() as cur:
+            cur.execute("""
+                UPDATE employees SET name=%s, inn=%s, passport=%s, passport_issued=%s, bank=%s, bik=%s, corr=%s, account=%s, salary=%s, advance=%s, main_part=%s WHERE id = %s
+            """, (
+                emp.get("name"), emp.get("inn"), emp.get("passport"), emp.get("passport_issued"),
+                emp.get("bank"), emp.get("bik"), emp.get("corr"), emp.get("account"),
+                decimal_from_str(emp.get("salary") or _ZERO),
+                decimal_from_str(emp.get("advance") or _ZERO),
+                decimal_from_str(emp.get("main") or _ZERO), eid
+            ))
     
     def get_employee_by_id(self, eid: str) -> Optional[Dict[str, Any]]:
-        conn = get_db_connection()
-        cur = conn.cursor(cursor_factory=RealDictCursor)
-        cur.execute("SELECT * FROM employees WHERE id = %s", (eid,))
-        row = cur.fetchone()
-        cur.close()
-        return_db_connection(conn)
+        with db_cursor(dict_cursor=True) as cur:
+            row = _fetch_by_id(cur, "get_employee", eid)
         return dict(row) if row else None
     
     def delete_employee(self, eid: str):
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute("DELETE FROM employees WHERE id = %s", (eid,))
-        conn.commit()
-        cur.close()
-        return_db_connection(conn)
+        with db_cursor() as cur:
+            cur.execute("DELETE FROM employees WHERE id = %s", (eid,))
     
     @property
     def salary_payments(self) -> List[Dict[str, Any]]:
-        conn = get_db_connection()
-        cur = conn.cursor(cursor_factory=RealDictCursor)
-        cur.execute("SELECT * FROM salary_payments ORDER BY created_at DESC")
-        rows = cur.fetchall()
-        cur.close()
-        return_db_connection(conn)
-        result = []
-        for row in rows:
-            d = dict(row)
+        with db_cursor() as cur:
+            cur.execute("SELECT * FROM salary_payments ORDER BY created_at DESC")
+            result = _fetch_dicts(cur)
+        for d in result:
             if d.get("created_at"):
                 d["created_at_str"] = d["created_at"].strftime("%d.%m.%Y %H:%M:%S")
             else:
                 d["created_at_str"] = ""
-            result.append(d)
         return result
     
     def add_salary_payment(self, sp: Dict[str, Any]):
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute("""
-            INSERT INTO salary_payments (id, employee_id, month, pay_type, amount, payment_order_id)
-            VALUES (%s, %s, %s, %s, %s, %s)
-        """, (
-            sp.get("id"), sp.get("employee_id"), sp.get("month"), sp.get("type"),
-            str(decimal_from_str(sp.get("amount") or 0)), sp.get("payment_order_id")
-        ))
-        conn.commit()
-        cur.close()
-        return_db_connection(conn)
+        self.add_salary_payments([sp])
+    
+    def add_salary_payments(self, items: List[Dict[str, Any]]):
+        if not items:
+            return
+        with db_cursor() as cur:
+            execute_values(cur, """
+                INSERT INTO salary_payments (id, employee_id, month, pay_type, amount, payment_order_id)
+                VALUES %s
+            """, [(
+                sp.get("id"), sp.get("employee_id"), sp.get("month"), sp.get("type"),
+                decimal_from_str(sp.get("amount") or _ZERO), sp.get("payment_order_id")
+            ) for sp in items], page_size=1000)
     
     def delete_salary_payment(self, sid: str):
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute("DELETE FROM salary_payments WHERE id = %s", (sid,))
-        conn.commit()
-        cur.close()
-        return_db_connection(conn)
+        with db_cursor() as cur:
+            cur.execute("DELETE FROM salary_payments WHERE id = %s", (sid,))
     
     def add_payment_order_with_source(self, po: Dict[str, Any]):
-        conn = get_db_connection()
-        cur = conn.cursor()
-        payer_json = json.dumps(po.get("payer", {}), ensure_ascii=False)
-        receiver_json = json.dumps(po.get("receiver", {}), ensure_ascii=False)
-        cur.execute("""
-            INSERT INTO payment_orders (id, number, date_str, amount, amount_words, payer_json, receiver_json, purpose, pay_type, vid_op, ocher, source)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-        """, (
-            po.get("id"), po.get("number"), po.get("date"),
-            str(decimal_from_str(po.get("amount") or 0)), po.get("amount_words"),
-            payer_json, receiver_json, po.get("purpose"),
-            po.get("pay_type"), po.get("vid_op"), po.get("ocher"), po.get("source")
-        ))
-        conn.commit()
-        cur.close()
-        return_db_connection(conn)
+        with db_cursor() as cur:
+            payer_json = json_dumps_text(po.get("payer", {}))
+            receiver_json = json_dumps_text(po.get("receiver", {}))
+            cur.execute("""
+                INSERT INTO payment_orders (id, number, date_str, amount, amount_words, payer_json, receiver_json, purpose, pay_type, vid_op, ocher, source)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+            """, (
+                po.get("id"), po.get("number"), po.get("date"),
+                decimal_from_str(po.get("amount") or _ZERO), po.get("amount_words"),
+                payer_json, receiver_json, po.get("purpose"),
+                po.get("pay_type"), po.get("vid_op"), po.get("ocher"), po.get("source")
+            ))
     
     @property
     def upd_rows(self) -> List[Dict[str, Any]]:
-        conn = get_db_connection()
-        cur = conn.cursor(cursor_factory=RealDictCursor)
-        cur.execute("SELECT * FROM upd_rows ORDER BY created_at DESC")
-        rows = cur.fetchall()
-        cur.close()
-        return_db_connection(conn)
-        return [dict(row) for row in rows]
+        return list(self.iter_upd_rows())
+    
+    def iter_upd_rows(self, batch: int = 500):
+        return self._iter_query("SELECT * FROM upd_rows ORDER BY created_at DESC", batch=batch)
     
     def add_upd_row(self, r: Dict[str, Any]):
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute("""
-            INSERT INTO upd_rows (id, doc_no, doc_date, counterparty, inn, amount, vat, description, source_file)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
-        """, (
-            r.get("id"), r.get("doc_no"), r.get("doc_date"), r.get("counterparty"),
-            r.get("inn"), str(decimal_from_str(r.get("amount") or 0)), str(decimal_from_str(r.get("vat") or 0)),
-            r.get("description"), r.get("source_file")
-        ))
-        conn.commit()
-        cur.close()
-        return_db_connection(conn)
+        self.add_upd_rows([r])
     
-    def delete_upd_row(self, rid: str):
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute("DELETE FROM upd_rows WHERE id = %s", (rid,))
-        conn.commit()
-        cur.close()
-        return_db_connection(conn)
+    def add_upd_rows(self, rows: List[Dict[str, Any]]):
+        if not rows:
+            return
+        with db_cursor() as cur:
+            execute_values(cur, """
+                INSERT INTO upd_rows (id, doc_no, doc_date, counterparty, inn, amount, vat, description, source_file)
+                VALUES %s
+            """, [(
+                r.get("id"), r.get("doc_no"), r.get("doc_date"), r.get("counterparty"),
+                r.get("inn"), decimal_from_str(r.get("amount") or _ZERO), decimal_from_str(r.get("vat") or _ZERO),
+                r.get("description"), r.get("source_file")
+            ) for r in rows], page_size=1000)
+    
+    def delete_upd_row(self, rid: str):
+        with db_cursor() as cur:
+            cur.execute("DELETE FROM upd_rows WHERE id = %s", (rid,))
     
     @property
     def real_rows(self) -> List[Dict[str, Any]]:
-        conn = get_db_connection()
-        cur = conn.cursor(cursor_factory=RealDictCursor)
-        cur.execute("SELECT * FROM real_rows ORDER BY created_at DESC")
-        rows = cur.fetchall()
-        cur.close()
-        return_db_connection(conn)
-        return [dict(row) for row in rows]
+        return list(self.iter_real_rows())
+    
+    def iter_real_rows(self, batch: int = 500):
+        return self._iter_query("SELECT * FROM real_rows ORDER BY created_at DESC", batch=batch)
     
     def add_real_row(self, r: Dict[str, Any]):
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute("""
-            INSERT INTO real_rows (id, doc_no, doc_date, counterparty, amount, description)
-            VALUES (%s, %s, %s, %s, %s, %s)
-        """, (
-            r.get("id"), r.get("doc_no"), r.get("doc_date"), r.get("counterparty"),
-            str(decimal_from_str(r.get("amount") or 0)), r.get("description")
-        ))
-        conn.commit()
-        cur.close()
-        return_db_connection(conn)
+        self.add_real_rows([r])
+    
+    def add_real_rows(self, rows: List[Dict[str, Any]]):
+        if not rows:
+            return
+        with db_cursor() as cur:
+            execute_values(cur, """
+                INSERT INTO real_rows (id, doc_no, doc_date, counterparty, amount, description)
+                VALUES %s
+            """, [(
+                r.get("id"), r.get("doc_no"), r.get("doc_date"), r.get("counterparty"),
+                decimal_from_str(r.get("amount") or _ZERO), r.get("description")
+            ) for r in rows], page_size=1000)
     
     def delete_real_row(self, rid: str):
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute("DELETE FROM real_rows WHERE id = %s", (rid,))
-        conn.commit()
-        cur.close()
-        return_db_connection(conn)
+        with db_cursor() as cur:
+            cur.execute("DELETE FROM real_rows WHERE id = %s", (rid,))
     
     @property
     def basis_history(self) -> List[str]:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute("SELECT basis FROM basis_history ORDER BY id DESC")
-        rows = cur.fetchall()
-        cur.close()
-        return_db_connection(conn)
+        with db_cursor() as cur:
+            cur.execute("SELECT basis FROM basis_history ORDER BY id DESC")
+            rows = cur.fetchall()
         return [row[0] for row in rows]
     
     def add_basis(self, basis: str):
         if not basis.strip():
             return
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute("""
-            INSERT INTO basis_history (basis) VALUES (%s)
-            ON CONFLICT (basis) DO NOTHING
-        """, (basis,))
-        conn.commit()
-        cur.close()
-        return_db_connection(conn)
+        with db_cursor() as cur:
+            cur.execute("""
+                INSERT INTO basis_history (basis) VALUES (%s)
+                ON CONFLICT (basis) DO NOTHING
+            """, (basis,))
     
     def recalc_bank_categories(self):
         cp_map = self.cp_category_map
         user_map = self.user_category_map
         
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute("SELECT id, counterparty, purpose FROM bank_rows")
-        rows = cur.fetchall()
-        
-        for rid, counterparty, purpose in rows:
-            category = detect_category(counterparty or "", purpose or "", cp_map, user_map)
-            cur.execute("UPDATE bank_rows SET category = %s WHERE id = %s", (category, rid))
+        with db_cursor() as cur:
+            cur.execute("SELECT id, counterparty, purpose, category FROM bank_rows")
+            rows = cur.fetchall()
         
-        conn.commit()
-        cur.close()
-        return_db_connection(conn)
+            updates = []
+            for rid, counterparty, purpose, old_category in rows:
+                category = detect_category(counterparty or "", purpose or "", cp_map, user_map)
+                if category != old_category:
+                    updates.append((rid, category))
+            _bulk_update_column(cur, "bank_rows", "category", updates)
+            _refresh_bank_search_text(cur, [rid for rid, _ in updates])
+        if updates:
+            self._bump_version("bank_rows")
     
     def sanitize_names_and_inn(self):
-        conn = get_db_connection()
-        cur = conn.cursor()
-        
-        cur.execute("SELECT id, name, inn FROM counterparties")
-        for cid, name, inn in cur.fetchall():
-            clean, inn2 = split_inn_from_name(name or "")
-            if clean and clean != name:
-                cur.execute("UPDATE counterparties SET name = %s WHERE id = %s", (clean, cid))
-            if inn2 and not (inn or "").strip():
-                cur.execute("UPDATE counterparties SET inn = %s WHERE id = %s", (inn2, cid))
+        with db_cursor() as cur:
+            cp_updates = []
+            cur.execute("SELECT id, name, inn FROM counterparties")
+            for cid, name, inn in cur.fetchall():
+                fix = self._sanitize_fix(cid, name, inn)
+                if fix:
+                    cp_updates.append(fix)
+            _bulk_update_columns(cur, "counterparties", ("name", "inn"), cp_updates)
         
-        cur.execute("SELECT id, counterparty, cp_inn FROM bank_rows")
-        for rid, counterparty, cp_inn in cur.fetchall():
-            clean, inn2 = split_inn_from_name(counterparty or "")
-            if clean and clean != counterparty:
-                cur.execute("UPDATE bank_rows SET counterparty = %s WHERE id = %s", (clean, rid))
-            if inn2 and not (cp_inn or "").strip():
-                cur.execute("UPDATE bank_rows SET cp_inn = %s WHERE id = %s", (inn2, rid))
-        
-        conn.commit()
-        cur.close()
-        return_db_connection(conn)
+            bank_updates = []
+            cur.execute("SELECT id, counterparty, cp_inn FROM bank_rows")
+            for rid, counterparty, cp_inn in cur.fetchall():
+                fix = self._sanitize_fix(rid, counterparty, cp_inn)
+                if fix:
+                    bank_updates.append(fix)
+            _bulk_update_columns(cur, "bank_rows", ("counterparty", "cp_inn"), bank_updates)
+            _refresh_bank_search_text(cur, [fix[0] for fix in bank_updates if fix[1] is not None])
+        if cp_updates:
+            self._bump_version("counterparties")
+        if bank_updates:
+            self._bump_version("bank_rows")
+    
+    @staticmethod
+    def _sanitize_fix(rid: Any, name: Optional[str], inn: Optional[str]) -> Optional[Tuple[Any, Optional[str], Optional[str]]]:
+        """(id, новое имя или None, ИНН из имени или None); None, если строку менять не нужно."""
+        clean, inn2 = split_inn_from_name(name or "")
+        new_name = clean if clean and clean != name else None
+        new_inn = inn2 if inn2 and not (inn or "").strip() else None
+        if new_name is None and new_inn is None:
+            return None
+        return (rid, new_name, new_inn)
 
 
 STATE = AccountingStateDB()
 
 
+_PUNCT_RE = re.compile(r"[^\w\s]")
+
+
 def is_fns_treasury(counterparty: str) -> bool:
     """Check if counterparty is FNS Treasury (case-insensitive, ignores brackets etc)"""
-    cp_clean = re.sub(r'[^\w\s]', '', counterparty.lower())
-    cp_clean = ' '.join(cp_clean.split())
+    low = counterparty.lower()
+    if "ф" not in low:
+        # Удаление знаков препинания букв не добавляет: без «ф» не будет и «фнс»
+        return False
+    if "казначейство" in low and "фнс" in low:
+        return True
+    cp_clean = _PUNCT_RE.sub("", low)
     return "казначейство" in cp_clean and "фнс" in cp_clean
 
 
@@ -1637,25 +2305,77 @@ def detect_tax_type(purpose: str) -> str:
     return "Налоги"
 
 
+_FIXED_CATEGORY_MAP = tuple((norm_text(k), v) for k, v in (
+    ("ООО РВБ", "РВБ"),
+    ("ООО \"РВБ\"", "РВБ"),
+    ("ФНС", "Налоги"),
+    ("СКБ КОНТУР", "Консультационные услуги"),
+    ("КОНТУР", "Консультационные услуги"),
+))
+
+# Слова в назначении платежа -> категория; порядок задаёт приоритет
+_PURPOSE_KEYWORDS = (
+    ("КОМИСС", "Комиссия банка"), ("ОБСЛУЖ", "Комиссия банка"), ("ТАРИФ", "Комиссия банка"),
+    ("АРЕНД", "Аренда"),
+    ("НАЛОГ", "Налоги"), ("ЕНП", "Налоги"), ("КБК", "Налоги"),
+    ("ЗАРПЛАТ", "Зарплата"), ("ЗАРАБОТН", "Зарплата"),
+    ("ИНТЕРНЕТ", "Связь, интернет"), ("СВЯЗ", "Связь, интернет"),
+)
+
+# id карты -> (карта, правила). Сбрасывается clear_category_rules() при каждой записи справочников статей
+_CATEGORY_RULES_MEMO: Dict[int, Tuple[Dict[str, Any], List[Tuple[str, str]]]] = {}
+_CATEGORY_RULES_LOCK = threading.Lock()
+
+
+def clear_category_rules():
+    with _CATEGORY_RULES_LOCK:
+        _CATEGORY_RULES_MEMO.clear()
+
+
+def _user_rule_category(cats: List[str]) -> Optional[str]:
+    if len(cats) == 1:
+        return norm_spaces(cats[0].strip() or "Прочее")
+    if len(cats) > 1:
+        return "СПОРНАЯ"
+    return None
+
+
+def _cp_rule_category(cat: Optional[str]) -> str:
+    return norm_spaces((cat or "").strip() or "Прочее")
+
+
+def _category_rules(m: Dict[str, Any], resolve) -> List[Tuple[str, str]]:
+    """Пары (ключ, итоговая категория) по убыванию длины ключа. Считается один раз на объект карты,
+    а не на каждую строку выписки. Запись справочника в STATE сбрасывает память через clear_category_rules();
+    карта хранится в записи, поэтому её id не может достаться другому объекту, пока запись жива."""
+    with _CATEGORY_RULES_LOCK:
+        entry = _CATEGORY_RULES_MEMO.get(id(m))
+    if entry is not None and entry[0] is m:
+        return entry[1]
+    rules = []
+    for k in sorted((k for k in m if k), key=len, reverse=True):
+        category = resolve(m[k])
+        if category is not None:
+            rules.append((k, category))
+    with _CATEGORY_RULES_LOCK:
+        if len(_CATEGORY_RULES_MEMO) >= 8:
+            _CATEGORY_RULES_MEMO.clear()
+        _CATEGORY_RULES_MEMO[id(m)] = (m, rules)
+    return rules
+
+
 def detect_category(counterparty: str, purpose: str, cp_map: Dict[str, str], user_map: Dict[str, List[str]]) -> str:
     cp = norm_text(counterparty)
-    pur = norm_text(purpose)
 
     if user_map:
-        keys = sorted(user_map.keys(), key=len, reverse=True)
-        for k in keys:
-            if k and (k in cp):
-                cats = user_map.get(k, [])
-                if len(cats) == 1:
-                    return norm_spaces(cats[0].strip() or "Прочее")
-                elif len(cats) > 1:
-                    return "СПОРНАЯ"
+        for k, category in _category_rules(user_map, _user_rule_category):
+            if k in cp:
+                return category
 
     if cp_map:
-        keys = sorted(cp_map.keys(), key=len, reverse=True)
-        for k in keys:
-            if k and (k in cp):
-                return norm_spaces((cp_map.get(k) or "").strip() or "Прочее")
+        for k, category in _category_rules(cp_map, _cp_rule_category):
+            if k in cp:
+                return category
 
     if is_fns_treasury(counterparty):
         return detect_tax_type(purpose)
@@ -1665,89 +2385,83 @@ def detect_category(counterparty: str, purpose: str, cp_map: Dict[str, str], use
             return "Озон производство"
         return "Озон"
 
-    FIXED_MAP = {
-        "ООО РВБ": "РВБ",
-        "ООО \"РВБ\"": "РВБ",
-        "ФНС": "Налоги",
-        "СКБ КОНТУР": "Консультационные услуги",
-        "КОНТУР": "Консультационные услуги",
-    }
-    for k, v in FIXED_MAP.items():
-        if norm_text(k) in cp:
+    for k, v in _FIXED_CATEGORY_MAP:
+        if k in cp:
             return v
 
-    if "КОМИСС" in pur or "ОБСЛУЖ" in pur or "ТАРИФ" in pur:
-        return "Комиссия банка"
-    if "АРЕНД" in pur:
-        return "Аренда"
-    if "НАЛОГ" in pur or "ЕНП" in pur or "КБК" in pur:
-        return "Налоги"
-    if "ЗАРПЛАТ" in pur or "ЗАРАБОТН" in pur:
-        return "Зарплата"
-    if "ИНТЕРНЕТ" in pur or "СВЯЗ" in pur:
-        return "Связь, интернет"
+    # Ниже только поиск отдельных слов: пробелы схлопывать не нужно, а уникальные назначения платежа
+    # не вытесняют имена контрагентов из кэша norm_text
+    pur = (purpose or "").upper()
+    for k, v in _PURPOSE_KEYWORDS:
+        if k in pur:
+            return v
 
     return "Прочее"
 
 
-def _get_any(doc: Dict[str, str], keys: List[str]) -> str:
-    for k in keys:
-        v = (doc.get(k) or "").strip()
-        if v:
-            return v
-    return ""
+def _party_keys(prefix: str) -> Tuple[Tuple[str, Tuple[str, ...]], ...]:
+    """Поле карточки -> ключи 1С-выписки в порядке приоритета, для Плательщика или Получателя."""
+    return (
+        ("name", (prefix, prefix + "1")),
+        ("inn", (prefix + "ИНН", prefix + "ИНН1")),
+        ("kpp", (prefix + "КПП", prefix + "КПП1")),
+        ("account", (prefix + "Счет", prefix + "РасчСчет", prefix + "Счет1")),
+        ("bank", (prefix + "Банк1", prefix + "Банк", prefix + "Банк2")),
+        ("bik", (prefix + "БИК", prefix + "БИК1")),
+        ("corr", (prefix + "КорСчет", prefix + "КорСчет1", prefix + "КС")),
+    )
 
 
-def extract_counterparty_details(doc: Dict[str, str], side: str) -> Dict[str, str]:
-    if side == "PAYER":
-        name = _get_any(doc, ["Плательщик", "Плательщик1"])
-        inn = _get_any(doc, ["ПлательщикИНН", "ПлательщикИНН1"])
-        kpp = _get_any(doc, ["ПлательщикКПП", "ПлательщикКПП1"])
-        acc = _get_any(doc, ["ПлательщикСчет", "ПлательщикРасчСчет", "ПлательщикСчет1"])
-        bank = _get_any(doc, ["ПлательщикБанк1", "ПлательщикБанк", "ПлательщикБанк2"])
-        bik = _get_any(doc, ["ПлательщикБИК", "ПлательщикБИК1"])
-        corr = _get_any(doc, ["ПлательщикКорСчет", "ПлательщикКорСчет1", "ПлательщикКС"])
-    else:
-        name = _get_any(doc, ["Получатель", "Получатель1"])
-        inn = _get_any(doc, ["ПолучательИНН", "ПолучательИНН1"])
-        kpp = _get_any(doc, ["ПолучательКПП", "ПолучательКПП1"])
-        acc = _get_any(doc, ["ПолучательСчет", "ПолучательРасчСчет", "ПолучательСчет1"])
-        bank = _get_any(doc, ["ПолучательБанк1", "ПолучательБанк", "ПолучательБанк2"])
-        bik = _get_any(doc, ["ПолучательБИК", "ПолучательБИК1"])
-        corr = _get_any(doc, ["ПолучательКорСчет", "ПолучательКорСчет1", "ПолучательКС"])
+_PAYER_KEYS = _party_keys("Плательщик")
+_RECEIVER_KEYS = _party_keys("Получатель")
 
-    return {"name": name, "inn": inn, "kpp": kpp, "account": acc, "bank": bank, "bik": bik, "corr": corr}
+
+def extract_counterparty_details(doc: Dict[str, str], side: str) -> Dict[str, str]:
+    """Реквизиты стороны из документа parse_client_bank_file: значения там уже обрезаны,
+    поэтому берётся первое непустое по ключам поля без повторного strip()."""
+    fields = _PAYER_KEYS if side == "PAYER" else _RECEIVER_KEYS
+    get = doc.get
+    out: Dict[str, str] = {}
+    for field, keys in fields:
+        v = ""
+        for k in keys:
+            v = get(k)
+            if v:
+                break
+        out[field] = v or ""
+    return out
 
 
 def parse_client_bank_file(path: str) -> List[Dict[str, Any]]:
-    with open(path, "r", encoding="cp1251", errors="replace") as f:
-        lines = [line.rstrip("\n\r") for line in f]
-
     main_account = ""
     documents: List[Dict[str, str]] = []
     current_doc: Optional[Dict[str, str]] = None
 
-    for raw in lines:
+    # Выписка целиком читается байтами и декодируется одним вызовом: без построчного TextIOWrapper
+    with open(path, "rb") as f:
+        text = f.read().decode("cp1251", errors="replace")
+
+    for raw in text.splitlines():
         line = raw.strip()
         if not line:
             continue
 
-        if line.startswith("РасчСчет=") and not main_account:
-            main_account = line.split("=", 1)[1].strip()
-
-        if line.startswith("СекцияДокумент="):
-            section_type = line.split("=", 1)[1].strip()
-            current_doc = {"_SectionType": section_type}
-            continue
-
-        if line == "КонецДокумента":
-            if current_doc is not None:
+        # Один проход по строке: ключ до первого «=», значение после
+        key, sep, val = line.partition("=")
+        if not sep:
+            if line == "КонецДокумента" and current_doc is not None:
                 documents.append(current_doc)
                 current_doc = None
             continue
 
-        if current_doc is not None and "=" in line:
-            key, val = line.split("=", 1)
+        if key == "СекцияДокумент":
+            current_doc = {"_SectionType": val.strip()}
+            continue
+
+        if key == "РасчСчет" and not main_account:
+            main_account = val.strip()
+
+        if current_doc is not None:
             current_doc[key.strip()] = val.strip()
 
     rows: List[Dict[str, Any]] = []
@@ -1760,14 +2474,15 @@ def parse_client_bank_file(path: str) -> List[Dict[str, Any]]:
 
 
 def convert_document_to_row(doc: Dict[str, str], main_account: str) -> Dict[str, Any]:
-    sum_str = (doc.get("Сумма", "0") or "0").replace(" ", "").replace(",", ".")
-    amount = decimal_from_str(sum_str)
+    # decimal_from_str сам убирает пробелы и меняет запятую на точку
+    amount = decimal_from_str(doc.get("Сумма"))
 
-    payer_acc = doc.get("ПлательщикСчет", "") or doc.get("ПлательщикРасчСчет", "") or ""
-    receiver_acc = doc.get("ПолучательСчет", "") or doc.get("ПолучательРасчСчет", "") or ""
+    payer_acc = (doc.get("ПлательщикСчет", "") or doc.get("ПлательщикРасчСчет", "") or "").strip()
+    receiver_acc = (doc.get("ПолучательСчет", "") or doc.get("ПолучательРасчСчет", "") or "").strip()
+    main_account = (main_account or "").strip()
 
-    incoming = Decimal("0")
-    outgoing = Decimal("0")
+    incoming = _ZERO
+    outgoing = _ZERO
 
     dt = doc.get("Дата", "") or ""
     purpose = doc.get("НазначениеПлатежа", "") or ""
@@ -1776,13 +2491,13 @@ def convert_document_to_row(doc: Dict[str, str], main_account: str) -> Dict[str,
 
     cp_details = {"name": "", "inn": "", "kpp": "", "account": "", "bank": "", "bik": "", "corr": ""}
 
-    if receiver_acc.strip() and receiver_acc.strip() == (main_account or "").strip():
+    if receiver_acc and receiver_acc == main_account:
         incoming = amount
         dt = doc.get("ДатаПоступило") or doc.get("Дата") or ""
         cp_details = extract_counterparty_details(doc, "PAYER")
         counterparty = cp_details.get("name") or (doc.get("Плательщик", "") or doc.get("Плательщик1", "") or counterparty)
 
-    elif payer_acc.strip() and payer_acc.strip() == (main_account or "").strip():
+    elif payer_acc and payer_acc == main_account:
         outgoing = amount
         dt = doc.get("ДатаСписано") or doc.get("Дата") or ""
         cp_details = extract_counterparty_details(doc, "RECEIVER")
@@ -1814,8 +2529,8 @@ def convert_document_to_row(doc: Dict[str, str], main_account: str) -> Dict[str,
 
 def bank_row_fingerprint(r: Dict[str, Any]) -> str:
     dt = (r.get("date") or "").strip()
-    inc = Decimal(str(r.get("incoming") or 0)).quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
-    out = Decimal(str(r.get("outgoing") or 0)).quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
+    inc = _as_decimal(r.get("incoming")).quantize(_Q01, rounding=ROUND_HALF_UP)
+    out = _as_decimal(r.get("outgoing")).quantize(_Q01, rounding=ROUND_HALF_UP)
     amt_part = f"IN:{inc}" if inc > 0 else f"OUT:{out}"
     cp = norm_text(r.get("counterparty") or "")
     pur = norm_text(r.get("purpose") or "")
@@ -1942,6 +2657,33 @@ a{color:inherit;text-decoration:none}
 }
 """
 
+# Стили отдаются отдельным файлом /static/base.css: браузер кэширует его, а не получает в каждой странице.
+# Хэш в ссылке меняется вместе с содержимым, поэтому кэш можно держать «навсегда».
+BASE_CSS_BYTES = BASE_CSS.encode("utf-8")
+BASE_CSS_GZ = gzip.compress(BASE_CSS_BYTES, compresslevel=9)
+CSS_HASH = hashlib.sha256(BASE_CSS_BYTES).hexdigest()[:16]
+BASE_CSS_URL = f"/static/base.css?v={CSS_HASH}"
+
+
+def serve_base_css(environ, start_response):
+    etag = f'"{CSS_HASH}"'
+    headers = [
+        ("Cache-Control", "public, max-age=31536000, immutable"),
+        ("ETag", etag),
+        ("Vary", "Accept-Encoding"),
+    ]
+    if environ.get("HTTP_IF_NONE_MATCH") == etag:
+        start_response("304 Not Modified", headers)
+        return [b""]
+    data = BASE_CSS_BYTES
+    if "gzip" in (environ.get("HTTP_ACCEPT_ENCODING") or "").lower():
+        data = BASE_CSS_GZ
+        headers.append(("Content-Encoding", "gzip"))
+    headers.append(("Content-Type", "text/css; charset=utf-8"))
+    headers.append(("Content-Length", str(len(data))))
+    start_response("200 OK", headers)
+    return [data]
+
 
 def flash_box(text: str) -> str:
     if not text:
@@ -1949,25 +2691,35 @@ def flash_box(text: str) -> str:
     return f'<div class="flash">{h(text)}</div>'
 
 
-def render_layout(path: str, title: str, crumbs: str, body_html: str, flash: str = "") -> str:
-    nav_html = []
-    for group, items in NAV:
-        nav_html.append(f'<div class="navgroup"><div class="navtitle">{h(group)}</div>')
-        for name, url in items:
-            active = "active" if url == path else ""
-            nav_html.append(f'<a class="navitem {active}" href="{h(url)}"><span>{h(name)}</span></a>')
-        nav_html.append("</div>")
-    nav_html = "\n".join(nav_html)
+def render_layout(path: str, title: str, crumbs: str, body_html: Union[str, Iterable[str]], flash: str = "") -> str:
+    """body_html — готовая строка или куски тела; куски склеиваются с шапкой и подвалом одним join,
+    без промежуточной строки тела."""
+    head, tail = _layout_parts(path, title, crumbs, flash)
+    if isinstance(body_html, str):
+        return head + body_html + tail
+    return "".join((head, *body_html, tail))
+
+
+def render_layout_chunks(path: str, title: str, crumbs: str, body_chunks: Iterable[str], flash: str = "") -> Iterator[str]:
+    """То же, что render_layout, но по частям: шапка, куски тела по мере готовности, подвал."""
+    head, tail = _layout_parts(path, title, crumbs, flash)
+    yield head
+    yield from body_chunks
+    yield tail
+
+
+def _layout_parts(path: str, title: str, crumbs: str, flash: str) -> Tuple[str, str]:
+    nav_html = _NAV_HTML_BY_PATH.get(path, NAV_HTML)
 
     last_saved = STATE.last_saved_at or "—"
 
-    return f"""<!doctype html>
+    head = f"""<!doctype html>
 <html lang="ru">
 <head>
   <meta charset="utf-8"/>
   <meta name="viewport" content="width=device-width, initial-scale=1"/>
   <title>{h(title)} — {OUR_COMPANY_DEFAULT_NAME}</title>
-  <style>{BASE_CSS}</style>
+  <link rel="stylesheet" href="{BASE_CSS_URL}"/>
 </head>
 <body>
   <div class="header">
@@ -1998,14 +2750,73 @@ def render_layout(path: str, title: str, crumbs: str, body_html: str, flash: str
     <main class="main">
       <div class="breadcrumbs">{h(crumbs)}</div>
       {flash}
-      {body_html}
+      """
+    return head, _LAYOUT_TAIL
+
+
+_LAYOUT_TAIL = """
     </main>
   </div>
 </body>
 </html>"""
 
 
+# Шаблоны строки таблицы банка: разбираются один раз при импорте, на строку — один вызов format()
+_BANK_ROW_TPL = """
+        <tr data-id="{rid}">
+          <td class="center">{checkbox}</td>
+          <td class="center">{skip_cell}</td>
+          <td class="center">{date}</td>
+          <td class="center">{month}</td>
+          <td class="right">{incoming}</td>
+          <td class="right">{outgoing}</td>
+          <td>{category}</td>
+          <td>
+          <div class="purpose-wrap">
+            <div class="purpose-clamp" title="{purpose}">{purpose}</div>
+            <span class="purpose-more">Показать полностью</span>
+          </div>
+        </td>
+          <td>{counterparty}</td>
+          <td class="center">{doctype}</td>
+          <td class="center">
+            {action}
+          </td>
+        </tr>
+        """.format
+
+# Флажок «Не учитывать»: id строки берётся из data-id у <tr>, отправляет общая форма skipForm
+_BANK_SKIP_CELL_TPL = '<input type="checkbox" class="skip-toggle" {checked}/>'.format
+
+
 def page_bank(path: str, qd: Dict[str, str] = None, flash: str = "") -> str:
+    return "".join(page_bank_chunks(path, qd, flash))
+
+
+PREDEFINED_CATEGORIES = (
+    "Прочее", "Налоги", "Налоги - УСН", "Налоги - НДС", "Налоги - НДФЛ", "Налоги - Страховые",
+    "Комиссия банка", "Аренда", "Зарплата", "Связь, интернет", "Озон", "Wildberries",
+)
+
+
+_DATALIST_OPTION_TPL = '<option value="{}">'.format
+
+
+def category_datalist_html(bank_cats: Tuple[str, ...], user_cats: Tuple[str, ...] = ()) -> str:
+    """<option> для подсказок статей: статьи из выписки (кроме служебных), заведённые пользователем
+    и стандартные. Кэшируется в STATE.category_datalist."""
+    used = {c.strip() for c in bank_cats} - {"", "Прочее", "СПОРНАЯ"}
+    used.update(c.strip() for c in user_cats if c and c.strip())
+    used.update(PREDEFINED_CATEGORIES)
+    return "\n".join(map(_DATALIST_OPTION_TPL, map(h, sorted(used))))
+
+
+# Строки таблицы банка отдаются клиенту пачками по столько штук
+BANK_STREAM_ROWS = 25
+
+
+def page_bank_chunks(path: str, qd: Dict[str, str] = None, flash: str = "") -> Iterator[str]:
+    """Страница банка кусками для serve_stream. Запросы к базе выполняются до первого куска."""
     if qd is None:
         qd = {}
     sort_mode = qd.get("sort", "upload_desc")
@@ -2018,53 +2829,13 @@ def page_bank(path: str, qd: Dict[str, str] = None, flash: str = "") -> str:
         current_page = 1
     per_page = 100
     
-    bank_rows = list(STATE.bank_rows)
-    
-    if date_from or date_to:
-        from_dt = parse_date_ddmmyyyy(date_from)
-        to_dt = parse_date_ddmmyyyy(date_to)
-        filtered = []
-        for r in bank_rows:
-            rd = parse_date_ddmmyyyy(r.get("date", "") or "")
-            if rd:
-                if from_dt and rd < from_dt:
-                    continue
-                if to_dt and rd > to_dt:
-                    continue
-                filtered.append(r)
-            else:
-                filtered.append(r)
-        bank_rows = filtered
-    
-    if search_q:
-        sq = search_q.upper()
-        filtered = []
-        for r in bank_rows:
-            searchable = " ".join([
-                r.get("counterparty", "") or "",
-                r.get("purpose", "") or "",
-                r.get("category", "") or "",
-                str(r.get("incoming") or ""),
-                str(r.get("outgoing") or ""),
-            ]).upper()
-            if sq in searchable:
-                filtered.append(r)
-        bank_rows = filtered
-    
-    total_ops = len(bank_rows)
-    
-    def date_sort_key(r):
-        d = parse_date_ddmmyyyy(r.get("date", "") or "")
-        return d if d else date(1900, 1, 1)
-    
-    if sort_mode == "date_asc":
-        bank_rows.sort(key=date_sort_key)
-    elif sort_mode == "date_desc":
-        bank_rows.sort(key=date_sort_key, reverse=True)
-    elif sort_mode == "amount_desc":
-        bank_rows.sort(key=lambda r: Decimal(str(r.get("incoming") or 0)) + Decimal(str(r.get("outgoing") or 0)), reverse=True)
-    elif sort_mode == "amount_asc":
-        bank_rows.sort(key=lambda r: Decimal(str(r.get("incoming") or 0)) + Decimal(str(r.get("outgoing") or 0)))
+    # Фильтр, сортировка и страница считаются в базе: в память попадают только показываемые строки
+    page_rows, current_page, total_normal, disputed_rows = STATE.bank_page(
+        parse_date_ddmmyyyy(date_from) if date_from else None,
+        parse_date_ddmmyyyy(date_to) if date_to else None,
+        search_q, sort_mode, current_page, per_page,
+    )
+    total_ops = total_normal + len(disputed_rows)
     
     cp_map = STATE.cp_category_map
     cp_map_source = STATE.cp_map_source
@@ -2089,12 +2860,9 @@ function pickAndSubmit(inputId, formId){
   inp.onchange = ()=>{ if(inp.files && inp.files.length){ form.submit(); } };
   inp.click();
 }
-function submitOnCheck(formId){
-  document.getElementById(formId).submit();
-}
-function togglePurpose(id){
-  const box = document.getElementById("pur_"+id);
-  const link = document.getElementById("pur_lnk_"+id);
+function togglePurpose(row){
+  const box = row.querySelector(".purpose-wrap > div");
+  const link = row.querySelector(".purpose-more");
   if(!box || !link) return;
   const expanded = box.classList.contains("purpose-expanded");
   if(expanded){
@@ -2107,7 +2875,26 @@ function togglePurpose(id){
     link.textContent = "Свернуть";
   }
 }
+// Один обработчик на таблицу вместо onclick/onchange и отдельной формы в каждой строке
+document.addEventListener("DOMContentLoaded", function(){
+  document.querySelectorAll("table.bank-rows").forEach(function(table){
+    table.addEventListener("click", function(e){
+      if(e.target.classList.contains("purpose-more")) togglePurpose(e.target.closest("tr"));
+    });
+    table.addEventListener("change", function(e){
+      if(!e.target.classList.contains("skip-toggle")) return;
+      const form = document.getElementById("skipForm");
+      form.elements.id.value = e.target.closest("tr").dataset.id;
+      form.elements.value.value = e.target.checked ? "1" : "0";
+      form.submit();
+    });
+  });
+});
 </script>
+<form id="skipForm" method="POST" action="/action/bank/set-skip" style="display:none">
+  <input type="hidden" name="id"/>
+  <input type="hidden" name="value"/>
+</form>
 """
 
     sort_options = [
@@ -2203,50 +2990,40 @@ function togglePurpose(id){
         current_params.append(f"q={urlencode_component(search_q)}")
     return_url = "/bank" + ("?" + "&".join(current_params) if current_params else "")
 
-    disputed_rows = [r for r in bank_rows if r.get("category") == "СПОРНАЯ"]
-    normal_rows = [r for r in bank_rows if r.get("category") != "СПОРНАЯ"]
-
-    def build_row_html(r, show_disputed_form=False):
-        rid = r.get("id", "")
-        inc = Decimal(str(r.get("incoming") or 0))
-        out = Decimal(str(r.get("outgoing") or 0))
-        skip = bool(r.get("skip_outgoing", False))
+    def build_row_html(r, out, show_disputed_form=False,
+                       _h=h, _money=fmt_money, _dec=_as_decimal, _tpl=_BANK_ROW_TPL):
+        """Пишет строку таблицы в out (io.StringIO) по готовому шаблону _BANK_ROW_TPL.
+        Хвостовые аргументы по умолчанию — глобальные функции, связанные как локальные на время цикла."""
+        get = r.get
+        rid = get("id", "")
+        rid_h = _h(rid)
+        purpose_h = _h(get("purpose", "") or "")
+        inc = _dec(get("incoming"))
+        out_amt = _dec(get("outgoing"))
+        skip = bool(get("skip_outgoing", False))
 
         skip_cell = '<span class="muted">—</span>'
-        if out > 0:
-            form_id = f"sk_{rid}"
-            checked = "checked" if skip else ""
-            skip_cell = f"""
-            <form id="{h(form_id)}" method="POST" action="/action/bank/set-skip" style="margin:0">
-              <input type="hidden" name="id" value="{h(rid)}"/>
-              <input type="hidden" name="value" value="0"/>
-              <input type="checkbox" name="value" value="1" {checked}
-                     onchange="submitOnCheck('{h(form_id)}')"/>
-            </form>
-            """
+        if out_amt > 0:
+            skip_cell = _BANK_SKIP_CELL_TPL(checked="checked" if skip else "")
 
-        purpose_full = (r.get("purpose", "") or "")
-        purpose_box = f"""
-          <div class="purpose-wrap">
-            <div id="pur_{h(rid)}" class="purpose-clamp" title="{h(purpose_full)}">{h(purpose_full)}</div>
-            <span id="pur_lnk_{h(rid)}" class="purpose-more" onclick="togglePurpose('{h(rid)}')">Показать полностью</span>
-          </div>
-        """
-        
-        cat_display = h(r.get("category",""))
-        action_cell = f'<a class="btn small" href="/bank/assign?id={h(rid)}&ret={urlencode_component(return_url)}">Подписать</a>'
+        cat_display = _h(get("category",""))
+        action_cell = '<a class="btn small" href="/bank/assign?id=' + rid_h + assign_link_tail
         
         if show_disputed_form:
-            cp_name = (r.get("counterparty") or "").strip()
+            cp_name = (get("counterparty") or "").strip()
             cp_key = norm_text(cp_name)
-            cp_cats = STATE.get_user_categories(cp_key)
-            if cp_cats:
-                opts = "".join(f'<option value="{h(c)}">{h(c)}</option>' for c in cp_cats)
+            # У спорных строк часто один и тот же контрагент: список вариантов строим один раз на страницу
+            opts = disputed_opts.get(cp_key)
+            if opts is None:
+                opts = disputed_opts[cp_key] = "".join(
+                    f'<option value="{_h(c)}">{_h(c)}</option>' for c in STATE.get_user_categories(cp_key)
+                )
+            if opts:
                 cat_display = '<span style="color:#c00;font-weight:bold">СПОРНАЯ</span>'
                 action_cell = f"""
                 <form method="POST" action="/action/bank/resolve-disputed" style="margin:0;display:flex;flex-direction:column;gap:4px">
-                  <input type="hidden" name="id" value="{h(rid)}"/>
-                  <input type="hidden" name="return_url" value="{h(return_url)}"/>
+                  <input type="hidden" name="id" value="{rid_h}"/>
+                  <input type="hidden" name="return_url" value="{return_url_h}"/>
                   <select name="category" style="padding:4px;border-radius:6px;border:1px solid #ccc" required>
                     <option value="">Выберите...</option>
                     {opts}
@@ -2255,38 +3032,31 @@ function togglePurpose(id){
                 </form>
                 """
 
-        cp_name = (r.get("counterparty", "") or "").strip()
+        cp_name = (get("counterparty", "") or "").strip()
         checkbox = ""
         if not show_disputed_form and cp_name:
-            checkbox = f'<input type="checkbox" class="bulk-select" data-cp="{h(cp_name)}" />'
+            checkbox = f'<input type="checkbox" class="bulk-select" data-cp="{_h(cp_name)}" />'
         
-        return f"""
-        <tr>
-          <td class="center">{checkbox}</td>
-          <td class="center">{skip_cell}</td>
-          <td class="center">{h(r.get("date",""))}</td>
-          <td class="center">{h(r.get("month",""))}</td>
-          <td class="right">{f"<span class='income'>{h(fmt_money(inc))}</span>" if inc else ""}</td>
-          <td class="right">{f"<span class='outgoing'>{h(fmt_money(out))}</span>" if out else ""}</td>
-          <td>{cat_display}</td>
-          <td>{purpose_box}</td>
-          <td>{h(r.get("counterparty",""))}</td>
-          <td class="center">{h(r.get("doctype",""))}</td>
-          <td class="center">
-            {action_cell}
-          </td>
-        </tr>
-        """
+        out.write(_tpl(
+            checkbox=checkbox, skip_cell=skip_cell, date=_h(get("date","")), month=_h(get("month","")),
+            incoming=f"<span class='income'>{_money(inc)}</span>" if inc else "",
+            outgoing=f"<span class='outgoing'>{_money(out_amt)}</span>" if out_amt else "",
+            category=cat_display, rid=rid_h, purpose=purpose_h,
+            counterparty=_h(get("counterparty","")), doctype=_h(get("doctype","")),
+            action=action_cell,
+        ))
 
-    total_normal = len(normal_rows)
     total_pages = max(1, (total_normal + per_page - 1) // per_page)
-    current_page = min(current_page, total_pages)
     start_idx = (current_page - 1) * per_page
     end_idx = start_idx + per_page
-    page_rows = normal_rows[start_idx:end_idx]
     
-    rows_html = [build_row_html(r, show_disputed_form=False) for r in page_rows]
-    disputed_rows_html = [build_row_html(r, show_disputed_form=True) for r in disputed_rows]
+    return_url_h = h(return_url)
+    assign_link_tail = f'&ret={urlencode_component(return_url)}">Подписать</a>'
+    disputed_opts: Dict[str, str] = {}
+    disputed_out = io.StringIO()
+    for r in disputed_rows:
+        build_row_html(r, disputed_out, show_disputed_form=True)
+    disputed_rows_html = disputed_out.getvalue()
 
     disputed_section = ""
     if disputed_rows:
@@ -2296,7 +3066,7 @@ function togglePurpose(id){
         <span style="color:#c00;font-weight:bold;font-size:1.1em">Спорные операции ({len(disputed_rows)})</span>
         <span class="smallnote">У этих контрагентов заведено несколько статей — выберите нужную для каждой операции</span>
       </div>
-      <table class="table">
+      <table class="table bank-rows">
         <thead>
           <tr>
             <th style="width:40px"></th>
@@ -2313,28 +3083,18 @@ function togglePurpose(id){
           </tr>
         </thead>
         <tbody>
-          {''.join(disputed_rows_html)}
+          {disputed_rows_html}
         </tbody>
       </table>
     </div>
     """
 
-    used_categories = set()
-    for row in STATE.bank_rows:
-        cat = (row.get("category") or "").strip()
-        if cat and cat not in ("Прочее", "СПОРНАЯ"):
-            used_categories.add(cat)
-    predefined = ["Прочее", "Налоги", "Налоги - УСН", "Налоги - НДС", "Налоги - НДФЛ", "Налоги - Страховые",
-                  "Комиссия банка", "Аренда", "Зарплата", "Связь, интернет", "Озон", "Wildberries"]
-    for p in predefined:
-        used_categories.add(p)
-    categories_sorted = sorted(used_categories)
-    bulk_datalist = "\n".join(f'<option value="{h(c)}">' for c in categories_sorted)
+    bulk_datalist = STATE.category_datalist()
 
     bulk_form = f"""
     <div id="bulkPanel" class="panel" style="margin-bottom:12px;display:none;background:#f0f8ff;border:1px solid #7AA2F7">
       <form method="POST" action="/action/bank/bulk-assign" style="display:flex;gap:12px;align-items:center;flex-wrap:wrap">
-        <input type="hidden" name="return_url" value="{h(return_url)}"/>
+        <input type="hidden" name="return_url" value="{return_url_h}"/>
         <span><b>Выбрано контрагентов:</b> <span id="bulkCount">0</span></span>
         <input type="hidden" name="counterparties" id="bulkCounterparties" value=""/>
         <input type="text" name="category" list="bulk_cat_list" placeholder="Введите статью..."
@@ -2366,8 +3126,8 @@ function togglePurpose(id){
     </script>
     """
 
-    table_html = bulk_form + f"""
-    <table class="table">
+    table_open = bulk_form + f"""
+    <table class="table bank-rows">
       <thead>
         <tr>
           <th style="width:40px" class="center"><input type="checkbox" id="selectAll" onclick="toggleSelectAll(this)"/></th>
@@ -2384,14 +3144,15 @@ function togglePurpose(id){
         </tr>
       </thead>
       <tbody>
-        {''.join(rows_html) if rows_html else '<tr><td colspan="11" class="muted">Пока нет операций. Загрузите выписку.</td></tr>'}
+        """
+    table_close = """
       </tbody>
     </table>
     <script>
-      function toggleSelectAll(el) {{
-        document.querySelectorAll('.bulk-select').forEach(cb => {{ cb.checked = el.checked; }});
+      function toggleSelectAll(el) {
+        document.querySelectorAll('.bulk-select').forEach(cb => { cb.checked = el.checked; });
         updateBulkPanel();
-      }}
+      }
     </script>
     """
     
@@ -2424,10 +3185,22 @@ function togglePurpose(id){
         pagination_html = f'<div style="margin-top:12px;display:flex;gap:8px;align-items:center;flex-wrap:wrap">{" ".join(pages)}</div>'
     
     info_html = f'<div class="smallnote" style="margin-top:8px">Показаны {fmt_int(start_idx + 1)}–{fmt_int(min(end_idx, total_normal))} из {fmt_int(total_normal)} операций (страница {current_page}/{total_pages})</div>'
-    table_html = table_html + info_html + pagination_html
+    table_close = table_close + info_html + pagination_html
 
-    body = toolbar + disputed_section + table_html
-    return render_layout(path="/bank", title="Банк-клиент", crumbs="Операции → Банк-клиент", body_html=body, flash=flash_box(flash))
+    def body_chunks():
+        yield toolbar + disputed_section + table_open
+        if not page_rows:
+            yield '<tr><td colspan="11" class="muted">Пока нет операций. Загрузите выписку.</td></tr>'
+        rows_out = io.StringIO()
+        for i, r in enumerate(page_rows, 1):
+            build_row_html(r, rows_out)
+            if i % BANK_STREAM_ROWS == 0:
+                yield rows_out.getvalue()
+                rows_out = io.StringIO()
+        yield rows_out.getvalue()
+        yield table_close
+
+    yield from render_layout_chunks("/bank", "Банк-клиент", "Операции → Банк-клиент", body_chunks(), flash=flash_box(flash))
 
 
 def page_bank_assign(path: str, qd: Dict[str, str], flash: str = "") -> str:
@@ -2441,23 +3214,29 @@ def page_bank_assign(path: str, qd: Dict[str, str], flash: str = "") -> str:
     cur = (rr.get("category") or "").strip()
     cp_key = norm_text(cp_name)
     
+    # id строки и адрес возврата встречаются в нескольких формах страницы — экранируются один раз
+    rid_h = h(rid)
+    ret_h = h(return_url)
     existing_cats = STATE.get_user_categories(cp_key)
     existing_html = ""
     if existing_cats:
-        cats_items = []
-        for c in existing_cats:
-            cats_items.append(f'''
-              <span class="badge2" style="display:inline-flex;align-items:center;gap:6px">
-                {h(c)}
+        form_head = f'''
                 <form method="POST" action="/action/bank/remove-category" style="display:inline;margin:0">
-                  <input type="hidden" name="id" value="{h(rid)}"/>
+                  <input type="hidden" name="id" value="{rid_h}"/>
                   <input type="hidden" name="cp_key" value="{h(cp_key)}"/>
-                  <input type="hidden" name="category" value="{h(c)}"/>
-                  <input type="hidden" name="return_url" value="{h(return_url)}&id={h(rid)}"/>
+                  <input type="hidden" name="category" value="'''
+        form_tail = f'''"/>
+                  <input type="hidden" name="return_url" value="{ret_h}&id={rid_h}"/>
                   <button type="submit" style="background:none;border:none;cursor:pointer;color:#C00;font-weight:bold;padding:0 4px" title="Удалить статью">×</button>
                 </form>
               </span>
-            ''')
+            '''
+        cats_items = []
+        for c in existing_cats:
+            c_h = h(c)
+            cats_items.append(f'''
+              <span class="badge2" style="display:inline-flex;align-items:center;gap:6px">
+                {c_h}{form_head}{c_h}{form_tail}''')
         existing_html = f"""
         <div style="margin-bottom:12px">
           <div class="smallnote"><b>Заведённые статьи для этого контрагента:</b> (нажмите × чтобы удалить)</div>
@@ -2467,23 +3246,7 @@ def page_bank_assign(path: str, qd: Dict[str, str], flash: str = "") -> str:
         </div>
         """
 
-    used_categories = set()
-    for row in STATE.bank_rows:
-        cat = (row.get("category") or "").strip()
-        if cat and cat not in ("Прочее", "СПОРНАЯ"):
-            used_categories.add(cat)
-    for cats in STATE.user_category_map.values():
-        for cat in cats:
-            if cat and cat.strip():
-                used_categories.add(cat.strip())
-    
-    predefined = ["Прочее", "Налоги", "Налоги - УСН", "Налоги - НДС", "Налоги - НДФЛ", "Налоги - Страховые",
-                  "Комиссия банка", "Аренда", "Зарплата", "Связь, интернет", "Озон", "Wildberries"]
-    for p in predefined:
-        used_categories.add(p)
-    
-    categories_sorted = sorted(used_categories)
-    datalist_options = "\n".join(f'<option value="{h(c)}">' for c in categories_sorted)
+    datalist_options = STATE.category_datalist(include_user=True)
 
     body = f"""
     <div class="pagehead">
@@ -2492,7 +3255,7 @@ def page_bank_assign(path: str, qd: Dict[str, str], flash: str = "") -> str:
         <div class="smallnote">Можно добавить несколько статей — если их больше одной, операции станут «спорными» до выбора.</div>
       </div>
       <div class="toolbar">
-        <a class="btn" href="{h(return_url)}">← Назад</a>
+        <a class="btn" href="{ret_h}">← Назад</a>
       </div>
     </div>
 
@@ -2510,8 +3273,8 @@ def page_bank_assign(path: str, qd: Dict[str, str], flash: str = "") -> str:
       {existing_html}
       <div class="hr"></div>
       <form method="POST" action="/action/bank/assign-category">
-        <input type="hidden" name="id" value="{h(rid)}"/>
-        <input type="hidden" name="return_url" value="{h(return_url)}"/>
+        <input type="hidden" name="id" value="{rid_h}"/>
+        <input type="hidden" name="return_url" value="{ret_h}"/>
         <div>
           <div class="smallnote"><b>Добавить статью</b> (введите или выберите из списка)</div>
           <input name="category" value="" list="category_list" placeholder="Введите новую статью..."
@@ -2522,7 +3285,7 @@ def page_bank_assign(path: str, qd: Dict[str, str], flash: str = "") -> str:
         </div>
         <div style="margin-top:12px;display:flex;gap:10px">
           <button class="btn primary" type="submit">Добавить статью</button>
-          <a class="btn" href="{h(return_url)}">Отмена</a>
+          <a class="btn" href="{ret_h}">Отмена</a>
         </div>
       </form>
     </div>
@@ -2530,12 +3293,68 @@ def page_bank_assign(path: str, qd: Dict[str, str], flash: str = "") -> str:
     return render_layout(path="/bank", title="Подписать контрагента", crumbs="Операции → Банк-клиент → Подписать", body_html=body, flash=flash_box(flash))
 
 
+_CASH_TABLE_HEAD = """
+    <table class="table">
+      <thead>
+        <tr>
+          <th style="width:120px" class="center">Дата</th>
+          <th>Номенклатура</th>
+          <th style="width:160px" class="right">Сумма</th>
+          <th style="width:200px" class="center">Действие</th>
+        </tr>
+      </thead>
+      <tbody>
+        """
+_TABLE_FOOT = """
+      </tbody>
+    </table>
+    """
+
+# Неизменные куски строки таблицы кассы между экранируемыми полями
+_CASH_ROW_0 = """
+        <tr>
+          <td class="center">"""
+_CASH_ROW_1 = """</td>
+          <td>"""
+_CASH_ROW_2 = """</td>
+          <td class="right"><span class="income">"""
+_CASH_ROW_3 = """</span></td>
+          <td class="center">
+            <a class="btn small" href="/cash/edit?id="""
+_CASH_ROW_4 = """">Изменить</a>
+            <form method="POST" action="/action/cash/delete" style="display:inline;margin:0">
+              <input type="hidden" name="id" value=\""""
+_CASH_ROW_5 = """"/>
+              <button class="btn small" type="submit" onclick="return confirm('Удалить запись?')">Удалить</button>
+            </form>
+          </td>
+        </tr>
+        """
+
+
 def page_cash(path: str, flash: str = "") -> str:
     cash_rows = STATE.cash_rows
     total_ops = len(cash_rows)
-    total_sum = sum(Decimal(str(r.get("amount") or 0)) for r in cash_rows)
 
-    body = f"""
+    # Вся страница — один список кусков и один join; сумма считается в том же проходе по строкам
+    parts: List[str] = ["", _CASH_TABLE_HEAD]
+    extend = parts.extend
+    esc, as_dec, money = h, _as_decimal, fmt_money
+    total_sum = _ZERO
+    for r in cash_rows:
+        get = r.get
+        rid_h = esc(get("id", ""))
+        amt = as_dec(get("amount"))
+        total_sum += amt
+        extend((
+            _CASH_ROW_0, esc(get("date","")), _CASH_ROW_1, esc(get("nomenclature","")),
+            _CASH_ROW_2, money(amt), _CASH_ROW_3, rid_h, _CASH_ROW_4, rid_h, _CASH_ROW_5,
+        ))
+    if not cash_rows:
+        parts.append('<tr><td colspan="4" class="muted">Пока нет записей. Добавьте наличный платёж.</td></tr>')
+    parts.append(_TABLE_FOOT)
+
+    parts[0] = f"""
     <div class="pagehead">
       <div>
         <h1>Касса</h1>
@@ -2551,44 +3370,7 @@ def page_cash(path: str, flash: str = "") -> str:
       <span class="badge2"><b>Сумма:</b>&nbsp;{h(fmt_money(total_sum))}</span>
     </div>
     """
-
-    rows_html = []
-    for r in cash_rows:
-        rid = r.get("id", "")
-        amt = Decimal(str(r.get("amount") or 0))
-        rows_html.append(f"""
-        <tr>
-          <td class="center">{h(r.get("date",""))}</td>
-          <td>{h(r.get("nomenclature",""))}</td>
-          <td class="right"><span class="income">{h(fmt_money(amt))}</span></td>
-          <td class="center">
-            <a class="btn small" href="/cash/edit?id={h(rid)}">Изменить</a>
-            <form method="POST" action="/action/cash/delete" style="display:inline;margin:0">
-              <input type="hidden" name="id" value="{h(rid)}"/>
-              <button class="btn small" type="submit" onclick="return confirm('Удалить запись?')">Удалить</button>
-            </form>
-          </td>
-        </tr>
-        """)
-
-    table_html = f"""
-    <table class="table">
-      <thead>
-        <tr>
-          <th style="width:120px" class="center">Дата</th>
-          <th>Номенклатура</th>
-          <th style="width:160px" class="right">Сумма</th>
-          <th style="width:200px" class="center">Действие</th>
-        </tr>
-      </thead>
-      <tbody>
-        {''.join(rows_html) if rows_html else '<tr><td colspan="4" class="muted">Пока нет записей. Добавьте наличный платёж.</td></tr>'}
-      </tbody>
-    </table>
-    """
-
-    body += table_html
-    return render_layout(path="/cash", title="Касса", crumbs="Операции → Касса", body_html=body, flash=flash_box(flash))
+    return render_layout("/cash", "Касса", "Операции → Касса", parts, flash=flash_box(flash))
 
 
 def page_cash_form(path: str, qd: Dict[str, str], flash: str = "") -> str:
@@ -2642,46 +3424,91 @@ def page_cash_form(path: str, qd: Dict[str, str], flash: str = "") -> str:
     return render_layout(path="/cash", title=title, crumbs=f"Операции → Касса → {title}", body_html=body, flash=flash_box(flash))
 
 
+_OZ_TOTAL = "итого"
+_OZ_NEEDLE_PRIMARY = "итого реализовано"
+_OZ_NEEDLE_SECONDARY = "вычетом возвратов"
+
+
 def parse_ozon_excel_total(file_path: str) -> Decimal:
     if not Workbook or not load_workbook:
         return Decimal("0")
     try:
-        wb = load_workbook(file_path, data_only=True)
+        wb = load_workbook(file_path, read_only=True, data_only=True)
+    except Exception:
+        return Decimal("0")
+    fallback: Optional[Decimal] = None
+    try:
         ws = wb.active
+        # Один проход по листу: строка «итого реализовано … за вычетом возвратов» возвращается сразу,
+        # а первая положительная сумма после любого «итого» запоминается как запасной вариант
         for row in ws.iter_rows(values_only=True):
             for i, cell in enumerate(row):
-                if cell and "итого реализовано" in str(cell).lower() and "вычетом возвратов" in str(cell).lower():
+                # Числа и даты «итого» содержать не могут — str()/lower() только для текстовых ячеек
+                if not cell or type(cell) is not str:
+                    continue
+                low = cell.lower()
+                if _OZ_TOTAL not in low:
+                    continue
+                if _OZ_NEEDLE_PRIMARY in low and _OZ_NEEDLE_SECONDARY in low:
                     for j in range(i+1, len(row)):
                         if row[j] is not None:
                             return decimal_from_str(str(row[j]))
-        for row in ws.iter_rows(values_only=True):
-            for i, cell in enumerate(row):
-                if cell and "итого" in str(cell).lower():
+                if fallback is None:
                     for j in range(i+1, len(row)):
                         if row[j] is not None:
                             val = decimal_from_str(str(row[j]))
                             if val > 0:
-                                return val
+                                fallback = val
+                                break
     except Exception:
-        pass
-    return Decimal("0")
+        return Decimal("0")
+    finally:
+        wb.close()
+    return fallback if fallback is not None else Decimal("0")
+
+
+_WB_KEY = "к перечислению продавцу"
+_WB_NUM_RE = re.compile(r"[\d\s]+[,.]?\d*")
+
+
+def _pdf_pages_text(file_path: str) -> Iterator[str]:
+    """Текст PDF постранично: через PDFium (pypdfium2), если он есть, иначе через pdfplumber."""
+    if pdfium is not None:
+        pdf = pdfium.PdfDocument(file_path)
+        try:
+            for i in range(len(pdf)):
+                page = pdf[i]
+                textpage = page.get_textpage()
+                try:
+                    yield textpage.get_text_range()
+                finally:
+                    textpage.close()
+                    page.close()
+        finally:
+            pdf.close()
+        return
+    with pdfplumber.open(file_path) as pdf:
+        for page in pdf.pages:
+            text = page.extract_text() or ""
+            # Разобранные объекты страницы больше не нужны: в длинных отчётах иначе копятся все страницы
+            page.close()
+            yield text
 
 
 def parse_wb_pdf_total(file_path: str) -> Decimal:
-    if pdfplumber is None:
+    if pdfium is None and pdfplumber is None:
         return Decimal("0")
     try:
-        with pdfplumber.open(file_path) as pdf:
-            for page in pdf.pages:
-                text = page.extract_text() or ""
-                for line in text.split("\n"):
-                    low = line.lower()
-                    if "итого к перечислению продавцу" in low or "к перечислению продавцу" in low:
-                        nums = re.findall(r"[\d\s]+[,.]?\d*", line)
-                        for n in reversed(nums):
-                            val = decimal_from_str(n)
-                            if val > 0:
-                                return val
+        for text in _pdf_pages_text(file_path):
+            if _WB_KEY not in text.lower():
+                continue
+            for line in text.splitlines():
+                # «итого к перечислению продавцу» содержит «к перечислению продавцу» — хватает одной проверки
+                if _WB_KEY in line.lower():
+                    for n in reversed(_WB_NUM_RE.findall(line)):
+                        val = decimal_from_str(n)
+                        if val > 0:
+                            return val
     except Exception:
         pass
     return Decimal("0")
@@ -2705,26 +3532,74 @@ def get_period_dates(period_type: str, year: int, quarter: int, month: int) -> T
     return start_date.strftime("%d.%m.%Y"), end_date.strftime("%d.%m.%Y")
 
 
+_MONTHS_RU = ("", "январь", "февраль", "март", "апрель", "май", "июнь",
+              "июль", "август", "сентябрь", "октябрь", "ноябрь", "декабрь")
+
+
 def get_period_label(period_type: str, year: int, quarter: int, month: int) -> str:
     if period_type == "quarter":
         return f"{quarter} квартал {year}"
     else:
-        months_ru = ["", "январь", "февраль", "март", "апрель", "май", "июнь", 
-                     "июль", "август", "сентябрь", "октябрь", "ноябрь", "декабрь"]
-        return f"{months_ru[month]} {year}"
+        return f"{_MONTHS_RU[month]} {year}"
+
+
+# Неизменные куски строки таблицы маркетплейса между экранируемыми полями
+_MP_TABLE_HEAD = """
+    <table class="table">
+      <thead>
+        <tr>
+          <th style="width:140px" class="center">Площадка</th>
+          <th style="width:180px" class="center">Период</th>
+          <th style="width:110px" class="center">С</th>
+          <th style="width:110px" class="center">По</th>
+          <th style="width:160px" class="right">Поступления</th>
+          <th style="width:120px" class="center">Действие</th>
+        </tr>
+      </thead>
+      <tbody>
+        """
+
+_MP_ROW_0 = """
+        <tr>
+          <td class="center">"""
+_MP_ROW_CELL = """</td>
+          <td class="center">"""
+_MP_ROW_1 = """</td>
+          <td class="right"><span class="income">"""
+_MP_ROW_2 = """</span></td>
+          <td class="center">
+            <form method="POST" action="/action/marketplace/delete" style="display:inline;margin:0">
+              <input type="hidden" name="id" value=\""""
+_MP_ROW_3 = """"/>
+              <button class="btn small" type="submit" onclick="return confirm('Удалить запись?')">Удалить</button>
+            </form>
+          </td>
+        </tr>
+        """
 
 
 def page_marketplace(path: str, flash: str = "") -> str:
-    conn = get_db_connection()
-    cur = conn.cursor(cursor_factory=RealDictCursor)
-    cur.execute("SELECT * FROM marketplace_rows ORDER BY year DESC, quarter DESC, month DESC, created_at DESC")
-    rows = cur.fetchall()
-    cur.close()
-    return_db_connection(conn)
+    rows = STATE.marketplace_rows
 
-    total_sum = sum(Decimal(str(r.get("amount") or 0)) for r in rows)
+    # Как и в кассе: один список кусков страницы, сумма поступлений — в том же цикле по строкам
+    parts: List[str] = ["", _MP_TABLE_HEAD]
+    extend = parts.extend
+    esc, as_dec, money = h, _as_decimal, fmt_money
+    total_sum = _ZERO
+    for r in rows:
+        get = r.get
+        amt = as_dec(get("amount"))
+        total_sum += amt
+        extend((
+            _MP_ROW_0, esc(get("platform","")), _MP_ROW_CELL, esc(get("period_label","")),
+            _MP_ROW_CELL, esc(get("date_start","")), _MP_ROW_CELL, esc(get("date_end","")),
+            _MP_ROW_1, money(amt), _MP_ROW_2, esc(get("id", "")), _MP_ROW_3,
+        ))
+    if not rows:
+        parts.append('<tr><td colspan="6" class="muted">Пока нет записей. Добавьте поступление с маркетплейса.</td></tr>')
+    parts.append(_TABLE_FOOT)
 
-    body = f"""
+    parts[0] = f"""
     <div class="pagehead">
       <div>
         <h1>Маркетплейс</h1>
@@ -2741,47 +3616,7 @@ def page_marketplace(path: str, flash: str = "") -> str:
       <span class="badge2"><b>Сумма поступлений:</b>&nbsp;{h(fmt_money(total_sum))}</span>
     </div>
     """
-
-    rows_html = []
-    for r in rows:
-        rid = r.get("id", "")
-        amt = Decimal(str(r.get("amount") or 0))
-        rows_html.append(f'''
-        <tr>
-          <td class="center">{h(r.get("platform",""))}</td>
-          <td class="center">{h(r.get("period_label",""))}</td>
-          <td class="center">{h(r.get("date_start",""))}</td>
-          <td class="center">{h(r.get("date_end",""))}</td>
-          <td class="right"><span class="income">{h(fmt_money(amt))}</span></td>
-          <td class="center">
-            <form method="POST" action="/action/marketplace/delete" style="display:inline;margin:0">
-              <input type="hidden" name="id" value="{h(rid)}"/>
-              <button class="btn small" type="submit" onclick="return confirm('Удалить запись?')">Удалить</button>
-            </form>
-          </td>
-        </tr>
-        ''')
-
-    table_html = f"""
-    <table class="table">
-      <thead>
-        <tr>
-          <th style="width:140px" class="center">Площадка</th>
-          <th style="width:180px" class="center">Период</th>
-          <th style="width:110px" class="center">С</th>
-          <th style="width:110px" class="center">По</th>
-          <th style="width:160px" class="right">Поступления</th>
-          <th style="width:120px" class="center">Действие</th>
-        </tr>
-      </thead>
-      <tbody>
-        {''.join(rows_html) if rows_html else '<tr><td colspan="6" class="muted">Пока нет записей. Добавьте поступление с маркетплейса.</td></tr>'}
-      </tbody>
-    </table>
-    """
-
-    body += table_html
-    return render_layout(path="/marketplace", title="Маркетплейс", crumbs="Операции → Маркетплейс", body_html=body, flash=flash_box(flash))
+    return render_layout("/marketplace", "Маркетплейс", "Операции → Маркетплейс", parts, flash=flash_box(flash))
 
 
 def page_marketplace_add(path: str, qd: Dict[str, str], flash: str = "") -> str:
@@ -2889,11 +3724,20 @@ def page_marketplace_add(path: str, qd: Dict[str, str], flash: str = "") -> str:
     return render_layout(path="/marketplace", title=f"Поступления {platform}", crumbs=f"Операции → Маркетплейс → {platform}", body_html=body, flash=flash_box(flash))
 
 
-def page_counterparties(path: str, flash: str = "") -> str:
-    counterparties = STATE.counterparties
-    our_id = STATE.settings.get("our_company_id")
-
-    body = f"""
+# Неизменные куски строки справочника контрагентов между экранируемыми полями
+_CP_ROW_0 = """
+        <tr>
+          <td>"""
+_CP_ROW_CELL = """</td>
+          <td>"""
+_CP_ROW_1 = """</td>
+          <td class="center">
+            <a class="btn small" href="/counterparties/edit?id="""
+_CP_ROW_2 = """">Изменить</a>
+          </td>
+        </tr>
+        """
+_CP_PAGE_HEAD = """
     <div class="pagehead">
       <div>
         <h1>Контрагенты</h1>
@@ -2903,27 +3747,7 @@ def page_counterparties(path: str, flash: str = "") -> str:
         <a class="btn primary" href="/counterparties/new">+ Добавить</a>
       </div>
     </div>
-    """
-
-    rows = []
-    for c in counterparties:
-        cid = c.get("id", "")
-        is_our = (cid == our_id)
-        our_badge = '<span class="badge2" style="background:#d4edda;color:#155724">Наша компания</span>' if is_our else ""
-        rows.append(f"""
-        <tr>
-          <td>{h(c.get("name",""))} {our_badge}</td>
-          <td>{h(c.get("inn",""))}</td>
-          <td>{h(c.get("kpp",""))}</td>
-          <td>{h(c.get("bank",""))}</td>
-          <td>{h(c.get("account",""))}</td>
-          <td class="center">
-            <a class="btn small" href="/counterparties/edit?id={h(cid)}">Изменить</a>
-          </td>
-        </tr>
-        """)
-
-    body += f"""
+    
     <table class="table">
       <thead>
         <tr>
@@ -2936,56 +3760,97 @@ def page_counterparties(path: str, flash: str = "") -> str:
         </tr>
       </thead>
       <tbody>
-        {''.join(rows) if rows else '<tr><td colspan="6" class="muted">Нет контрагентов.</td></tr>'}
-      </tbody>
-    </table>
-    """
+        """
+_OUR_COMPANY_BADGE = '<span class="badge2" style="background:#d4edda;color:#155724">Наша компания</span>'
+
+
+def page_counterparties(path: str, flash: str = "") -> str:
+    counterparties = STATE.counterparties
+    our_id = STATE.settings.get("our_company_id")
+
+    def build_rows() -> str:
+        parts: List[str] = []
+        extend = parts.extend
+        esc = h
+        for c in counterparties:
+            get = c.get
+            cid = get("id", "")
+            extend((
+                _CP_ROW_0, esc(get("name","")), " ", _OUR_COMPANY_BADGE if cid == our_id else "",
+                _CP_ROW_CELL, esc(get("inn","")), _CP_ROW_CELL, esc(get("kpp","")),
+                _CP_ROW_CELL, esc(get("bank","")), _CP_ROW_CELL, esc(get("account","")),
+                _CP_ROW_1, esc(cid), _CP_ROW_2,
+            ))
+        return "".join(parts)
+
+    # Справочник пополняется из выписок и бывает большим: строки таблицы собираются заново,
+    # только когда сменился кэшированный список контрагентов
+    rows = STATE.render_memo(f"cp_rows_html:{our_id}", counterparties, build_rows)
+
+    body = (_CP_PAGE_HEAD, rows or '<tr><td colspan="6" class="muted">Нет контрагентов.</td></tr>', _TABLE_FOOT)
     return render_layout("/counterparties", "Контрагенты", "Справочники → Контрагенты", body, flash=flash_box(flash))
 
 
-def get_our_company_fields_html(c: Dict[str, Any], is_our: bool) -> str:
-    display = "block" if is_our else "none"
-    return f"""
+# Поля «нашей организации» в форме контрагента: один шаблон на new/edit, подставляются только значения
+_OUR_COMPANY_FIELDS = (
+    "inspection_code", "full_name", "oktmo", "okato", "signatory", "sfr_reg_number",
+    "pfr_reg_self", "pfr_reg_employees", "pfr_terr_code", "pfr_terr_organ", "payment_details",
+    "okpo", "okopf", "okfs", "okved1", "okved2", "okpo_rosstat",
+)
+_OUR_COMPANY_FIELDS_TPL = """
     <div id="ourCompanyFields" style="display:{display}">
       <div class="hr"></div>
       <b>Данные организации (для отчётности)</b>
       <div style="display:grid;grid-template-columns:1fr 1fr;gap:12px;margin-top:10px">
-        <div><div class="smallnote"><b>Код инспекции</b></div><input name="inspection_code" value="{h(c.get('inspection_code') or '')}" style="width:100%;padding:10px;border:1px solid #D7D7D7;border-radius:12px"/></div>
-        <div><div class="smallnote"><b>Полное наименование</b></div><input name="full_name" value="{h(c.get('full_name') or '')}" style="width:100%;padding:10px;border:1px solid #D7D7D7;border-radius:12px"/></div>
-        <div><div class="smallnote"><b>ОКТМО</b></div><input name="oktmo" value="{h(c.get('oktmo') or '')}" style="width:100%;padding:10px;border:1px solid #D7D7D7;border-radius:12px"/></div>
-        <div><div class="smallnote"><b>ОКАТО</b></div><input name="okato" value="{h(c.get('okato') or '')}" style="width:100%;padding:10px;border:1px solid #D7D7D7;border-radius:12px"/></div>
-        <div style="grid-column:span 2"><div class="smallnote"><b>Отчётность подписывает</b></div><input name="signatory" value="{h(c.get('signatory') or '')}" style="width:100%;padding:10px;border:1px solid #D7D7D7;border-radius:12px"/></div>
+        <div><div class="smallnote"><b>Код инспекции</b></div><input name="inspection_code" value="{inspection_code}" style="width:100%;padding:10px;border:1px solid #D7D7D7;border-radius:12px"/></div>
+        <div><div class="smallnote"><b>Полное наименование</b></div><input name="full_name" value="{full_name}" style="width:100%;padding:10px;border:1px solid #D7D7D7;border-radius:12px"/></div>
+        <div><div class="smallnote"><b>ОКТМО</b></div><input name="oktmo" value="{oktmo}" style="width:100%;padding:10px;border:1px solid #D7D7D7;border-radius:12px"/></div>
+        <div><div class="smallnote"><b>ОКАТО</b></div><input name="okato" value="{okato}" style="width:100%;padding:10px;border:1px solid #D7D7D7;border-radius:12px"/></div>
+        <div style="grid-column:span 2"><div class="smallnote"><b>Отчётность подписывает</b></div><input name="signatory" value="{signatory}" style="width:100%;padding:10px;border:1px solid #D7D7D7;border-radius:12px"/></div>
       </div>
       <div class="hr"></div>
       <b>Социальный фонд</b>
-      <div style="margin-top:10px"><div class="smallnote"><b>Регистрационный номер</b></div><input name="sfr_reg_number" value="{h(c.get('sfr_reg_number') or '')}" style="width:100%;padding:10px;border:1px solid #D7D7D7;border-radius:12px"/></div>
+      <div style="margin-top:10px"><div class="smallnote"><b>Регистрационный номер</b></div><input name="sfr_reg_number" value="{sfr_reg_number}" style="width:100%;padding:10px;border:1px solid #D7D7D7;border-radius:12px"/></div>
       <div class="hr"></div>
       <b>Пенсионный фонд</b>
       <div style="display:grid;grid-template-columns:1fr 1fr;gap:12px;margin-top:10px">
-        <div><div class="smallnote"><b>Рег. номер (за себя)</b></div><input name="pfr_reg_self" value="{h(c.get('pfr_reg_self') or '')}" style="width:100%;padding:10px;border:1px solid #D7D7D7;border-radius:12px"/></div>
-        <div><div class="smallnote"><b>Рег. номер (за сотрудников)</b></div><input name="pfr_reg_employees" value="{h(c.get('pfr_reg_employees') or '')}" style="width:100%;padding:10px;border:1px solid #D7D7D7;border-radius:12px"/></div>
-        <div><div class="smallnote"><b>Код терр. органа</b></div><input name="pfr_terr_code" value="{h(c.get('pfr_terr_code') or '')}" style="width:100%;padding:10px;border:1px solid #D7D7D7;border-radius:12px"/></div>
-        <div><div class="smallnote"><b>Территориальный орган</b></div><input name="pfr_terr_organ" value="{h(c.get('pfr_terr_organ') or '')}" style="width:100%;padding:10px;border:1px solid #D7D7D7;border-radius:12px"/></div>
+        <div><div class="smallnote"><b>Рег. номер (за себя)</b></div><input name="pfr_reg_self" value="{pfr_reg_self}" style="width:100%;padding:10px;border:1px solid #D7D7D7;border-radius:12px"/></div>
+        <div><div class="smallnote"><b>Рег. номер (за сотрудников)</b></div><input name="pfr_reg_employees" value="{pfr_reg_employees}" style="width:100%;padding:10px;border:1px solid #D7D7D7;border-radius:12px"/></div>
+        <div><div class="smallnote"><b>Код терр. органа</b></div><input name="pfr_terr_code" value="{pfr_terr_code}" style="width:100%;padding:10px;border:1px solid #D7D7D7;border-radius:12px"/></div>
+        <div><div class="smallnote"><b>Территориальный орган</b></div><input name="pfr_terr_organ" value="{pfr_terr_organ}" style="width:100%;padding:10px;border:1px solid #D7D7D7;border-radius:12px"/></div>
       </div>
       <div class="hr"></div>
       <b>Платёжные реквизиты (для отчётов)</b>
-      <div style="margin-top:10px"><textarea name="payment_details" style="width:100%;min-height:60px;padding:10px;border:1px solid #D7D7D7;border-radius:12px">{h(c.get('payment_details') or '')}</textarea></div>
+      <div style="margin-top:10px"><textarea name="payment_details" style="width:100%;min-height:60px;padding:10px;border:1px solid #D7D7D7;border-radius:12px">{payment_details}</textarea></div>
       <div class="hr"></div>
       <b>Коды статистики</b>
       <div style="display:grid;grid-template-columns:1fr 1fr 1fr;gap:12px;margin-top:10px">
-        <div><div class="smallnote"><b>ОКПО</b></div><input name="okpo" value="{h(c.get('okpo') or '')}" style="width:100%;padding:10px;border:1px solid #D7D7D7;border-radius:12px"/></div>
-        <div><div class="smallnote"><b>ОКОПФ</b></div><input name="okopf" value="{h(c.get('okopf') or '')}" style="width:100%;padding:10px;border:1px solid #D7D7D7;border-radius:12px"/></div>
-        <div><div class="smallnote"><b>ОКФС</b></div><input name="okfs" value="{h(c.get('okfs') or '')}" style="width:100%;padding:10px;border:1px solid #D7D7D7;border-radius:12px"/></div>
-        <div><div class="smallnote"><b>ОКВЭД ред.1</b></div><input name="okved1" value="{h(c.get('okved1') or '')}" style="width:100%;padding:10px;border:1px solid #D7D7D7;border-radius:12px"/></div>
-        <div><div class="smallnote"><b>ОКВЭД ред.2</b></div><input name="okved2" value="{h(c.get('okved2') or '')}" style="width:100%;padding:10px;border:1px solid #D7D7D7;border-radius:12px"/></div>
-        <div><div class="smallnote"><b>ОКПО Росстата</b></div><input name="okpo_rosstat" value="{h(c.get('okpo_rosstat') or '')}" style="width:100%;padding:10px;border:1px solid #D7D7D7;border-radius:12px"/></div>
+        <div><div class="smallnote"><b>ОКПО</b></div><input name="okpo" value="{okpo}" style="width:100%;padding:10px;border:1px solid #D7D7D7;border-radius:12px"/></div>
+        <div><div class="smallnote"><b>ОКОПФ</b></div><input name="okopf" value="{okopf}" style="width:100%;padding:10px;border:1px solid #D7D7D7;border-radius:12px"/></div>
+        <div><div class="smallnote"><b>ОКФС</b></div><input name="okfs" value="{okfs}" style="width:100%;padding:10px;border:1px solid #D7D7D7;border-radius:12px"/></div>
+        <div><div class="smallnote"><b>ОКВЭД ред.1</b></div><input name="okved1" value="{okved1}" style="width:100%;padding:10px;border:1px solid #D7D7D7;border-radius:12px"/></div>
+        <div><div class="smallnote"><b>ОКВЭД ред.2</b></div><input name="okved2" value="{okved2}" style="width:100%;padding:10px;border:1px solid #D7D7D7;border-radius:12px"/></div>
+        <div><div class="smallnote"><b>ОКПО Росстата</b></div><input name="okpo_rosstat" value="{okpo_rosstat}" style="width:100%;padding:10px;border:1px solid #D7D7D7;border-radius:12px"/></div>
       </div>
     </div>
-    """
+    """.format
+
+
+def get_our_company_fields_html(c: Dict[str, Any], is_our: bool) -> str:
+    get = c.get
+    return _OUR_COMPANY_FIELDS_TPL(display="block" if is_our else "none",
+                                   **{f: h(get(f) or "") for f in _OUR_COMPANY_FIELDS})
 
 def page_counterparty_new(flash: str = "") -> str:
+    return render_layout("/counterparties", "Новый контрагент", "Справочники → Контрагенты → Новый",
+                         _counterparty_new_body(), flash=flash_box(flash))
+
+
+@functools.lru_cache(maxsize=1)
+def _counterparty_new_body() -> str:
+    """Пустая форма нового контрагента не зависит от данных — собирается один раз."""
     our_fields = get_our_company_fields_html({}, False)
-    body = f"""
+    return f"""
     <div class="pagehead">
       <div>
         <h1>Новый контрагент</h1>
@@ -3064,7 +3929,6 @@ def page_counterparty_new(flash: str = "") -> str:
       }}
     </script>
     """
-    return render_layout("/counterparties", "Новый контрагент", "Справочники → Контрагенты → Новый", body, flash=flash_box(flash))
 
 
 def page_counterparty_edit(qd: Dict[str, str], flash: str = "") -> str:
@@ -3164,6 +4028,47 @@ def page_counterparty_edit(qd: Dict[str, str], flash: str = "") -> str:
     return render_layout("/counterparties", "Изменить контрагента", "Справочники → Контрагенты → Изменить", body, flash=flash_box(flash))
 
 
+# Разделители полей и строк в строке поиска. norm_text считает их пробельными символами
+# и убирает, так что ни в поле, ни в запросе их не бывает и совпадение не перескакивает границу.
+_SEARCH_FIELD_SEP = "\x1e"
+_SEARCH_ROW_SEP = "\x1f"
+
+
+def _search_haystack(fields: Iterable[Tuple[str, ...]]) -> Tuple[str, List[int]]:
+    """Нормализованные поля всех строк одной строкой плюс смещения начала каждой строки."""
+    chunks: List[str] = []
+    offsets: List[int] = []
+    pos = 0
+    for row in fields:
+        chunk = _SEARCH_FIELD_SEP.join(norm_text(v) for v in row)
+        offsets.append(pos)
+        chunks.append(chunk)
+        pos += len(chunk) + 1
+    return _SEARCH_ROW_SEP.join(chunks), offsets
+
+
+def _search_hits(hay: Tuple[str, List[int]], q: str) -> Iterator[int]:
+    """Номера строк, в полях которых встречается q, по порядку; каждая строка — один раз."""
+    text, offsets = hay
+    find = text.find
+    count = len(offsets)
+    pos = find(q)
+    while pos != -1:
+        idx = bisect.bisect_right(offsets, pos) - 1
+        yield idx
+        if idx + 1 >= count:
+            return
+        pos = find(q, offsets[idx + 1])
+
+
+_SEARCH_ROW_TPL = """
+        <tr>
+          <td style="width:120px"><span class="badge2">{kind}</span></td>
+          <td><a href="{link}"><b>{title}</b></a><div class="smallnote">{meta}</div></td>
+        </tr>
+        """.format
+
+
 def page_search(qd: Dict[str, str], flash: str = "") -> str:
     q = (qd.get("q") or "").strip()
     items = []
@@ -3171,39 +4076,44 @@ def page_search(qd: Dict[str, str], flash: str = "") -> str:
     if q:
         q_upper = norm_text(q)
         bank_rows = STATE.bank_rows
-        for r in bank_rows:
-            if q_upper in norm_text(r.get("counterparty", "")) or q_upper in norm_text(r.get("purpose", "")):
-                items.append((
-                    "Банк",
-                    f"{r.get('date','')} — {r.get('counterparty','')}",
-                    f"Сумма: {fmt_money(r.get('incoming') or r.get('outgoing') or 0)}",
-                    "/bank"
-                ))
-                if len(items) >= 120:
-                    break
+        # Нормализованные поля склеиваются в одну строку один раз на версию списка, а не на каждый запрос
+        bank_hay = STATE.render_memo("search_bank_hay", bank_rows, lambda: _search_haystack(
+            (r.get("counterparty", ""), r.get("purpose", "")) for r in bank_rows
+        ))
+        for idx in _search_hits(bank_hay, q_upper):
+            r = bank_rows[idx]
+            items.append((
+                "Банк",
+                f"{r.get('date','')} — {r.get('counterparty','')}",
+                f"Сумма: {fmt_money(r.get('incoming') or r.get('outgoing') or 0)}",
+                "/bank"
+            ))
+            if len(items) >= 120:
+                break
         
         counterparties = STATE.counterparties
-        for c in counterparties:
-            if q_upper in norm_text(c.get("name", "")) or q_upper in norm_text(c.get("inn", "")):
-                items.append((
-                    "Контрагент",
-                    c.get("name", ""),
-                    f"ИНН: {c.get('inn','')} | Банк: {c.get('bank','')}",
-                    f"/counterparties/edit?id={c.get('id','')}"
-                ))
-                if len(items) >= 120:
-                    break
+        cp_hay = STATE.render_memo("search_cp_hay", counterparties, lambda: _search_haystack(
+            (c.get("name", ""), c.get("inn", "")) for c in counterparties
+        ))
+        for idx in _search_hits(cp_hay, q_upper):
+            c = counterparties[idx]
+            items.append((
+                "Контрагент",
+                c.get("name", ""),
+                f"ИНН: {c.get('inn','')} | Банк: {c.get('bank','')}",
+                f"/counterparties/edit?id={c.get('id','')}"
+            ))
+            if len(items) >= 120:
+                break
 
-    rows = []
+    parts: List[str] = [""]
     for kind, title, meta, link in items:
-        rows.append(f"""
-        <tr>
-          <td style="width:120px"><span class="badge2">{h(kind)}</span></td>
-          <td><a href="{h(link)}"><b>{h(title)}</b></a><div class="smallnote">{h(meta)}</div></td>
-        </tr>
-        """)
+        parts.append(_SEARCH_ROW_TPL(kind=h(kind), link=h(link), title=h(title), meta=h(meta)))
+    if not items:
+        parts.append('<tr><td colspan="2" class="muted">Введите запрос.</td></tr>')
+    parts.append(_TABLE_FOOT)
 
-    body = f"""
+    parts[0] = f"""
     <div class="pagehead">
       <div>
         <h1>Поиск</h1>
@@ -3231,11 +4141,8 @@ def page_search(qd: Dict[str, str], flash: str = "") -> str:
     <table class="table">
       <thead><tr><th>Тип</th><th>Результат</th></tr></thead>
       <tbody>
-        {''.join(rows) if rows else '<tr><td colspan="2" class="muted">Введите запрос.</td></tr>'}
-      </tbody>
-    </table>
-    """
-    return render_layout("/search", "Поиск", "Поиск", body, flash=flash_box(flash))
+        """
+    return render_layout("/search", "Поиск", "Поиск", parts, flash=flash_box(flash))
 
 
 RU_MONTH_NAMES = {
@@ -3305,6 +4212,19 @@ def counterparty_names() -> List[str]:
     return [c.get("name", "") for c in STATE.counterparties if c.get("name")]
 
 
+def counterparty_options_html() -> str:
+    """<option> карточек контрагентов для редакторов документов (с пустым вариантом первым).
+    Собирается заново, только когда сменился кэшированный список контрагентов."""
+    counterparties = STATE.counterparties
+
+    def build() -> str:
+        return '<option value=""></option>' + "".join(
+            f'<option value="{h(n)}">{h(n)}</option>' for n in (c.get("name") for c in counterparties) if n
+        )
+
+    return STATE.render_memo("cp_options_html", counterparties, build)
+
+
 def party_from_counterparty(c: Dict[str, Any]) -> Dict[str, Any]:
     return {
         "name": c.get("name", ""),
@@ -3318,19 +4238,41 @@ def party_from_counterparty(c: Dict[str, Any]) -> Dict[str, Any]:
     }
 
 
+# Стили выгрузок в Excel неизменяемы: создаются один раз и переиспользуются всеми ячейками и файлами.
+# Функции, а не константы модуля, — openpyxl необязателен и может быть не установлен.
+@functools.lru_cache(maxsize=None)
+def _xl_font(bold: bool = False, size: Optional[int] = None):
+    return Font(bold=bold, size=size)
+
+
+@functools.lru_cache(maxsize=None)
+def _xl_align(horizontal: str, vertical: str = "top"):
+    return Alignment(horizontal=horizontal, vertical=vertical, wrap_text=True)
+
+
+@functools.lru_cache(maxsize=1)
+def _xl_thin_border():
+    thin = Side(style="thin", color="9E9E9E")
+    return Border(left=thin, right=thin, top=thin, bottom=thin)
+
+
+@functools.lru_cache(maxsize=1)
+def _xl_header_fill():
+    return PatternFill("solid", fgColor="E2EFDA")
+
+
 def build_act_excel(out_path: str, act: Dict[str, Any]):
     require_openpyxl()
     wb = Workbook()
     ws = wb.active
     ws.title = "Акт"
-    thin = Side(style="thin", color="9E9E9E")
-    border = Border(left=thin, right=thin, top=thin, bottom=thin)
+    border = _xl_thin_border()
 
     def set_cell(a1: str, value, bold=False, size=11, align="left"):
         c = ws[a1]
         c.value = value
-        c.font = Font(bold=bold, size=size)
-        c.alignment = Alignment(horizontal=align, vertical="top", wrap_text=True)
+        c.font = _xl_font(bold, size)
+        c.alignment = _xl_align(align)
         return c
 
     doc_no = act.get("doc_no", "")
@@ -3379,14 +4321,17 @@ def build_act_excel(out_path: str, act: Dict[str, Any]):
     for i, htxt in enumerate(headers, start=1):
         cell = ws.cell(row=start_row, column=i)
         cell.value = htxt
-        cell.font = Font(bold=True)
-        cell.alignment = Alignment(horizontal="center", vertical="center", wrap_text=True)
+        cell.font = _xl_font(True)
+        cell.alignment = _xl_align("center", "center")
         cell.border = border
-        cell.fill = PatternFill("solid", fgColor="E2EFDA")
+        cell.fill = _xl_header_fill()
 
     lines = act.get("lines", []) or []
     row = start_row + 1
     total = Decimal("0")
+    # Кол-во, цена и сумма — вправо, единица — по центру, остальное — влево
+    line_aligns = (None, _xl_align("left"), _xl_align("left"), _xl_align("right"),
+                   _xl_align("center"), _xl_align("right"), _xl_align("right"))
 
     for idx, ln in enumerate(lines, start=1):
         qty = decimal_from_str(ln.get("qty", 0))
@@ -3407,12 +4352,7 @@ def build_act_excel(out_path: str, act: Dict[str, Any]):
         for c, v in enumerate(values, start=1):
             cell = ws.cell(row=row, column=c, value=v)
             cell.border = border
-            if c in (3, 5, 6):
-                cell.alignment = Alignment(horizontal="right", vertical="top", wrap_text=True)
-            elif c == 4:
-                cell.alignment = Alignment(horizontal="center", vertical="top", wrap_text=True)
-            else:
-                cell.alignment = Alignment(horizontal="left", vertical="top", wrap_text=True)
+            cell.alignment = line_aligns[c]
         row += 1
 
     row += 1
@@ -3436,10 +4376,9 @@ def build_payment_order_excel(out_path: str, po: Dict[str, Any]):
     wb = Workbook()
     ws = wb.active
     ws.title = "Платежка"
-    thin = Side(style="thin", color="9E9E9E")
-    border = Border(left=thin, right=thin, top=thin, bottom=thin)
-    center = Alignment(horizontal="center", vertical="center", wrap_text=True)
-    left = Alignment(horizontal="left", vertical="center", wrap_text=True)
+    border = _xl_thin_border()
+    center = _xl_align("center", "center")
+    left = _xl_align("left", "center")
 
     def box(r1, c1, r2, c2):
         for rr in range(r1, r2 + 1):
@@ -3447,13 +4386,13 @@ def build_payment_order_excel(out_path: str, po: Dict[str, Any]):
                 ws.cell(row=rr, column=cc).border = border
 
     ws["A1"] = "ПЛАТЕЖНОЕ ПОРУЧЕНИЕ"
-    ws["A1"].font = Font(bold=True, size=13)
+    ws["A1"].font = _xl_font(True, 13)
     ws.merge_cells("A1:H1")
 
     ws["A3"] = f"№ {po.get('number','')}"
-    ws["A3"].font = Font(bold=True)
+    ws["A3"].font = _xl_font(True)
     ws["E3"] = po.get("date", "")
-    ws["E3"].font = Font(bold=True)
+    ws["E3"].font = _xl_font(True)
     ws["G3"] = po.get("pay_type", "Электронно")
 
     amt = decimal_from_str(po.get("amount", 0))
@@ -3536,22 +4475,19 @@ def _required_party_missing(p: Dict[str, Any]) -> List[str]:
     return [k for k in req if not (p.get(k) or "").strip()]
 
 
-def _act_lines_table(lines: List[Dict[str, Any]]) -> str:
-    rows = []
-    for i, ln in enumerate(lines):
-        rows.append(f"""
+# Редактор акта: шаблон строки услуги и скрипт таблицы не зависят от данных — разбираются один раз
+_ACT_LINE_ROW_TPL = """
         <tr>
-          <td class="center">{i+1}</td>
-          <td><input name="ln_name_{i}" value="{h(str(ln.get('name','')))}" style="width:100%"/></td>
-          <td><input name="ln_qty_{i}" value="{h(str(ln.get('qty','1')))}" style="width:100%;text-align:right"/></td>
-          <td><input name="ln_unit_{i}" value="{h(str(ln.get('unit','шт')))}" style="width:100%;text-align:center"/></td>
-          <td><input name="ln_price_{i}" value="{h(str(ln.get('price','0')))}" style="width:100%;text-align:right"/></td>
-          <td><input name="ln_amount_{i}" value="{h(str(ln.get('amount','')))}" style="width:100%;text-align:right" placeholder="авто"/></td>
+          <td class="center">{num}</td>
+          <td><input name="ln_name_{i}" value="{name}" style="width:100%"/></td>
+          <td><input name="ln_qty_{i}" value="{qty}" style="width:100%;text-align:right"/></td>
+          <td><input name="ln_unit_{i}" value="{unit}" style="width:100%;text-align:center"/></td>
+          <td><input name="ln_price_{i}" value="{price}" style="width:100%;text-align:right"/></td>
+          <td><input name="ln_amount_{i}" value="{amount}" style="width:100%;text-align:right" placeholder="авто"/></td>
           <td class="center"><button class="btn small danger" type="button" onclick="removeLine(this)">×</button></td>
         </tr>
-        """)
-
-    js = r"""
+        """.format
+_ACT_LINES_JS = r"""
 <script>
 function addLine(){
   const tbody = document.getElementById("linesBody");
@@ -3593,6 +4529,16 @@ function renumber(){
 window.addEventListener("load", ()=>{ renumber(); });
 </script>
 """
+
+
+def _act_lines_table(lines: List[Dict[str, Any]]) -> str:
+    rows = []
+    for i, ln in enumerate(lines):
+        get = ln.get
+        rows.append(_ACT_LINE_ROW_TPL(
+            num=i+1, i=i, name=h(str(get("name", ""))), qty=h(str(get("qty", "1"))),
+            unit=h(str(get("unit", "шт"))), price=h(str(get("price", "0"))), amount=h(str(get("amount", ""))),
+        ))
     return f"""
     <input type="hidden" id="linesCount" name="lines_count" value="{len(lines)}"/>
     <table class="table">
@@ -3613,53 +4559,12 @@ window.addEventListener("load", ()=>{ renumber(); });
       <button class="btn small" type="button" onclick="addLine()">+ Добавить строку</button>
       <span class="smallnote">Если «Сумма» пустая — будет посчитана как Кол-во × Цена.</span>
     </div>
-    {js}
+    {_ACT_LINES_JS}
     """
 
 
-def page_acts(path: str, flash: str = "") -> str:
-    our = STATE.get_our_company_card()
-    our_name = norm_text(our.get("name", "")) if our else OUR_COMPANY_DEFAULT_NAME.upper()
-    rows = []
-    for a in STATE.acts:
-        aid = a.get("id", "")
-        lines = a.get("lines", []) or []
-        total = Decimal("0")
-        for ln in lines:
-            amount = decimal_from_str(ln.get("amount", 0))
-            if amount == 0:
-                qty = decimal_from_str(ln.get("qty", 0))
-                price = decimal_from_str(ln.get("price", 0))
-                amount = money2(qty * price)
-            total += amount
-        direction = a.get("direction", "provide")
-        executor = a.get("executor", {}) or {}
-        customer = a.get("customer", {}) or {}
-        other = ""
-        if norm_text(executor.get("name", "")) == our_name:
-            other = customer.get("name", "")
-        elif norm_text(customer.get("name", "")) == our_name:
-            other = executor.get("name", "")
-        else:
-            other = customer.get("name", "") or executor.get("name", "")
-        rows.append(f"""
-        <tr>
-          <td class="center">{h(a.get("doc_no",""))}</td>
-          <td class="center">{h(a.get("doc_date",""))}</td>
-          <td>{"Оказание услуг" if direction=="provide" else "Получение услуг"}</td>
-          <td>{h(other)}</td>
-          <td class="right">{h(fmt_money(total)) if total else ""}</td>
-          <td class="center" style="white-space:nowrap">
-            <a class="btn small" href="/acts/edit?id={h(aid)}">Открыть</a>
-            <a class="btn small" href="/action/acts/export?id={h(aid)}">Excel</a>
-            <form method="POST" action="/action/acts/delete" style="display:inline;margin:0">
-              <input type="hidden" name="id" value="{h(aid)}"/>
-              <button class="btn small danger" type="submit">Удалить</button>
-            </form>
-          </td>
-        </tr>
-        """)
-    body = f"""
+# Список актов: шапка страницы и шаблон строки разбираются один раз при импорте
+_ACTS_PAGE_HEAD = """
     <div class="pagehead">
       <div>
         <h1>Акты / накладные</h1>
@@ -3681,89 +4586,178 @@ def page_acts(path: str, flash: str = "") -> str:
         </tr>
       </thead>
       <tbody>
-        {''.join(rows) if rows else '<tr><td colspan="6" class="muted">Документов нет. Создайте акт.</td></tr>'}
-      </tbody>
-    </table>
-    """
-    return render_layout("/acts", "Акты", "Документы → Акты / накладные", body, flash=flash_box(flash))
+        """
+_ACT_ROW_TPL = """
+        <tr>
+          <td class="center">{doc_no}</td>
+          <td class="center">{doc_date}</td>
+          <td>{kind}</td>
+          <td>{other}</td>
+          <td class="right">{total}</td>
+          <td class="center" style="white-space:nowrap">
+            <a class="btn small" href="/acts/edit?id={aid}">Открыть</a>
+            <a class="btn small" href="/action/acts/export?id={aid}">Excel</a>
+            <form method="POST" action="/action/acts/delete" style="display:inline;margin:0">
+              <input type="hidden" name="id" value="{aid}"/>
+              <button class="btn small danger" type="submit">Удалить</button>
+            </form>
+          </td>
+        </tr>
+        """.format
 
 
-def page_act_editor(mode: str, qd: Dict[str, str], flash: str = "") -> str:
-    if mode == "edit":
-        aid = (qd.get("id") or "").strip()
-        act = STATE.get_act_by_id(aid)
-        if not act:
-            return render_layout("/acts", "Акт", "Документы → Акты", "<h1>Документ не найден</h1><a class='btn' href='/acts'>Назад</a>", flash=flash_box(flash))
-        init = act.copy()
+def page_acts(path: str, flash: str = "") -> str:
+    return "".join(page_acts_chunks(path, flash))
+
+
+# Строки списка актов отдаются клиенту пачками по столько штук
+ACTS_STREAM_ROWS = 50
+
+
+def page_acts_chunks(path: str, flash: str = "") -> Iterator[str]:
+    """Список актов кусками для serve_stream: одна пачка актов из базы (iter_act_batches) — один кусок.
+    Первый кусок собирается уже после первой пачки, так что ошибка запроса ещё становится ответом 500;
+    ошибка на следующих пачках закрывает таблицу строкой с предупреждением вместо обрыва страницы."""
+    our = STATE.get_our_company_card()
+    our_name = norm_text(our.get("name", "")) if our else OUR_COMPANY_DEFAULT_NAME.upper()
+    head, tail = _layout_parts("/acts", "Акты", "Документы → Акты / накладные", flash_box(flash))
+    parts: List[str] = [head, _ACTS_PAGE_HEAD]
+    count = 0
+    batches = STATE.iter_act_batches(ACTS_STREAM_ROWS)
+    while True:
+        try:
+            batch = next(batches, None)
+        except Exception:
+            if not count:
+                raise
+            traceback.print_exc()
+            parts.append('<tr><td colspan="6" class="muted">Не удалось загрузить список полностью — обновите страницу.</td></tr>')
+            break
+        if batch is None:
+            break
+        for a in batch:
+            parts.append(_act_row_html(a, our_name))
+        count += len(batch)
+        yield "".join(parts)
+        parts = []
+    if not count:
+        parts.append('<tr><td colspan="6" class="muted">Документов нет. Создайте акт.</td></tr>')
+    parts.append(_TABLE_FOOT)
+    parts.append(tail)
+    yield "".join(parts)
+
+
+def _act_row_html(a: Dict[str, Any], our_name: str) -> str:
+    aid = a.get("id", "")
+    lines = a.get("lines", []) or []
+    total = Decimal("0")
+    for ln in lines:
+        amount = decimal_from_str(ln.get("amount", 0))
+        if amount == 0:
+            qty = decimal_from_str(ln.get("qty", 0))
+            price = decimal_from_str(ln.get("price", 0))
+            amount = money2(qty * price)
+        total += amount
+    direction = a.get("direction", "provide")
+    executor = a.get("executor", {}) or {}
+    customer = a.get("customer", {}) or {}
+    other = ""
+    if norm_text(executor.get("name", "")) == our_name:
+        other = customer.get("name", "")
+    elif norm_text(customer.get("name", "")) == our_name:
+        other = executor.get("name", "")
     else:
-        init = {
-            "id": new_id(),
-            "doc_no": "",
-            "doc_date": format_ddmmyyyy(date.today()),
-            "direction": "provide",
-            "executor": {},
-            "customer": {},
-            "basis": "",
-            "vat_mode": "Без налога (НДС)",
-            "lines": [{"name": "", "qty": "1", "unit": "шт", "price": "0", "amount": ""}],
-        }
-        our = STATE.get_our_company_card()
-        if our:
-            init["executor"] = party_from_counterparty(our)
+        other = customer.get("name", "") or executor.get("name", "")
+    return _ACT_ROW_TPL(
+        doc_no=h(a.get("doc_no","")), doc_date=h(a.get("doc_date","")),
+        kind="Оказание услуг" if direction=="provide" else "Получение услуг",
+        other=h(other), total=fmt_money(total) if total else "", aid=h(aid),
+    )
 
-    direction = init.get("direction", "provide")
-    basis_cur = init.get("basis", "") or ""
-    basis_opts = ['<option value=""></option>'] + [f'<option value="{h(x)}">{h(x)}</option>' for x in STATE.basis_history[-60:]]
 
-    def party_block(prefix: str, title: str, data: Dict[str, Any]) -> str:
-        names = counterparty_names()
-        options = ['<option value=""></option>'] + [f'<option value="{h(n)}">{h(n)}</option>' for n in names]
-        return f"""
+# Блок стороны акта (исполнитель/заказчик): шаблон разбирается один раз, подставляются только значения
+_PARTY_BLOCK_FIELDS = ("name", "inn", "kpp", "account", "bank", "bik", "corr", "address")
+_PARTY_BLOCK_TPL = """
         <div class="panel">
           <div style="display:flex;justify-content:space-between;align-items:center;gap:10px">
-            <div><b>{h(title)}</b></div>
+            <div><b>{title}</b></div>
             <div style="display:flex;gap:8px;align-items:center">
-              <select name="{prefix}_card" style="max-width:260px">{''.join(options)}</select>
+              <select name="{prefix}_card" style="max-width:260px">{options}</select>
               <button class="btn small" name="_apply_card" value="{prefix}" type="submit">Подставить</button>
             </div>
           </div>
           <div class="hr"></div>
           <div class="smallnote"><b>Наименование*</b></div>
-          <input name="{prefix}_name" value="{h(data.get('name',''))}" style="width:100%;padding:10px;border:1px solid #D7D7D7;border-radius:12px"/>
+          <input name="{prefix}_name" value="{name}" style="width:100%;padding:10px;border:1px solid #D7D7D7;border-radius:12px"/>
           <div style="display:grid;grid-template-columns:1fr 1fr;gap:12px;margin-top:10px">
             <div>
               <div class="smallnote"><b>ИНН*</b></div>
-              <input name="{prefix}_inn" value="{h(data.get('inn',''))}" style="width:100%;padding:10px;border:1px solid #D7D7D7;border-radius:12px"/>
+              <input name="{prefix}_inn" value="{inn}" style="width:100%;padding:10px;border:1px solid #D7D7D7;border-radius:12px"/>
             </div>
             <div>
               <div class="smallnote"><b>КПП</b></div>
-              <input name="{prefix}_kpp" value="{h(data.get('kpp',''))}" style="width:100%;padding:10px;border:1px solid #D7D7D7;border-radius:12px"/>
+              <input name="{prefix}_kpp" value="{kpp}" style="width:100%;padding:10px;border:1px solid #D7D7D7;border-radius:12px"/>
             </div>
           </div>
           <div style="margin-top:10px">
             <div class="smallnote"><b>р/с*</b></div>
-            <input name="{prefix}_account" value="{h(data.get('account',''))}" style="width:100%;padding:10px;border:1px solid #D7D7D7;border-radius:12px"/>
+            <input name="{prefix}_account" value="{account}" style="width:100%;padding:10px;border:1px solid #D7D7D7;border-radius:12px"/>
           </div>
           <div style="margin-top:10px">
             <div class="smallnote"><b>Банк*</b></div>
-            <input name="{prefix}_bank" value="{h(data.get('bank',''))}" style="width:100%;padding:10px;border:1px solid #D7D7D7;border-radius:12px"/>
+            <input name="{prefix}_bank" value="{bank}" style="width:100%;padding:10px;border:1px solid #D7D7D7;border-radius:12px"/>
           </div>
           <div style="display:grid;grid-template-columns:1fr 1fr;gap:12px;margin-top:10px">
             <div>
               <div class="smallnote"><b>БИК*</b></div>
-              <input name="{prefix}_bik" value="{h(data.get('bik',''))}" style="width:100%;padding:10px;border:1px solid #D7D7D7;border-radius:12px"/>
+              <input name="{prefix}_bik" value="{bik}" style="width:100%;padding:10px;border:1px solid #D7D7D7;border-radius:12px"/>
             </div>
             <div>
               <div class="smallnote"><b>к/с</b></div>
-              <input name="{prefix}_corr" value="{h(data.get('corr',''))}" style="width:100%;padding:10px;border:1px solid #D7D7D7;border-radius:12px"/>
+              <input name="{prefix}_corr" value="{corr}" style="width:100%;padding:10px;border:1px solid #D7D7D7;border-radius:12px"/>
             </div>
           </div>
           <div style="margin-top:10px">
             <div class="smallnote"><b>Адрес</b></div>
-            <input name="{prefix}_address" value="{h(data.get('address',''))}" style="width:100%;padding:10px;border:1px solid #D7D7D7;border-radius:12px"/>
+            <input name="{prefix}_address" value="{address}" style="width:100%;padding:10px;border:1px solid #D7D7D7;border-radius:12px"/>
           </div>
         </div>
-        """
+        """.format
+
+
+def page_act_editor(mode: str, qd: Dict[str, str], flash: str = "") -> str:
+    if mode == "edit":
+        aid = (qd.get("id") or "").strip()
+        act = STATE.get_act_by_id(aid)
+        if not act:
+            return render_layout("/acts", "Акт", "Документы → Акты", "<h1>Документ не найден</h1><a class='btn' href='/acts'>Назад</a>", flash=flash_box(flash))
+        init = act.copy()
+    else:
+        init = {
+            "id": new_id(),
+            "doc_no": "",
+            "doc_date": format_ddmmyyyy(date.today()),
+            "direction": "provide",
+            "executor": {},
+            "customer": {},
+            "basis": "",
+            "vat_mode": "Без налога (НДС)",
+            "lines": [{"name": "", "qty": "1", "unit": "шт", "price": "0", "amount": ""}],
+        }
+        our = STATE.get_our_company_card()
+        if our:
+            init["executor"] = party_from_counterparty(our)
+
+    direction = init.get("direction", "provide")
+    basis_cur = init.get("basis", "") or ""
+    basis_opts = ['<option value=""></option>'] + [f'<option value="{h(x)}">{h(x)}</option>' for x in STATE.basis_history[-60:]]
+
+    card_options = counterparty_options_html()
+
+    def party_block(prefix: str, title: str, data: Dict[str, Any]) -> str:
+        get = data.get
+        return _PARTY_BLOCK_TPL(prefix=prefix, title=h(title), options=card_options,
+                                **{f: h(get(f, "")) for f in _PARTY_BLOCK_FIELDS})
 
     body = f"""
     <div class="pagehead">
@@ -3842,7 +4836,7 @@ def page_act_editor(mode: str, qd: Dict[str, str], flash: str = "") -> str:
 
 def page_payments(path: str, flash: str = "") -> str:
     rows = []
-    for po in STATE.payment_orders:
+    for po in STATE.iter_payment_orders():
         poid = po.get("id", "")
         amt = decimal_from_str(po.get("amount", 0))
         receiver = po.get("receiver", {}) or {}
@@ -3895,7 +4889,7 @@ def page_payments(path: str, flash: str = "") -> str:
 def page_payment_editor(mode: str, qd: Dict[str, str], flash: str = "") -> str:
     if mode == "edit":
         poid = (qd.get("id") or "").strip()
-        po = next((p for p in STATE.payment_orders if p.get("id") == poid), None)
+        po = STATE.get_payment_order_by_id(poid)
         if not po:
             return render_layout("/payments", "Платёжка", "Документы → Платёжки", "<h1>Документ не найден</h1><a class='btn' href='/payments'>Назад</a>", flash=flash_box(flash))
         init = po.copy()
@@ -3921,14 +4915,12 @@ def page_payment_editor(mode: str, qd: Dict[str, str], flash: str = "") -> str:
     receiver = init.get("receiver", {}) or {}
 
     def party_block(prefix: str, title: str, data: Dict[str, Any]) -> str:
-        names = counterparty_names()
-        options = ['<option value=""></option>'] + [f'<option value="{h(n)}">{h(n)}</option>' for n in names]
         return f"""
         <div class="panel" style="margin-bottom:12px">
           <div style="display:flex;justify-content:space-between;align-items:center;gap:10px">
             <div><b>{h(title)}</b></div>
             <div style="display:flex;gap:8px;align-items:center">
-              <select name="{prefix}_card" style="max-width:260px">{''.join(options)}</select>
+              <select name="{prefix}_card" style="max-width:260px">{counterparty_options_html()}</select>
               <button class="btn small" name="_apply_card" value="{prefix}" type="submit">Подставить</button>
             </div>
           </div>
@@ -4035,7 +5027,7 @@ def page_salary(path: str, flash: str = "") -> str:
         po_id = sp.get("payment_order_id", "")
         po_link = ""
         if po_id:
-            po = next((p for p in STATE.payment_orders if p.get("id") == po_id), None)
+            po = STATE.get_payment_order_by_id(po_id)
             if po:
                 po_num = po.get("number", "") or "б/н"
                 po_link = f"<a href='/payments/edit?id={h(po_id)}'>{h(po_num)}</a>"
@@ -4253,7 +5245,7 @@ def parse_upd_html(path: str) -> Dict[str, Any]:
 
 def page_upd(path: str, flash: str = "") -> str:
     rows = []
-    for r in STATE.upd_rows:
+    for r in STATE.iter_upd_rows():
         rid = r.get("id", "")
         amt = decimal_from_str(r.get("amount") or 0)
         rows.append(f"""
@@ -4294,7 +5286,7 @@ def page_upd(path: str, flash: str = "") -> str:
 
 def page_realization(path: str, flash: str = "") -> str:
     rows = []
-    for r in STATE.real_rows:
+    for r in STATE.iter_real_rows():
         amt = decimal_from_str(r.get("amount") or 0)
         rows.append(f"""
         <tr>
@@ -4326,8 +5318,8 @@ def calc_op_profit(start: Optional[date], end: Optional[date]) -> Tuple[str, Lis
         d = parse_date_ddmmyyyy(r.get("date", ""))
         if not in_range(d, start, end):
             continue
-        inc = Decimal(str(r.get("incoming") or 0))
-        out = Decimal(str(r.get("outgoing") or 0))
+        inc = _as_decimal(r.get("incoming"))
+        out = _as_decimal(r.get("outgoing"))
         if out > 0 and bool(r.get("skip_outgoing", False)):
             continue
         cat = norm_category(r.get("category") or "")
@@ -4412,15 +5404,15 @@ def page_op_profit_details(path: str, qd: Dict[str, str], flash: str = "") -> st
         d = parse_date_ddmmyyyy(r.get("date", ""))
         if not in_range(d, start, end):
             continue
-        inc = Decimal(str(r.get("incoming") or 0))
-        out = Decimal(str(r.get("outgoing") or 0))
+        inc = _as_decimal(r.get("incoming"))
+        out = _as_decimal(r.get("outgoing"))
         if out > 0 and bool(r.get("skip_outgoing", False)):
             continue
         ops.append(r)
     tr = []
     for r in ops:
-        inc = Decimal(str(r.get("incoming") or 0))
-        out = Decimal(str(r.get("outgoing") or 0))
+        inc = _as_decimal(r.get("incoming"))
+        out = _as_decimal(r.get("outgoing"))
         tr.append(f"""
         <tr>
           <td class="center">{h(r.get("date",""))}</td>
@@ -4455,8 +5447,8 @@ def calc_recon(counterparty_name: str, start: date, end: date) -> Tuple[str, Lis
         cp = norm_text(r.get("counterparty", ""))
         if not cp or not (cp_norm in cp or cp in cp_norm):
             continue
-        inc = Decimal(str(r.get("incoming") or 0))
-        out = Decimal(str(r.get("outgoing") or 0))
+        inc = _as_decimal(r.get("incoming"))
+        out = _as_decimal(r.get("outgoing"))
         if out > 0 and bool(r.get("skip_outgoing", False)):
             continue
         if inc > 0:
@@ -4539,8 +5531,8 @@ def calc_kudir(start: date, end: date) -> Tuple[str, List[Dict[str, Any]], Dict[
         d = parse_date_ddmmyyyy(r.get("date", ""))
         if not in_range(d, start, end):
             continue
-        inc = Decimal(str(r.get("incoming") or 0))
-        out = Decimal(str(r.get("outgoing") or 0))
+        inc = _as_decimal(r.get("incoming"))
+        out = _as_decimal(r.get("outgoing"))
         if out > 0 and bool(r.get("skip_outgoing", False)):
             continue
         if inc == 0 and out == 0:
@@ -4782,7 +5774,7 @@ def calc_income_for_period(start: date, end: date) -> Decimal:
         d = parse_date_ddmmyyyy(r.get("date", ""))
         if not d or not (start <= d <= end):
             continue
-        inc = Decimal(str(r.get("incoming") or 0))
+        inc = _as_decimal(r.get("incoming"))
         if inc > 0:
             income += inc
             category = (r.get("category") or "").lower()
@@ -4793,7 +5785,7 @@ def calc_income_for_period(start: date, end: date) -> Decimal:
         d = parse_date_ddmmyyyy(r.get("date", ""))
         if not d or not (start <= d <= end):
             continue
-        amt = Decimal(str(r.get("amount") or 0))
+        amt = _as_decimal(r.get("amount"))
         if amt > 0:
             income += amt
     return money2(income)
@@ -4804,7 +5796,7 @@ def calc_usn(start: Optional[date], end: Optional[date], tax_1_percent: bool = F
         d = parse_date_ddmmyyyy(r.get("date", ""))
         if start and end and (not d or not (start <= d <= end)):
             continue
-        inc = Decimal(str(r.get("incoming") or 0))
+        inc = _as_decimal(r.get("incoming"))
         if inc > 0:
             income += inc
             category = (r.get("category") or "").lower()
@@ -4815,7 +5807,7 @@ def calc_usn(start: Optional[date], end: Optional[date], tax_1_percent: bool = F
         d = parse_date_ddmmyyyy(r.get("date", ""))
         if start and end and (not d or not (start <= d <= end)):
             continue
-        amt = Decimal(str(r.get("amount") or 0))
+        amt = _as_decimal(r.get("amount"))
         if amt > 0:
             income += amt
     usn_6 = money2(income * Decimal("0.06")) if income > 0 else Decimal("0.00")
@@ -4971,7 +5963,7 @@ def application(environ, start_response):
                 ctype = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
             elif ext == ".pdf":
                 ctype = "application/pdf"
-            return serve_file_download(start_response, fpath, ctype)
+            return serve_file_download(environ, start_response, fpath, ctype)
 
         if path == "/action/save" and method == "POST":
             STATE.save()
@@ -4984,13 +5976,9 @@ def application(environ, start_response):
                 return redirect("/bank?m=" + urlencode({"m": "Файл не выбран."})[2:], start_response)
 
             filename = getattr(item, "filename", "") or "bank.txt"
-            data = item.file.read() if getattr(item, "file", None) is not None else b""
-            if not data:
-                return redirect("/bank?m=" + urlencode({"m": "Файл пустой или не прочитан."})[2:], start_response)
-
             tmp = os.path.join(DOWNLOAD_DIR, f"upload_{int(time.time())}_{safe_filename(filename)}")
-            with open(tmp, "wb") as f:
-                f.write(data)
+            if not save_upload(item, tmp):
+                return redirect("/bank?m=" + urlencode({"m": "Файл пустой или не прочитан."})[2:], start_response)
 
             new_rows = parse_client_bank_file(tmp)
             
@@ -5008,12 +5996,15 @@ def application(environ, start_response):
             existing_fp = set(bank_row_fingerprint(x) for x in STATE.bank_rows)
             new_fp = [bank_row_fingerprint(x) for x in new_rows]
             
-            added = 0
+            to_add = []
+            new_cps: List[Dict[str, Any]] = []
             for r, fp in zip(new_rows, new_fp):
                 if fp not in existing_fp:
-                    STATE.auto_upsert_counterparty_from_bank_row(r)
-                    STATE.add_bank_row(r)
-                    added += 1
+                    STATE.auto_upsert_counterparty_from_bank_row(r, new_cps)
+                    to_add.append(r)
+            STATE.add_counterparties_if_absent(new_cps)
+            STATE.add_bank_rows(to_add)
+            added = len(to_add)
 
             STATE.sanitize_names_and_inn()
             STATE.save()
@@ -5109,13 +6100,9 @@ def application(environ, start_response):
                 return redirect("/bank?m=" + urlencode({"m": "Файл не выбран."})[2:], start_response)
 
             filename = getattr(item, "filename", "") or "map.xlsx"
-            data = item.file.read() if getattr(item, "file", None) is not None else b""
-            if not data:
-                return redirect("/bank?m=" + urlencode({"m": "Файл пустой или не прочитан."})[2:], start_response)
-
             tmp = os.path.join(DOWNLOAD_DIR, f"cpmap_{int(time.time())}_{safe_filename(filename)}")
-            with open(tmp, "wb") as f:
-                f.write(data)
+            if not save_upload(item, tmp):
+                return redirect("/bank?m=" + urlencode({"m": "Файл пустой или не прочитан."})[2:], start_response)
 
             mp = load_counterparty_category_map(tmp)
             STATE.cp_category_map = mp
@@ -5132,8 +6119,8 @@ def application(environ, start_response):
                 w = csv.writer(f, delimiter=";")
                 w.writerow(["Не учитывать", "Дата", "Месяц", "Поступление", "Списание", "Статья", "Назначение", "Контрагент", "Вид операции"])
                 for r in bank_rows:
-                    inc = Decimal(str(r.get("incoming") or 0))
-                    out = Decimal(str(r.get("outgoing") or 0))
+                    inc = _as_decimal(r.get("incoming"))
+                    out = _as_decimal(r.get("outgoing"))
                     w.writerow([
                         "1" if r.get("skip_outgoing", False) else "",
                         r.get("date", ""), r.get("month", ""),
@@ -5195,8 +6182,7 @@ def application(environ, start_response):
                 upload = get_upload(form, "file")
                 if upload:
                     tmp_path = os.path.join(DOWNLOAD_DIR, f"mp_{new_id()}_{safe_filename(upload.filename)}")
-                    with open(tmp_path, "wb") as f:
-                        f.write(upload.file.read())
+                    save_upload(upload, tmp_path)
                     if platform.lower() == "ozon":
                         amount = parse_ozon_excel_total(tmp_path)
                     else:
@@ -5209,15 +6195,11 @@ def application(environ, start_response):
             period_label = get_period_label(period_type, year, quarter, month)
             date_start, date_end = get_period_dates(period_type, year, quarter, month)
             
-            conn = get_db_connection()
-            cur = conn.cursor()
-            cur.execute("""
-                INSERT INTO marketplace_rows (id, platform, period_type, period_label, year, quarter, month, date_start, date_end, amount)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-            """, (new_id(), platform, period_type, period_label, year, quarter, month, date_start, date_end, amount))
-            conn.commit()
-            cur.close()
-            return_db_connection(conn)
+            STATE.add_marketplace_row({
+                "id": new_id(), "platform": platform, "period_type": period_type, "period_label": period_label,
+                "year": year, "quarter": quarter, "month": month,
+                "date_start": date_start, "date_end": date_end, "amount": amount,
+            })
             
             msg = f"Добавлено поступление {platform}: {fmt_money(amount)}"
             return redirect("/marketplace?m=" + urlencode({"m": msg})[2:], start_response)
@@ -5226,12 +6208,7 @@ def application(environ, start_response):
             form = parse_post_form(environ)
             rid = (form.get("id") or "").strip()
             if rid:
-                conn = get_db_connection()
-                cur = conn.cursor()
-                cur.execute("DELETE FROM marketplace_rows WHERE id = %s", (rid,))
-                conn.commit()
-                cur.close()
-                return_db_connection(conn)
+                STATE.delete_marketplace_row(rid)
             return redirect("/marketplace?m=" + urlencode({"m": "Запись удалена."})[2:], start_response)
 
         if path == "/action/cp/save" and method == "POST":
@@ -5294,46 +6271,49 @@ def application(environ, start_response):
                 STATE.save()
             return redirect("/counterparties?m=" + urlencode({"m": "Контрагент удалён."})[2:], start_response)
 
+        if path == "/static/base.css":
+            return serve_base_css(environ, start_response)
+
         if path == "/health":
             start_response("200 OK", [("Content-Type", "text/plain")])
             return [b"OK"]
 
         if path == "/" or path == "":
             html = '<!DOCTYPE html><html><head><meta http-equiv="refresh" content="0;url=/bank"></head><body>Redirecting...</body></html>'
-            return serve_text(start_response, html)
+            return serve_text(environ, start_response, html)
 
         if path == "/bank" and method == "GET":
-            return serve_text(start_response, page_bank("/bank", qd=qd, flash=qd.get("m","") or ""))
+            return serve_stream(environ, start_response, page_bank_chunks("/bank", qd=qd, flash=qd.get("m","") or ""))
 
         if path == "/bank/assign" and method == "GET":
-            return serve_text(start_response, page_bank_assign("/bank", qd, flash=qd.get("m","") or ""))
+            return serve_text(environ, start_response, page_bank_assign("/bank", qd, flash=qd.get("m","") or ""))
 
         if path == "/cash" and method == "GET":
-            return serve_text(start_response, page_cash("/cash", flash=qd.get("m","") or ""))
+            return serve_text(environ, start_response, page_cash("/cash", flash=qd.get("m","") or ""))
 
         if path == "/cash/new" and method == "GET":
-            return serve_text(start_response, page_cash_form("/cash", {}, flash=qd.get("m","") or ""))
+            return serve_text(environ, start_response, page_cash_form("/cash", {}, flash=qd.get("m","") or ""))
 
         if path == "/cash/edit" and method == "GET":
-            return serve_text(start_response, page_cash_form("/cash", qd, flash=qd.get("m","") or ""))
+            return serve_text(environ, start_response, page_cash_form("/cash", qd, flash=qd.get("m","") or ""))
 
         if path == "/marketplace" and method == "GET":
-            return serve_text(start_response, page_marketplace("/marketplace", flash=qd.get("m","") or ""))
+            return serve_text(environ, start_response, page_marketplace("/marketplace", flash=qd.get("m","") or ""))
 
         if path == "/marketplace/add" and method == "GET":
-            return serve_text(start_response, page_marketplace_add("/marketplace", qd, flash=qd.get("m","") or ""))
+            return serve_text(environ, start_response, page_marketplace_add("/marketplace", qd, flash=qd.get("m","") or ""))
 
         if path == "/counterparties" and method == "GET":
-            return serve_text(start_response, page_counterparties("/counterparties", flash=qd.get("m","") or ""))
+            return serve_text(environ, start_response, page_counterparties("/counterparties", flash=qd.get("m","") or ""))
 
         if path == "/counterparties/new" and method == "GET":
-            return serve_text(start_response, page_counterparty_new(flash=qd.get("m","") or ""))
+            return serve_text(environ, start_response, page_counterparty_new(flash=qd.get("m","") or ""))
 
         if path == "/counterparties/edit" and method == "GET":
-            return serve_text(start_response, page_counterparty_edit(qd, flash=qd.get("m","") or ""))
+            return serve_text(environ, start_response, page_counterparty_edit(qd, flash=qd.get("m","") or ""))
 
         if path == "/search" and method == "GET":
-            return serve_text(start_response, page_search(qd, flash=qd.get("m","") or ""))
+            return serve_text(environ, start_response, page_search(qd, flash=qd.get("m","") or ""))
 
         if path == "/action/acts/save" and method == "POST":
             form = parse_post_form(environ)
@@ -5394,7 +6374,7 @@ def application(environ, start_response):
             
             existing = STATE.get_act_by_id(aid)
             if existing:
-                STATE.update_act(aid, act)
+                STATE.update_act(aid, act, existing)
             else:
                 STATE.add_act(act)
             if basis:
@@ -5453,7 +6433,7 @@ def application(environ, start_response):
                 "vid_op": (form.get("vid_op") or "01").strip(),
                 "ocher": (form.get("ocher") or "5").strip(),
             }
-            existing_po = next((p for p in STATE.payment_orders if p.get("id") == poid), None)
+            existing_po = STATE.get_payment_order_by_id(poid)
             if existing_po:
                 STATE.delete_payment_order(poid)
             STATE.add_payment_order(po)
@@ -5470,7 +6450,7 @@ def application(environ, start_response):
 
         if path == "/action/payments/export" and method == "GET":
             poid = (qd.get("id") or "").strip()
-            po = next((p for p in STATE.payment_orders if p.get("id") == poid), None)
+            po = STATE.get_payment_order_by_id(poid)
             if not po:
                 return redirect("/payments?m=" + urlencode({"m": "Платёжка не найдена."})[2:], start_response)
             token = f"payment_{poid}_{int(time.time())}.xlsx"
@@ -5616,12 +6596,9 @@ def application(environ, start_response):
             if item is None:
                 return redirect("/upd?m=" + urlencode({"m": "Файл не выбран."})[2:], start_response)
             filename = getattr(item, "filename", "") or "upd.html"
-            data = item.file.read() if getattr(item, "file", None) else b""
-            if not data:
-                return redirect("/upd?m=" + urlencode({"m": "Файл пустой."})[2:], start_response)
             tmp = os.path.join(DOWNLOAD_DIR, f"upd_{int(time.time())}_{safe_filename(filename)}")
-            with open(tmp, "wb") as f:
-                f.write(data)
+            if not save_upload(item, tmp):
+                return redirect("/upd?m=" + urlencode({"m": "Файл пустой."})[2:], start_response)
             try:
                 upd_row = parse_upd_html(tmp)
                 STATE.add_upd_row(upd_row)
@@ -5653,44 +6630,47 @@ def application(environ, start_response):
             return redirect("/download/" + token, start_response)
 
         if path == "/acts" and method == "GET":
-            return serve_text(start_response, page_acts("/acts", flash=qd.get("m","") or ""))
+            return serve_stream(environ, start_response, page_acts_chunks("/acts", flash=qd.get("m","") or ""))
         if path == "/acts/new" and method == "GET":
-            return serve_text(start_response, page_act_editor("new", qd, flash=qd.get("m","") or ""))
+            return serve_text(environ, start_response, page_act_editor("new", qd, flash=qd.get("m","") or ""))
         if path == "/acts/edit" and method == "GET":
-            return serve_text(start_response, page_act_editor("edit", qd, flash=qd.get("m","") or ""))
+            return serve_text(environ, start_response, page_act_editor("edit", qd, flash=qd.get("m","") or ""))
         if path == "/payments" and method == "GET":
-            return serve_text(start_response, page_payments("/payments", flash=qd.get("m","") or ""))
+            return serve_text(environ, start_response, page_payments("/payments", flash=qd.get("m","") or ""))
         if path == "/payments/new" and method == "GET":
-            return serve_text(start_response, page_payment_editor("new", qd, flash=qd.get("m","") or ""))
+            return serve_text(environ, start_response, page_payment_editor("new", qd, flash=qd.get("m","") or ""))
         if path == "/payments/edit" and method == "GET":
-            return serve_text(start_response, page_payment_editor("edit", qd, flash=qd.get("m","") or ""))
+            return serve_text(environ, start_response, page_payment_editor("edit", qd, flash=qd.get("m","") or ""))
         if path == "/salary" and method == "GET":
-            return serve_text(start_response, page_salary("/salary", flash=qd.get("m","") or ""))
+            return serve_text(environ, start_response, page_salary("/salary", flash=qd.get("m","") or ""))
         if path == "/salary/emp-new" and method == "GET":
-            return serve_text(start_response, page_employee_editor("new", qd, flash=qd.get("m","") or ""))
+            return serve_text(environ, start_response, page_employee_editor("new", qd, flash=qd.get("m","") or ""))
         if path == "/salary/emp-edit" and method == "GET":
-            return serve_text(start_response, page_employee_editor("edit", qd, flash=qd.get("m","") or ""))
+            return serve_text(environ, start_response, page_employee_editor("edit", qd, flash=qd.get("m","") or ""))
         if path == "/upd" and method == "GET":
-            return serve_text(start_response, page_upd("/upd", flash=qd.get("m","") or ""))
+            return serve_text(environ, start_response, page_upd("/upd", flash=qd.get("m","") or ""))
         if path == "/realization" and method == "GET":
-            return serve_text(start_response, page_realization("/realization", flash=qd.get("m","") or ""))
+            return serve_text(environ, start_response, page_realization("/realization", flash=qd.get("m","") or ""))
         if path == "/reports/op-profit" and method == "GET":
-            return serve_text(start_response, page_op_profit("/reports/op-profit", qd, flash=qd.get("m","") or ""))
+            return serve_text(environ, start_response, page_op_profit("/reports/op-profit", qd, flash=qd.get("m","") or ""))
         if path == "/reports/op-profit/details" and method == "GET":
-            return serve_text(start_response, page_op_profit_details("/reports/op-profit/details", qd, flash=qd.get("m","") or ""))
+            return serve_text(environ, start_response, page_op_profit_details("/reports/op-profit/details", qd, flash=qd.get("m","") or ""))
         if path == "/reports/recon" and method == "GET":
-            return serve_text(start_response, page_recon("/reports/recon", qd, flash=qd.get("m","") or ""))
+            return serve_text(environ, start_response, page_recon("/reports/recon", qd, flash=qd.get("m","") or ""))
         if path == "/reports/kudir" and method == "GET":
-            return serve_text(start_response, page_kudir("/reports/kudir", qd, flash=qd.get("m","") or ""))
+            return serve_text(environ, start_response, page_kudir("/reports/kudir", qd, flash=qd.get("m","") or ""))
         if path == "/tax/usn" and method == "GET":
-            return serve_text(start_response, page_usn("/tax/usn", qd, flash=qd.get("m","") or ""))
+            return serve_text(environ, start_response, page_usn("/tax/usn", qd, flash=qd.get("m","") or ""))
 
         return not_found(start_response)
 
+    except RequestTooLarge as e:
+        return serve_text(environ, start_response, f"<h1>Слишком большой запрос</h1><p>{h(str(e))}</p>",
+                          status="413 Payload Too Large")
     except Exception as e:
         tb = traceback.format_exc()
         html = f"<h1>Ошибка</h1><pre>{h(str(e))}</pre><pre>{h(tb)}</pre>"
-        return serve_text(start_response, html, status="500 Internal Server Error")
+        return serve_text(environ, start_response, html, status="500 Internal Server Error")
 
 
 class QuietHandler(WSGIRequestHandler):
@@ -5774,6 +6754,7 @@ def fetch_bank_statement_from_email():
         processed_files = []
         existing_fp = set(bank_row_fingerprint(x) for x in STATE.bank_rows)
         
+        statement_files: List[Tuple[str, str]] = []
         for email_date, email_msg in statement_emails:
             txt_data = None
             txt_filename = None
@@ -5803,12 +6784,13 @@ def fetch_bank_statement_from_email():
             tmp = os.path.join(DOWNLOAD_DIR, f"email_{int(time.time())}_{safe_filename(txt_filename)}")
             with open(tmp, "wb") as f:
                 f.write(txt_data)
-            
-            new_rows = parse_client_bank_file(tmp)
-            
-            cp_map = STATE.cp_category_map
-            user_map = STATE.user_category_map
-            
+            statement_files.append((txt_filename, tmp))
+
+        parsed = [parse_client_bank_file(tmp) for _, tmp in statement_files]
+        cp_map = STATE.cp_category_map
+        user_map = STATE.user_category_map
+
+        for (txt_filename, _), new_rows in zip(statement_files, parsed):
             for r in new_rows:
                 r["category"] = detect_category(
                     r.get("counterparty", ""),
@@ -5819,13 +6801,16 @@ def fetch_bank_statement_from_email():
             
             new_fp = [bank_row_fingerprint(x) for x in new_rows]
             
-            added = 0
+            to_add = []
+            new_cps: List[Dict[str, Any]] = []
             for r, fp in zip(new_rows, new_fp):
                 if fp not in existing_fp:
-                    STATE.auto_upsert_counterparty_from_bank_row(r)
-                    STATE.add_bank_row(r)
+                    STATE.auto_upsert_counterparty_from_bank_row(r, new_cps)
+                    to_add.append(r)
                     existing_fp.add(fp)
-                    added += 1
+            STATE.add_counterparties_if_absent(new_cps)
+            STATE.add_bank_rows(to_add)
+            added = len(to_add)
             
             total_added += added
             if txt_filename:
@@ -5880,6 +6865,7 @@ def run_server(host="0.0.0.0", port=5000):
     
     scheduler = threading.Thread(target=email_scheduler_thread, daemon=True)
     scheduler.start()
+
     print("Запущен планировщик загрузки выписок с почты (12:00 ежедневно)")
     
     print(f"Запуск сервера на http://{host}:{port}")
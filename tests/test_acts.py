@@ -0,0 +1,80 @@
+"""Акты без базы: iter_act_batches (keyset по created_at, id) на таблице, где есть строки без created_at."""
+import contextlib
+import unittest
+from collections import namedtuple
+from datetime import datetime, timedelta
+from unittest import mock
+
+import main
+
+Column = namedtuple("Column", "name")
+COLUMNS = ("id", "created_at", "lines_json", "executor_json", "customer_json")
+
+
+class FakeActsCursor:
+    """Выполняет три запроса iter_act_batches так, как их выполнила бы PostgreSQL:
+    ORDER BY created_at DESC (NULL первыми), id DESC."""
+    description = [Column(c) for c in COLUMNS]
+
+    def __init__(self, table, log):
+        self.table = table
+        self.log = log
+        self.rows = []
+
+    def execute(self, sql, params):
+        self.log.append(sql)
+        *args, limit = params
+        if "created_at IS NOT NULL OR id < %s" in sql:
+            (last_id,) = args
+            keep = lambda r: r[1] is not None or r[0] < last_id
+        elif "created_at < %s" in sql:
+            ts, _, last_id = args
+            keep = lambda r: r[1] is not None and (r[1] < ts or (r[1] == ts and r[0] < last_id))
+        else:
+            keep = lambda r: True
+        ordered = sorted(self.table, key=lambda r: (r[1] is None, r[1] or datetime.min, r[0]), reverse=True)
+        self.rows = [r for r in ordered if keep(r)][:limit]
+
+    def fetchall(self):
+        return self.rows
+
+
+class IterActBatchesTest(unittest.TestCase):
+    def setUp(self):
+        base = datetime(2024, 1, 1)
+        # Несколько актов с одинаковым created_at (одна загрузка) и несколько без него
+        times = [None, None, None, base, base, base, base + timedelta(days=1), base - timedelta(days=3)]
+        self.table = [(f"a{i:02d}", t, "[]", "{}", "{}") for i, t in enumerate(times)]
+        self.queries = []
+
+        @contextlib.contextmanager
+        def fake_db_cursor(*args, **kwargs):
+            yield FakeActsCursor(self.table, self.queries)
+
+        patcher = mock.patch.object(main, "db_cursor", fake_db_cursor)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.state = main.AccountingStateDB()
+
+    def expected_ids(self):
+        ordered = sorted(self.table, key=lambda r: (r[1] is None, r[1] or datetime.min, r[0]), reverse=True)
+        return [r[0] for r in ordered]
+
+    def test_every_batch_size_returns_each_act_once_in_order(self):
+        for batch in range(1, len(self.table) + 2):
+            with self.subTest(batch=batch):
+                ids = [a["id"] for chunk in self.state.iter_act_batches(batch) for a in chunk]
+                self.assertEqual(ids, self.expected_ids())
+
+    def test_batches_are_inflated_and_sized(self):
+        chunks = list(self.state.iter_act_batches(3))
+        self.assertEqual([len(c) for c in chunks], [3, 3, 2])
+        self.assertEqual(chunks[0][0]["lines"], [])
+
+    def test_stops_after_a_short_batch(self):
+        list(self.state.iter_act_batches(5))
+        self.assertEqual(len(self.queries), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,50 @@
+"""Страница банка: фильтр по датам и поиск идут в базе по op_date / search_text.
+Нужна живая PostgreSQL: тесты запускаются, только если задан DATABASE_URL."""
+import os
+import unittest
+from datetime import date
+
+if os.environ.get("DATABASE_URL"):
+    import main
+else:
+    main = None
+
+
+@unittest.skipUnless(main, "DATABASE_URL не задан")
+class BankPageTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        main.init_database()
+        cls.state = main.AccountingStateDB()
+
+    def setUp(self):
+        self.rid = main.new_id()
+        self.state.add_bank_row({
+            "id": self.rid, "date": "10.01.2024", "month": 1, "incoming": "1500,00", "outgoing": "0",
+            "purpose": "Оплата по счёту 17", "counterparty": "ООО Ромашка", "category": "Выручка",
+        })
+
+    def tearDown(self):
+        with main.db_cursor() as cur:
+            cur.execute("DELETE FROM bank_rows WHERE id = %s", (self.rid,))
+
+    def page_ids(self, date_from=None, date_to=None, search=""):
+        rows, _, _, disputed = self.state.bank_page(date_from, date_to, search, "", 1, 1000)
+        return {r.get("id") for r in rows} | {r.get("id") for r in disputed}
+
+    def test_filter_follows_edited_date(self):
+        self.assertIn(self.rid, self.page_ids(date(2024, 1, 1), date(2024, 1, 31)))
+        self.state.update_bank_row(self.rid, {"date": "15.03.2024"})
+        self.assertNotIn(self.rid, self.page_ids(date(2024, 1, 1), date(2024, 1, 31)))
+        self.assertIn(self.rid, self.page_ids(date(2024, 3, 1), date(2024, 3, 31)))
+
+    def test_search_is_case_insensitive_for_cyrillic(self):
+        self.assertIn(self.rid, self.page_ids(search="ромашка"))
+        self.assertIn(self.rid, self.page_ids(search="1500.00"))
+        self.state.update_bank_row(self.rid, {"counterparty": "ИП Лютиков"})
+        self.assertNotIn(self.rid, self.page_ids(search="ромашка"))
+        self.assertIn(self.rid, self.page_ids(search="лютиков"))
+
+
+if __name__ == "__main__":
+    unittest.main()
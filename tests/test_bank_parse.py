@@ -0,0 +1,69 @@
+"""Разбор выписки 1CClientBankExchange (cp1251, CRLF) без базы."""
+import os
+import tempfile
+import unittest
+from decimal import Decimal
+
+import main
+
+STATEMENT = """1CClientBankExchange
+ВерсияФормата=1.03
+Кодировка=Windows
+РасчСчет=40802810000000000001
+
+СекцияДокумент=Платежное поручение
+Номер=17
+Дата=10.01.2024
+Сумма=1 500,50
+ПлательщикСчет=40702810000000000002
+Плательщик=ООО "Ромашка"
+ПлательщикИНН=7701234567
+ПолучательСчет=40802810000000000001
+Получатель=ИП Селецкий
+ДатаПоступило=11.01.2024
+НазначениеПлатежа=Оплата по счёту 17 = аванс
+КонецДокумента
+СекцияДокумент=Платежное поручение
+Номер=18
+Дата=15.02.2024
+Сумма=200
+ПлательщикСчет=40802810000000000001
+Плательщик=ИП Селецкий
+ПолучательСчет=40702810000000000003
+Получатель=ИНН 7709876543 ООО Лютик
+ДатаСписано=16.02.2024
+НазначениеПлатежа=Аренда
+КонецДокумента
+КонецФайла
+"""
+
+
+class ParseClientBankFileTest(unittest.TestCase):
+    def parse(self, text: str):
+        fd, path = tempfile.mkstemp(suffix=".txt")
+        self.addCleanup(os.remove, path)
+        with os.fdopen(fd, "wb") as f:
+            f.write(text.replace("\n", "\r\n").encode("cp1251"))
+        return main.parse_client_bank_file(path)
+
+    def test_incoming_and_outgoing_rows(self):
+        incoming, outgoing = self.parse(STATEMENT)
+        self.assertEqual(incoming["date"], "11.01.2024")
+        self.assertEqual(incoming["incoming"], Decimal("1500.50"))
+        self.assertEqual(incoming["outgoing"], 0)
+        self.assertEqual(incoming["purpose"], "Оплата по счёту 17 = аванс")
+        self.assertEqual((incoming["counterparty"], incoming["cp_inn"]), ('ООО "Ромашка"', "7701234567"))
+        self.assertEqual(incoming["month"], "01.2024")
+        self.assertEqual(outgoing["date"], "16.02.2024")
+        self.assertEqual(outgoing["outgoing"], Decimal("200"))
+        self.assertEqual(outgoing["doctype"], "Платежное поручение")
+        # ИНН из имени получателя переносится в cp_inn
+        self.assertEqual((outgoing["counterparty"], outgoing["cp_inn"]), ("ООО Лютик", "7709876543"))
+
+    def test_unterminated_document_is_dropped(self):
+        rows = self.parse(STATEMENT.replace("КонецДокумента\nКонецФайла", "КонецФайла"))
+        self.assertEqual(len(rows), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,78 @@
+"""Строки выписки без базы: проверка «ничего не изменилось» в update_bank_row по кэшу bank_rows."""
+import contextlib
+import unittest
+from datetime import date
+from decimal import Decimal
+from unittest import mock
+
+import main
+
+
+class FakeCursor:
+    def __init__(self):
+        self.executed = []
+
+    def execute(self, sql, params=None):
+        self.executed.append((sql, params))
+
+    def fetchall(self):
+        return []
+
+
+class UpdateBankRowTest(unittest.TestCase):
+    def setUp(self):
+        self.state = main.AccountingStateDB()
+        self.row = {
+            "id": "r1", "date": "10.01.2024", "month": "1", "incoming": Decimal("1500.00"),
+            "outgoing": Decimal("0.00"), "purpose": "Оплата", "counterparty": "ООО Ромашка",
+            "skip_outgoing": False, "category": "Выручка",
+        }
+        self.state._set_versioned("bank_rows", self.state._cache_version("bank_rows"), [self.row])
+        self.cursors = []
+
+        @contextlib.contextmanager
+        def fake_db_cursor(*args, **kwargs):
+            cur = FakeCursor()
+            self.cursors.append(cur)
+            yield cur
+
+        patches = [
+            mock.patch.object(main, "db_cursor", fake_db_cursor),
+            mock.patch.object(main, "_update_statement", lambda cur, table, columns, *a, **k: ("UPDATE", columns)),
+        ]
+        for p in patches:
+            p.start()
+            self.addCleanup(p.stop)
+
+    def test_same_date_is_a_no_op(self):
+        self.state.update_bank_row("r1", {"date": "10.01.2024"})
+        self.assertEqual(self.cursors, [])
+
+    def test_form_values_are_normalized_before_comparing(self):
+        self.state.update_bank_row("r1", {"month": 1, "incoming": "1 500,00", "outgoing": "0", "skip_outgoing": 0})
+        self.assertEqual(self.cursors, [])
+
+    def test_changed_date_writes_op_date(self):
+        self.state.update_bank_row("r1", {"date": "15.03.2024"})
+        (sql, params), = self.cursors[0].executed
+        self.assertEqual(sql[1], ("date_str", "op_date"))
+        self.assertEqual(params[:2], ["15.03.2024", date(2024, 3, 15)])
+
+    def test_changed_amount_is_written(self):
+        self.state.update_bank_row("r1", {"incoming": "1500,01"})
+        self.assertEqual(len(self.cursors), 1)
+
+
+class BankSearchTextTest(unittest.TestCase):
+    def test_cyrillic_is_upper_cased_and_spaces_collapsed(self):
+        text = main.bank_search_text("ооо  Ромашка", "Оплата\tпо счёту", "Выручка", None, None)
+        self.assertEqual(text, "ООО РОМАШКА ОПЛАТА ПО СЧЁТУ ВЫРУЧКА")
+
+    def test_only_nonzero_amounts_are_searchable(self):
+        text = main.bank_search_text("", "", "", "1 500,5", Decimal("0.00"))
+        self.assertEqual(text, "1500.50")
+        self.assertNotIn("0.00", main.bank_search_text("", "", "", Decimal("0"), "0"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,40 @@
+"""Поля для COPY ... WITH (FORMAT csv) без базы: кавычки, переводы строк и NULL."""
+import csv
+import io
+import unittest
+from datetime import date
+from decimal import Decimal
+
+import main
+
+
+class CopyCsvFieldTest(unittest.TestCase):
+    def roundtrip(self, values):
+        line = ",".join(main._copy_csv_field(v) for v in values) + "\n"
+        return next(csv.reader(io.StringIO(line)))
+
+    def test_null_and_empty_string_differ(self):
+        # В CSV-режиме COPY пустое поле без кавычек — NULL, а "" — пустая строка
+        self.assertEqual(main._copy_csv_field(None), "")
+        self.assertEqual(main._copy_csv_field(""), '""')
+
+    def test_special_characters_survive(self):
+        values = ['ООО "Ромашка"', "a,b", "две\nстроки", "\\N", " пробелы ", '""']
+        self.assertEqual(self.roundtrip(values), values)
+
+    def test_non_string_values(self):
+        self.assertEqual(self.roundtrip([Decimal("1500.50"), True, date(2024, 1, 10), 3]),
+                         ["1500.50", "True", "2024-01-10", "3"])
+
+    def test_bank_row_params_line(self):
+        row = {"id": "r1", "date": "10.01.2024", "month": "01.2024", "incoming": "1 500,50",
+               "purpose": 'Оплата, счёт "17"', "counterparty": "ООО Ромашка", "cp_inn": None}
+        params = main.AccountingStateDB._bank_row_params(row)
+        fields = self.roundtrip(params)
+        self.assertEqual(len(fields), len(main.BANK_ROW_INSERT_COLUMNS.split(",")))
+        self.assertEqual(fields[5], 'Оплата, счёт "17"')
+        self.assertEqual(fields[-2], "2024-01-10")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,74 @@
+"""Вспомогательные функции форматирования и разбора без базы."""
+import unittest
+from datetime import date
+from decimal import Decimal
+
+import main
+
+
+class FmtNumTest(unittest.TestCase):
+    def test_int_fast_path_matches_decimal_path(self):
+        for value in (0, 7, 1234567, -1234567):
+            for decimals, strip in ((2, False), (0, False), (2, True), (3, False)):
+                with self.subTest(value=value, decimals=decimals, strip=strip):
+                    self.assertEqual(main.fmt_num(value, decimals, strip),
+                                     main.fmt_num(Decimal(value), decimals, strip))
+
+    def test_grouping_and_rounding(self):
+        self.assertEqual(main.fmt_num(1234567), "1.234.567,00")
+        self.assertEqual(main.fmt_num(-1234567), "-1.234.567,00")
+        self.assertEqual(main.fmt_num(Decimal("1234.5")), "1.234,50")
+        self.assertEqual(main.fmt_num(Decimal("999.995")), "1.000,00")
+        self.assertEqual(main.fmt_num(Decimal("0.005")), "0,01")
+        self.assertEqual(main.fmt_num(Decimal("-0.005")), "-0,01")
+        self.assertEqual(main.fmt_num(1234.565), "1.234,57")
+        self.assertEqual(main.fmt_num(Decimal("12.3456"), 3), "12,346")
+
+    def test_strings_and_trailing_zeros(self):
+        self.assertEqual(main.fmt_num("1 234,567"), "1.234,57")
+        self.assertEqual(main.fmt_num("abc"), "0,00")
+        self.assertEqual(main.fmt_num(Decimal("1000.10"), 2, True), "1.000,1")
+        self.assertEqual(main.fmt_num(Decimal("1000.00"), 2, True), "1.000")
+        self.assertEqual(main.fmt_num(5, 0), "5")
+        self.assertEqual(main.fmt_num(None), "")
+
+
+class SplitInnFromNameTest(unittest.TestCase):
+    def test_inn_is_moved_out_of_the_name(self):
+        cases = {
+            "ООО Ромашка ИНН 7701234567": ("ООО Ромашка", "7701234567"),
+            "ИНН 7701234567 ООО Лютик": ("ООО Лютик", "7701234567"),
+            "7701234567 ООО Лютик": ("ООО Лютик", "7701234567"),
+            "ООО Ромашка 770123456789": ("ООО Ромашка", "770123456789"),
+            "  ООО  «Альфа», ИНН: 7701234567 ;": ("ООО «Альфа»", "7701234567"),
+        }
+        for name, expected in cases.items():
+            with self.subTest(name=name):
+                self.assertEqual(main.split_inn_from_name(name), expected)
+
+    def test_names_without_inn(self):
+        self.assertEqual(main.split_inn_from_name("ИП Иванов"), ("ИП Иванов", ""))
+        self.assertEqual(main.split_inn_from_name("ООО Ромашка - ИНН"), ("ООО Ромашка", ""))
+        self.assertEqual(main.split_inn_from_name("ООО 123"), ("ООО 123", ""))
+        self.assertEqual(main.split_inn_from_name("1234567890"), ("1234567890", ""))
+        self.assertEqual(main.split_inn_from_name(" "), ("", ""))
+
+
+class ParseDateTest(unittest.TestCase):
+    def test_valid_dates(self):
+        self.assertEqual(main.parse_date_ddmmyyyy("10.01.2024"), date(2024, 1, 10))
+        self.assertEqual(main.parse_date_ddmmyyyy("1.2.2024"), date(2024, 2, 1))
+        self.assertEqual(main.parse_date_ddmmyyyy(" 10.01.2024 "), date(2024, 1, 10))
+
+    def test_invalid_dates(self):
+        for s in ("", "31.02.2024", "2024-01-10", "10.01.24", "10.01.2024.", "aa.bb.cccc", "+1.01.2024", "100.01.2024"):
+            with self.subTest(s=s):
+                self.assertIsNone(main.parse_date_ddmmyyyy(s))
+
+    def test_month_from_date_str(self):
+        self.assertEqual(main.month_from_date_str("05.03.2024"), "03.2024")
+        self.assertEqual(main.month_from_date_str("31.02.2024"), "")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,140 @@
+"""Итоги отчётов маркетплейсов без базы: один проход по листу Ozon против прежних двух, текст PDF Wildberries."""
+import contextlib
+import os
+import tempfile
+import unittest
+from datetime import date
+from decimal import Decimal
+from unittest import mock
+
+import main
+
+try:
+    from openpyxl import Workbook
+except ImportError:
+    Workbook = None
+
+try:
+    from reportlab.pdfbase import pdfmetrics
+    from reportlab.pdfbase.ttfonts import TTFont
+    from reportlab.pdfgen import canvas
+except ImportError:
+    canvas = None
+
+# Кириллице в PDF нужен TTF-шрифт; встроенные шрифты reportlab её не содержат
+FONT_PATH = "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf"
+
+
+def naive_ozon_total(rows):
+    """Прежний разбор: сначала ищется строка «итого реализовано … вычетом возвратов», потом любое «итого»."""
+    for row in rows:
+        for i, cell in enumerate(row):
+            if cell and "итого реализовано" in str(cell).lower() and "вычетом возвратов" in str(cell).lower():
+                for j in range(i+1, len(row)):
+                    if row[j] is not None:
+                        return main.decimal_from_str(str(row[j]))
+    for row in rows:
+        for i, cell in enumerate(row):
+            if cell and "итого" in str(cell).lower():
+                for j in range(i+1, len(row)):
+                    if row[j] is not None:
+                        val = main.decimal_from_str(str(row[j]))
+                        if val > 0:
+                            return val
+    return Decimal("0")
+
+
+@unittest.skipIf(Workbook is None, "openpyxl не установлен")
+class ParseOzonTotalTest(unittest.TestCase):
+    def total(self, rows):
+        wb = Workbook()
+        for row in rows:
+            wb.active.append(row)
+        fd, path = tempfile.mkstemp(suffix=".xlsx")
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        wb.save(path)
+        return main.parse_ozon_excel_total(path)
+
+    def test_matches_two_pass_search(self):
+        primary = "Итого реализовано за вычетом возвратов"
+        cases = [
+            [["Отчёт", 1], ["Итого", None, 0, 5], [primary, None, 0]],
+            [["Итого", 0], ["ИТОГО", "7"]],
+            [["Итого", 3], [primary, "9 500,50"]],
+            [[primary], ["Итого", 3]],
+            [[date(2024, 1, 1), 12, Decimal("1.5")], ["итого по разделу", -4, 8]],
+            [["Нет итогов", 10]],
+        ]
+        for rows in cases:
+            with self.subTest(rows=rows):
+                self.assertEqual(self.total(rows), naive_ozon_total(rows))
+
+    def test_primary_row_wins_over_earlier_total(self):
+        rows = [["Итого", 3], ["Итого реализовано за вычетом возвратов", None, "12 345,67"]]
+        self.assertEqual(self.total(rows), Decimal("12345.67"))
+
+    def test_fallback_is_first_positive_total(self):
+        self.assertEqual(self.total([["Итого", 0, -2], ["Итого", 4], ["Итого", 5]]), Decimal("4"))
+
+    def test_broken_file_gives_zero(self):
+        fd, path = tempfile.mkstemp(suffix=".xlsx")
+        os.write(fd, b"not a workbook")
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        self.assertEqual(main.parse_ozon_excel_total(path), Decimal("0"))
+
+
+@unittest.skipIf(canvas is None or not os.path.exists(FONT_PATH), "нет reportlab или шрифта DejaVu")
+@unittest.skipIf(main.pdfium is None and main.pdfplumber is None, "нет библиотек чтения PDF")
+class ParseWbTotalTest(unittest.TestCase):
+    def make_pdf(self, pages):
+        pdfmetrics.registerFont(TTFont("DejaVu", FONT_PATH))
+        fd, path = tempfile.mkstemp(suffix=".pdf")
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        c = canvas.Canvas(path)
+        for lines in pages:
+            c.setFont("DejaVu", 10)
+            for n, line in enumerate(lines):
+                c.drawString(50, 800 - 20 * n, line)
+            c.showPage()
+        c.save()
+        return path
+
+    def backends(self):
+        """Разбор через PDFium и запасной разбор через pdfplumber — в зависимости от того, что установлено."""
+        if main.pdfium is not None:
+            yield "pdfium", contextlib.nullcontext()
+        if main.pdfplumber is not None:
+            yield "pdfplumber", mock.patch.object(main, "pdfium", None)
+
+    def assertTotal(self, path, expected):
+        for name, backend in self.backends():
+            with self.subTest(backend=name), backend:
+                self.assertEqual(main.parse_wb_pdf_total(path), expected)
+
+    def test_total_on_a_later_page(self):
+        path = self.make_pdf([
+            ["Отчёт Wildberries за январь 2024"],
+            ["Продажи 1 000,00", "Итого к перечислению продавцу: 12 345,67 руб. 0"],
+        ])
+        self.assertTotal(path, Decimal("12345.67"))
+
+    def test_first_matching_line_wins(self):
+        path = self.make_pdf([["К перечислению продавцу 500", "Итого к перечислению продавцу 900"]])
+        self.assertTotal(path, Decimal("500"))
+
+    def test_no_total_gives_zero(self):
+        self.assertTotal(self.make_pdf([["Продажи 1 000,00"]]), Decimal("0"))
+
+    def test_broken_file_gives_zero(self):
+        fd, path = tempfile.mkstemp(suffix=".pdf")
+        os.write(fd, b"not a pdf")
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        self.assertTotal(path, Decimal("0"))
+
+
+if __name__ == "__main__":
+    unittest.main()
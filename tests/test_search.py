@@ -0,0 +1,39 @@
+"""Глобальный поиск без базы: _search_hits по общей строке полей против поиска по каждому полю."""
+import random
+import unittest
+
+import main
+
+
+def naive_hits(rows, q):
+    return [i for i, row in enumerate(rows) if any(q in main.norm_text(v) for v in row)]
+
+
+class SearchHitsTest(unittest.TestCase):
+    def test_matches_per_field_search(self):
+        rng = random.Random(7)
+        alphabet = "аб в  Аб\t1"
+        for _ in range(300):
+            rows = [tuple("".join(rng.choice(alphabet) for _ in range(rng.randrange(0, 6)))
+                          for _ in range(rng.randrange(1, 3)))
+                    for _ in range(rng.randrange(0, 8))]
+            q = main.norm_text("".join(rng.choice(alphabet) for _ in range(rng.randrange(1, 4))))
+            if not q:
+                continue
+            with self.subTest(rows=rows, q=q):
+                hay = main._search_haystack(rows)
+                self.assertEqual(list(main._search_hits(hay, q)), naive_hits(rows, q))
+
+    def test_match_does_not_cross_field_or_row_boundaries(self):
+        rows = [("ООО РОМ", "АШКА"), ("РОМ",), ("АШКА", "")]
+        hay = main._search_haystack(rows)
+        self.assertEqual(list(main._search_hits(hay, "РОМАШКА")), [])
+        self.assertEqual(list(main._search_hits(hay, "РОМ")), [0, 1])
+
+    def test_row_is_reported_once(self):
+        hay = main._search_haystack([("аренда аренда", "аренда"), ("нет",), ("Аренда",)])
+        self.assertEqual(list(main._search_hits(hay, "АРЕНДА")), [0, 2])
+
+
+if __name__ == "__main__":
+    unittest.main()
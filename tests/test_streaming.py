@@ -0,0 +1,48 @@
+"""Потоковая отдача страниц (serve_stream) без сервера: gzip с Z_SYNC_FLUSH после каждого куска."""
+import gzip
+import unittest
+import zlib
+
+import main
+
+CHUNKS = ["<html><body>", "<tr><td>Ромашка</td></tr>" * 50, "", "</body></html>"]
+
+
+class ServeStreamTest(unittest.TestCase):
+    def serve(self, chunks, accept_encoding=""):
+        started = []
+        body = main.serve_stream({"HTTP_ACCEPT_ENCODING": accept_encoding},
+                                 lambda status, headers: started.append((status, dict(headers))), chunks)
+        return started, body
+
+    def test_plain_output_is_the_joined_page(self):
+        started, body = self.serve(CHUNKS)
+        self.assertEqual(b"".join(body).decode("utf-8"), "".join(CHUNKS))
+        self.assertNotIn("Content-Encoding", started[0][1])
+
+    def test_gzip_output_decompresses_to_the_page(self):
+        started, body = self.serve(CHUNKS, "gzip, deflate")
+        self.assertEqual(started[0][1]["Content-Encoding"], "gzip")
+        self.assertEqual(gzip.decompress(b"".join(body)).decode("utf-8"), "".join(CHUNKS))
+
+    def test_each_gzip_piece_is_flushed(self):
+        _, body = self.serve(CHUNKS, "gzip")
+        decomp = zlib.decompressobj(31)
+        pieces = iter(body)
+        for chunk in CHUNKS:
+            # Всё, что отправлено к этому моменту, уже распаковывается без следующих кусков
+            self.assertEqual(decomp.decompress(next(pieces)).decode("utf-8"), chunk)
+
+    def test_error_in_first_chunk_happens_before_start_response(self):
+        def failing():
+            raise RuntimeError("db down")
+            yield ""
+
+        started = []
+        with self.assertRaises(RuntimeError):
+            main.serve_stream({}, lambda *a: started.append(a), failing())
+        self.assertEqual(started, [])
+
+
+if __name__ == "__main__":
+    unittest.main()